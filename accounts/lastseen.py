@@ -0,0 +1,93 @@
+"""
+Accounts — Last Seen Buffer
+Coalesces last_seen updates from authenticated requests. Each user is
+written at most once per LAST_SEEN_MIN_INTERVAL seconds; pending
+timestamps are flushed together every LAST_SEEN_FLUSH_INTERVAL seconds in
+one bulk UPDATE, and once more when the process exits. The write rate
+follows the number of active users, not the request rate.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, DateTimeField, Value, When
+
+logger = logging.getLogger(__name__)
+
+# Users per UPDATE statement, to stay well under SQLite's variable limit
+FLUSH_CHUNK = 500
+
+
+class LastSeenBuffer:
+
+    def __init__(self, min_interval=None, flush_interval=None):
+        self.min_interval = min_interval if min_interval is not None else getattr(settings, 'LAST_SEEN_MIN_INTERVAL', 60)
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(settings, 'LAST_SEEN_FLUSH_INTERVAL', 30)
+        self._pending = {}   # {user_id: datetime to write}
+        self._written = {}   # {user_id: monotonic time of the last accepted touch}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def touch(self, user_id, when):
+        """Record that the user was seen at ``when``; a no-op inside their minimum interval."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._written.get(user_id, -self.min_interval) < self.min_interval:
+                return
+            self._written[user_id] = now
+            self._pending[user_id] = when
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            connections.close_all()
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # Forget users idle for longer than the interval; they may write right away
+            cutoff = time.monotonic() - self.min_interval
+            self._written = {uid: t for uid, t in self._written.items() if t > cutoff}
+        return pending
+
+    def flush(self):
+        pending = self._take()
+        if not pending:
+            return
+        try:
+            self._persist(pending)
+        except Exception:
+            logger.exception('Failed to persist last_seen for %d users', len(pending))
+
+    def flush_sync(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.flush()
+
+    def _persist(self, pending):
+        from accounts.models import UserProfile
+        items = list(pending.items())
+        for start in range(0, len(items), FLUSH_CHUNK):
+            chunk = items[start:start + FLUSH_CHUNK]
+            UserProfile.objects.filter(user_id__in=[uid for uid, _ in chunk]).update(
+                last_seen=Case(
+                    *[When(user_id=uid, then=Value(when)) for uid, when in chunk],
+                    output_field=DateTimeField(),
+                )
+            )
+
+
+last_seen = LastSeenBuffer()
+atexit.register(last_seen.flush_sync)
@@ -1,21 +1,35 @@
 """
 Accounts — Middleware
-Updates user's last_seen timestamp on each request.
+Records the user's last_seen timestamp on each request (buffered, see
+accounts.lastseen).
 """
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.utils import timezone
 
+from .lastseen import last_seen
+
 
 class UpdateLastSeenMiddleware:
+    # Async-capable so async views (the long-poll endpoint) stay on the event loop
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
         if request.user.is_authenticated:
-            try:
-                profile = request.user.profile
-                profile.last_seen = timezone.now()
-                profile.save(update_fields=['last_seen'])
-            except Exception:
-                pass
+            last_seen.touch(request.user.id, timezone.now())
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        user = await request.auser()
+        if user.is_authenticated:
+            last_seen.touch(user.id, timezone.now())
         return response
@@ -0,0 +1,73 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.lastseen import LastSeenBuffer, last_seen
+from accounts.models import UserProfile
+
+
+class LastSeenBufferTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.buffer = LastSeenBuffer(min_interval=60, flush_interval=3600)
+        self.addCleanup(self.buffer.flush_sync)
+
+    def last_seen(self, user):
+        return UserProfile.objects.get(user=user).last_seen
+
+    def test_touches_inside_the_interval_are_dropped(self):
+        first = timezone.now() - timedelta(hours=1)
+        self.buffer.touch(self.alice.id, first)
+        self.buffer.touch(self.alice.id, timezone.now())
+        self.buffer.flush_sync()
+        self.assertEqual(self.last_seen(self.alice), first)
+
+    def test_pending_users_are_written_in_one_update(self):
+        seen = {self.alice: timezone.now() - timedelta(hours=2), self.bob: timezone.now() - timedelta(hours=1)}
+        for user, when in seen.items():
+            self.buffer.touch(user.id, when)
+        with self.assertNumQueries(1):
+            self.buffer.flush_sync()
+        for user, when in seen.items():
+            self.assertEqual(self.last_seen(user), when)
+        with self.assertNumQueries(0):
+            self.buffer.flush_sync()
+
+    def test_user_may_write_again_after_the_interval(self):
+        buffer = LastSeenBuffer(min_interval=0, flush_interval=3600)
+        self.addCleanup(buffer.flush_sync)
+        later = timezone.now() - timedelta(minutes=1)
+        buffer.touch(self.alice.id, timezone.now() - timedelta(hours=1))
+        buffer.touch(self.alice.id, later)
+        buffer.flush_sync()
+        self.assertEqual(self.last_seen(self.alice), later)
+
+
+# Keep test logins out of the file-based session store
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class UpdateLastSeenMiddlewareTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.buffer = LastSeenBuffer(flush_interval=3600)
+        patcher = mock.patch('accounts.middleware.last_seen', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.buffer.flush_sync)
+        self.addCleanup(last_seen.flush_sync)
+
+    def test_requests_are_buffered_not_written(self):
+        self.client.force_login(self.alice)
+        before = UserProfile.objects.get(user=self.alice).last_seen
+        for _ in range(3):
+            self.client.get(reverse('accounts:search_users'), {'q': 'bob'})
+        self.assertEqual(UserProfile.objects.get(user=self.alice).last_seen, before)
+        self.assertEqual(list(self.buffer._pending), [self.alice.id])
+
+    def test_anonymous_requests_are_ignored(self):
+        self.client.get(reverse('accounts:login'))
+        self.assertEqual(self.buffer._pending, {})
@@ -6,6 +6,7 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from accounts.models import UserProfile
 from chat.models import Conversation, Message
+from chat.reactions import my_reactions
 
 
 class UserProfileSerializer(serializers.ModelSerializer):
@@ -25,35 +26,66 @@ class UserSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     sender_name = serializers.CharField(source='sender.username', read_only=True)
     sender_avatar = serializers.SerializerMethodField()
+    my_reactions = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = [
-            'id', 'conversation', 'sender', 'sender_name', 'sender_avatar',
+            'id', 'seq', 'conversation', 'sender', 'sender_name', 'sender_avatar',
             'content', 'message_type', 'media', 'timestamp',
             'is_delivered', 'is_read', 'is_edited', 'is_deleted',
-            'reply_to', 'reactions',
+            'reply_to', 'reactions', 'my_reactions',
         ]
-        read_only_fields = ['sender', 'timestamp']
+        read_only_fields = ['seq', 'sender', 'timestamp', 'reactions']
 
     def get_sender_avatar(self, obj):
         return obj.sender.profile.avatar_url
 
+    def get_my_reactions(self, obj):
+        """Emojis the requesting user reacted with (from context['my_reactions'] when prefetched)."""
+        if not obj.reactions:
+            return []
+        mine = self.context.get('my_reactions')
+        if mine is None:
+            request = self.context.get('request')
+            if not request or not request.user.is_authenticated:
+                return []
+            mine = my_reactions(request.user, [obj.id])
+        return sorted(mine.get(obj.id, ()))
+
 
 class ConversationSerializer(serializers.ModelSerializer):
+    """
+    The per-user fields come from the requesting user's ConversationMember
+    row, annotated onto the queryset by ConversationViewSet.
+    """
     participants = UserSerializer(many=True, read_only=True)
-    last_message = MessageSerializer(read_only=True)
-    unread = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+    unread = serializers.IntegerField(read_only=True, default=0)
+    is_pinned = serializers.BooleanField(read_only=True, default=False)
+    is_archived = serializers.BooleanField(read_only=True, default=False)
+    is_muted = serializers.BooleanField(read_only=True, default=False)
 
     class Meta:
         model = Conversation
         fields = [
             'id', 'participants', 'created_at', 'updated_at',
-            'is_pinned', 'is_archived', 'last_message', 'unread',
+            'is_pinned', 'is_archived', 'is_muted', 'last_message', 'unread',
         ]
 
-    def get_unread(self, obj):
-        request = self.context.get('request')
-        if request and request.user:
-            return obj.unread_count(request.user)
-        return 0
+    def get_last_message(self, obj):
+        """The inbox row's preview of the newest message, without loading it."""
+        if not getattr(obj, 'last_message_id', None):
+            return None
+        return {
+            'id': obj.last_message_id,
+            'content': obj.last_message_preview,
+            'timestamp': serializers.DateTimeField().to_representation(obj.last_activity),
+            'is_deleted': obj.last_message_deleted,
+        }
+
+
+class MemberStateSerializer(serializers.Serializer):
+    is_pinned = serializers.BooleanField(required=False)
+    is_archived = serializers.BooleanField(required=False)
+    is_muted = serializers.BooleanField(required=False)
@@ -0,0 +1,87 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from accounts.lastseen import last_seen
+from chat.models import Conversation, ConversationMember, Message
+
+
+# Keep test logins out of the file-based session store
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class ConversationApiTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = Conversation.objects.create()
+        self.conv.participants.add(self.alice, self.bob)
+        self.client.force_login(self.alice)
+        self.addCleanup(last_seen.flush_sync)
+
+    def test_list_previews_last_message_from_the_inbox_row(self):
+        message = Message.objects.create(conversation=self.conv, sender=self.bob, content='hello there')
+        response = self.client.get('/api/conversations/')
+
+        self.assertEqual(response.status_code, 200)
+        (row,) = response.json()['results']
+        self.assertEqual(row['last_message']['id'], message.id)
+        self.assertEqual(row['last_message']['content'], 'hello there')
+        self.assertEqual(row['unread'], 1)
+
+    def test_list_cost_does_not_grow_with_conversations(self):
+        Message.objects.create(conversation=self.conv, sender=self.bob, content='hi')
+        self.client.get('/api/conversations/')  # Warm the membership caches
+        with CaptureQueriesContext(connection) as one:
+            self.client.get('/api/conversations/')
+
+        for _ in range(5):
+            conv = Conversation.objects.create()
+            conv.participants.add(self.alice, self.bob)
+            Message.objects.create(conversation=conv, sender=self.bob, content='hi')
+        with self.assertNumQueries(len(one)):
+            self.client.get('/api/conversations/')
+
+    def test_empty_conversation_has_no_last_message(self):
+        response = self.client.get('/api/conversations/')
+        self.assertIsNone(response.json()['results'][0]['last_message'])
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class MemberStateApiTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.older, self.newer = Conversation.objects.create(), Conversation.objects.create()
+        for conv in (self.older, self.newer):
+            conv.participants.add(self.alice, self.bob)
+            Message.objects.create(conversation=conv, sender=self.bob, content='hi')
+        self.client.force_login(self.alice)
+        self.addCleanup(last_seen.flush_sync)
+
+    def listed(self, **params):
+        return [row['id'] for row in self.client.get('/api/conversations/', params).json()['results']]
+
+    def test_state_is_the_requesting_users_own(self):
+        response = self.client.patch(f'/api/conversations/{self.older.id}/state/',
+                                     {'is_pinned': True, 'is_muted': True}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['is_pinned'], response.json()['is_muted']), (True, True))
+        bob_row = ConversationMember.objects.get(user=self.bob, conversation=self.older)
+        self.assertEqual((bob_row.is_pinned, bob_row.is_muted), (False, False))
+
+    def test_pinned_first_then_by_activity(self):
+        self.assertEqual(self.listed(), [self.newer.id, self.older.id])
+        ConversationMember.objects.filter(user=self.alice, conversation=self.older).update(is_pinned=True)
+        self.assertEqual(self.listed(), [self.older.id, self.newer.id])
+        self.assertEqual(self.listed(pinned='true'), [self.older.id])
+
+    def test_archived_filter(self):
+        ConversationMember.objects.filter(user=self.alice, conversation=self.newer).update(is_archived=True)
+        self.assertEqual(self.listed(archived='true'), [self.newer.id])
+        self.assertEqual(self.listed(archived='false'), [self.older.id])
+
+    def test_outsider_cannot_set_state(self):
+        self.client.force_login(User.objects.create_user('eve'))
+        response = self.client.patch(f'/api/conversations/{self.older.id}/state/',
+                                     {'is_pinned': True}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
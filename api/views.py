@@ -4,10 +4,14 @@ DRF ViewSets for Users, Conversations, and Messages.
 """
 from rest_framework import viewsets, permissions, filters
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from django.contrib.auth.models import User
-from chat.models import Conversation, Message
-from .serializers import UserSerializer, ConversationSerializer, MessageSerializer
+from django.db.models import F
+from chat import history
+from chat.models import Conversation, ConversationMember, Message
+from chat.reactions import my_reactions
+from .serializers import UserSerializer, ConversationSerializer, MemberStateSerializer, MessageSerializer
 
 
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
@@ -23,18 +27,61 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class ConversationViewSet(viewsets.ModelViewSet):
+    """
+    Conversations with the requesting user's membership state, pinned first
+    and then by activity. The list takes ?archived= and ?pinned= filters.
+    """
     serializer_class = ConversationSerializer
 
     def get_queryset(self):
-        return Conversation.objects.filter(
-            participants=self.request.user
-        ).prefetch_related('participants', 'participants__profile')
+        # One filter() call so every members__ lookup below uses the same join
+        member = {'members__user': self.request.user}
+        if self.action == 'list':
+            for flag in ('archived', 'pinned'):
+                value = self.request.query_params.get(flag)
+                if value is not None:
+                    member[f'members__is_{flag}'] = value.lower() in ('1', 'true', 'yes')
+        return Conversation.objects.filter(**member).annotate(
+            is_pinned=F('members__is_pinned'),
+            is_archived=F('members__is_archived'),
+            is_muted=F('members__is_muted'),
+            unread=F('members__unread_count'),
+            last_activity=F('members__last_activity'),
+            last_message_id=F('members__last_message_id'),
+            last_message_preview=F('members__last_message_preview'),
+            last_message_deleted=F('members__last_message_deleted'),
+        ).prefetch_related('participants', 'participants__profile').order_by('-is_pinned', '-last_activity')
+
+    @action(detail=True, methods=['patch'])
+    def state(self, request, pk=None):
+        """Set the requesting user's pin/archive/mute flags on the conversation."""
+        conversation = self.get_object()
+        serializer = MemberStateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data:
+            ConversationMember.objects.filter(
+                user=request.user, conversation=conversation,
+            ).update(**serializer.validated_data)
+        return Response(self.get_serializer(self.get_object()).data)
 
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
+        """
+        Newest first, 100 per page by default; page back with ?before_seq=
+        (the smallest seq received) or forward with ?after_seq=.
+        """
         conversation = self.get_object()
-        messages = conversation.messages.all().order_by('-timestamp')[:100]
-        serializer = MessageSerializer(messages, many=True)
+        try:
+            before_seq, after_seq, limit = history.parse_cursor(request.query_params, default_limit=100)
+        except ValueError:
+            raise ValidationError('Invalid cursor')
+        messages, _ = history.page(conversation.id, before_seq, after_seq, limit)
+        messages = messages[::-1]
+        mine = my_reactions(request.user, [m.id for m in messages if m.reactions])
+        serializer = MessageSerializer(messages, many=True, context={
+            'request': request,
+            'my_reactions': mine,
+        })
         return Response(serializer.data)
 
 
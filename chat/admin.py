@@ -1,11 +1,10 @@
 from django.contrib import admin
-from .models import Conversation, Message
+from .models import Conversation, ConversationMember, Message, Reaction
 
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created_at', 'updated_at', 'is_pinned', 'is_archived')
-    list_filter = ('is_pinned', 'is_archived')
+    list_display = ('id', 'created_at', 'updated_at')
     filter_horizontal = ('participants',)
 
 
@@ -15,3 +14,16 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ('message_type', 'is_read', 'is_delivered', 'is_deleted')
     search_fields = ('content', 'sender__username')
     raw_id_fields = ('sender', 'conversation', 'reply_to')
+
+
+@admin.register(ConversationMember)
+class ConversationMemberAdmin(admin.ModelAdmin):
+    list_display = ('id', 'conversation', 'user', 'last_read_message_id', 'unread_count', 'is_pinned', 'is_archived', 'is_muted')
+    list_filter = ('is_pinned', 'is_archived', 'is_muted')
+    raw_id_fields = ('conversation', 'user')
+
+
+@admin.register(Reaction)
+class ReactionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'message', 'user', 'emoji', 'created_at')
+    raw_id_fields = ('message', 'user')
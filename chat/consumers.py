@@ -1,202 +1,197 @@
 """
 Chat — WebSocket Consumers
-Async consumer for real-time messaging over WebSockets.
+Async consumers for real-time messaging over WebSockets.
 """
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.utils import timezone
+from . import history, inbox, membership, replay
+from .events import conversation_event, conversation_group, sidebar_event, user_group
+from .online import online_users
+from .outbound import OutboundQueueMixin
+from .readcursor import read_cursors, read_position
+from .recent import recent_messages
+from .writebehind import write_behind
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ConversationActionsMixin:
     """
-    Handles WebSocket connections for chat conversations.
+    Conversation frame handling shared by ChatConsumer (one socket per
+    conversation) and MultiplexConsumer (one socket per user). Every action
+    takes the conversation id explicitly instead of reading it off the socket.
     Supports: messages, typing indicators, read receipts, reactions,
     edit/delete, and online presence.
     """
 
-    async def connect(self):
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.room_group_name = f'chat_{self.conversation_id}'
-        self.user = self.scope['user']
-
-        if self.user.is_anonymous:
-            await self.close()
-            return
-
-        # Verify user is a participant in this conversation
-        is_participant = await self.check_participant()
-        if not is_participant:
-            await self.close()
-            return
-
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        await self.accept()
-
-        # Set user online
-        await self.set_online(True)
-
-        # Notify group that user is online
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'username': self.user.username,
-                'is_online': True,
-            }
-        )
+    participant_ids = None
 
-    async def disconnect(self, close_code):
-        await self.set_online(False)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'username': self.user.username,
-                'is_online': False,
-            }
-        )
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def handle_conversation_frame(self, conversation_id, data):
+        room = conversation_group(conversation_id)
         msg_type = data.get('type', 'message')
 
         if msg_type == 'message':
-            message = await self.save_message(data.get('content', ''))
+            if write_behind.enabled:
+                message = self.queue_message(conversation_id, data.get('content', ''))
+            else:
+                message = await self.save_message(conversation_id, data.get('content', ''))
             await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
+                room,
+                conversation_event(conversation_id, 'chat_message', {
+                    'type': 'message',
                     'message': message,
-                }
+                })
             )
+            await self.notify_sidebar(conversation_id, message)
         elif msg_type == 'typing':
             await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
+                room,
+                conversation_event(conversation_id, 'typing_indicator', {
+                    'type': 'typing',
                     'username': self.user.username,
                     'is_typing': data.get('is_typing', False),
-                }
+                }, username=self.user.username,
+                    coalesce=f'typing:{conversation_id}:{self.user.username}')
             )
         elif msg_type == 'read_receipt':
-            message_id = data.get('message_id')
+            message_id = await self.mark_as_read(conversation_id, data.get('message_id'))
             if message_id:
-                await self.mark_as_read(message_id)
                 await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
+                    room,
+                    conversation_event(conversation_id, 'read_receipt', {
                         'type': 'read_receipt',
                         'message_id': message_id,
                         'reader': self.user.username,
-                    }
+                    })
                 )
         elif msg_type == 'reaction':
             message_id = data.get('message_id')
             emoji = data.get('emoji')
             if message_id and emoji:
-                await self.add_reaction(message_id, emoji)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'message_reaction',
-                        'message_id': message_id,
-                        'emoji': emoji,
-                        'username': self.user.username,
-                    }
-                )
+                result = await self.add_reaction(conversation_id, message_id, emoji)
+                if result is not None:
+                    added, counts, message_seq = result
+                    await self.channel_layer.group_send(
+                        room,
+                        conversation_event(conversation_id, 'message_reaction', {
+                            'type': 'reaction',
+                            'message_id': message_id,
+                            'message_seq': message_seq,
+                            'emoji': emoji,
+                            'username': self.user.username,
+                            'added': added,
+                            'reactions': counts,
+                        })
+                    )
         elif msg_type == 'edit':
             message_id = data.get('message_id')
             new_content = data.get('content', '')
             if message_id:
-                await self.edit_message(message_id, new_content)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'message_edited',
-                        'message_id': message_id,
-                        'content': new_content,
-                        'username': self.user.username,
-                    }
-                )
+                message_seq = await self.edit_message(conversation_id, message_id, new_content)
+                if message_seq:
+                    await self.channel_layer.group_send(
+                        room,
+                        conversation_event(conversation_id, 'message_edited', {
+                            'type': 'edited',
+                            'message_id': message_id,
+                            'message_seq': message_seq,
+                            'content': new_content,
+                        })
+                    )
         elif msg_type == 'delete':
             message_id = data.get('message_id')
             if message_id:
-                await self.delete_message(message_id)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'message_deleted',
-                        'message_id': message_id,
-                        'username': self.user.username,
-                    }
-                )
+                message_seq = await self.delete_message(conversation_id, message_id)
+                if message_seq:
+                    await self.channel_layer.group_send(
+                        room,
+                        conversation_event(conversation_id, 'message_deleted', {
+                            'type': 'deleted',
+                            'message_id': message_id,
+                            'message_seq': message_seq,
+                        })
+                    )
 
-    # ── Group message handlers ──────────────────────────────────────────
-
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-        }))
+    async def announce_status(self, conversation_id, is_online):
+        await self.channel_layer.group_send(
+            conversation_group(conversation_id),
+            conversation_event(conversation_id, 'user_status', {
+                'type': 'status',
+                'username': self.user.username,
+                'is_online': is_online,
+            }, coalesce=f'status:{conversation_id}:{self.user.username}')
+        )
 
-    async def typing_indicator(self, event):
-        if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'username': event['username'],
-                'is_typing': event['is_typing'],
-            }))
+    async def send_subscribed(self, conversation_id, resume=None, after_seq=None):
+        """
+        Send what a reconnecting client missed since resume ({"epoch", "seq"}),
+        from the replay buffer or else as a 'resync' of the messages after
+        after_seq, then the 'subscribed' frame with the position to resume
+        from next time. Call after joining the conversation's group.
+        """
+        # Taken after group_add: anything newer reaches this socket live
+        epoch, seq = replay.position(conversation_id)
+        replayed = 0
+        if isinstance(resume, dict):
+            missed = replay.resume(conversation_id, resume.get('epoch'), resume.get('seq'))
+            if missed is not None:
+                for text in missed:
+                    await self.send(text_data=text)
+                replayed = len(missed)
+            else:
+                messages, truncated = await self.resync_messages(conversation_id, after_seq)
+                await self.send(text_data=json.dumps({
+                    'type': 'resync',
+                    'conversation_id': conversation_id,
+                    'messages': messages,
+                    'truncated': truncated,
+                }))
 
-    async def read_receipt(self, event):
         await self.send(text_data=json.dumps({
-            'type': 'read_receipt',
-            'message_id': event['message_id'],
-            'reader': event['reader'],
+            'type': 'subscribed',
+            'conversation_id': conversation_id,
+            'epoch': epoch,
+            'seq': seq,
+            'replayed': replayed,
         }))
 
-    async def message_reaction(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'reaction',
-            'message_id': event['message_id'],
-            'emoji': event['emoji'],
-            'username': event['username'],
-        }))
+    async def notify_sidebar(self, conversation_id, message):
+        """Push the new message to every participant's per-user group."""
+        event = sidebar_event(conversation_id, message)
+        for user_id in self.participant_ids.get(conversation_id, ()):
+            await self.channel_layer.group_send(user_group(user_id), event)
 
-    async def message_edited(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'edited',
-            'message_id': event['message_id'],
-            'content': event['content'],
-        }))
+    # ── Group message handlers ──────────────────────────────────────────
+    # Frames arrive pre-encoded in event['text'] (see chat.events.group_event),
+    # so each recipient forwards the same string without re-serializing.
+    # Events carrying a 'coalesce' key are ephemeral in the outbound queue;
+    # the rest are stamped with a replay seq for resuming clients.
 
-    async def message_deleted(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'deleted',
-            'message_id': event['message_id'],
-        }))
+    async def forward(self, event):
+        await self.send(text_data=replay.record(event), coalesce=event.get('coalesce'))
 
-    async def user_status(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'status',
-            'username': event['username'],
-            'is_online': event['is_online'],
-        }))
+    chat_message = forward
+    message_persisted = forward
+    read_receipt = forward
+    message_reaction = forward
+    message_edited = forward
+    message_deleted = forward
+    user_status = forward
+    sidebar_update = forward
+
+    async def typing_indicator(self, event):
+        # Don't echo a user's own typing back to them
+        if event['username'] != self.user.username:
+            await self.send(text_data=event['text'], coalesce=event['coalesce'])
 
     # ── Database operations ──────────────────────────────────────────────
 
     @database_sync_to_async
-    def save_message(self, content):
+    def save_message(self, conversation_id, content):
         from chat.models import Conversation, Message
-        conv = Conversation.objects.get(id=self.conversation_id)
+        conv = Conversation.objects.get(id=conversation_id)
         msg = Message.objects.create(
             conversation=conv,
             sender=self.user,
@@ -206,69 +201,179 @@ class ChatConsumer(AsyncWebsocketConsumer):
         conv.save(update_fields=['updated_at'])
         return msg.to_json()
 
-    @database_sync_to_async
-    def mark_as_read(self, message_id):
+    def queue_message(self, conversation_id, content):
+        """
+        Write-behind variant of save_message: build the row in memory, hand
+        it to the batcher and return its JSON without touching the database.
+        The participant check on connect/subscribe stands in for the
+        Conversation lookup.
+        """
         from chat.models import Message
-        Message.objects.filter(
-            id=message_id,
-            conversation_id=self.conversation_id
-        ).exclude(sender=self.user).update(is_read=True)
+        msg = Message(
+            conversation_id=conversation_id,
+            sender=self.user,
+            content=content,
+        )
+        write_behind.submit(msg)
+        return msg.to_json()
 
     @database_sync_to_async
-    def add_reaction(self, message_id, emoji):
-        from chat.models import Message
+    def load_sender_profile(self):
+        """Cache the profile on self.user so to_json() needs no query later."""
         try:
-            msg = Message.objects.get(id=message_id, conversation_id=self.conversation_id)
-            reactions = msg.reactions or {}
-            username = self.user.username
-            if emoji in reactions:
-                if username in reactions[emoji]:
-                    reactions[emoji].remove(username)
-                    if not reactions[emoji]:
-                        del reactions[emoji]
-                else:
-                    reactions[emoji].append(username)
-            else:
-                reactions[emoji] = [username]
-            msg.reactions = reactions
-            msg.save(update_fields=['reactions'])
+            self.user.profile
         except Exception:
             pass
 
+    async def mark_as_read(self, conversation_id, message_id):
+        """
+        Advance the user's read cursor to message_id, clamped to a message
+        that exists in the conversation. The write is debounced and coalesced
+        by read_cursors; returns the id recorded, or None for acks that don't
+        move it forward.
+        """
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return None
+        message_id = await database_sync_to_async(read_position)(conversation_id, message_id)
+        if message_id and read_cursors.advance(self.user.id, conversation_id, message_id):
+            return message_id
+        return None
+
+    @database_sync_to_async
+    def add_reaction(self, conversation_id, message_id, emoji):
+        from chat.reactions import toggle_reaction
+        try:
+            return toggle_reaction(self.user, conversation_id, int(message_id), emoji)
+        except (TypeError, ValueError):
+            return None
+
+    def _own_message_seq(self, conversation_id, message_id):
+        """Seq of one of the user's messages in the conversation, or None."""
+        from chat.models import Message
+        try:
+            return Message.objects.filter(
+                id=int(message_id),
+                sender=self.user,
+                conversation_id=conversation_id
+            ).values_list('seq', flat=True).first()
+        except (TypeError, ValueError):
+            return None
+
     @database_sync_to_async
-    def edit_message(self, message_id, new_content):
+    def edit_message(self, conversation_id, message_id, new_content):
+        """Edit one of the user's messages; returns its seq, or None if not allowed."""
         from chat.models import Message
-        Message.objects.filter(
-            id=message_id,
-            sender=self.user,
-            conversation_id=self.conversation_id
-        ).update(content=new_content, is_edited=True)
+        seq = self._own_message_seq(conversation_id, message_id)
+        if seq is not None:
+            Message.objects.filter(id=message_id).update(content=new_content, is_edited=True)
+            recent_messages.patch(conversation_id, message_id, content=new_content, is_edited=True)
+            inbox.update_message(conversation_id, message_id, new_content)
+        return seq
 
     @database_sync_to_async
-    def delete_message(self, message_id):
+    def delete_message(self, conversation_id, message_id):
+        """Soft-delete one of the user's messages; returns its seq, or None if not allowed."""
         from chat.models import Message
-        Message.objects.filter(
-            id=message_id,
-            sender=self.user,
-            conversation_id=self.conversation_id
-        ).update(is_deleted=True, content='')
+        seq = self._own_message_seq(conversation_id, message_id)
+        if seq is not None:
+            Message.objects.filter(id=message_id).update(is_deleted=True, content='')
+            recent_messages.patch(conversation_id, message_id, is_deleted=True, content='')
+            inbox.update_message(conversation_id, message_id, '', is_deleted=True)
+        return seq
 
     @database_sync_to_async
-    def set_online(self, status):
+    def resync_messages(self, conversation_id, after_seq):
+        """
+        DB fallback for a resume the replay buffer cannot answer (see
+        history.resync). Returns (messages, truncated); a truncated client
+        should reload instead.
+        """
         try:
-            profile = self.user.profile
-            profile.is_online = status
-            if not status:
-                profile.last_seen = timezone.now()
-            profile.save(update_fields=['is_online', 'last_seen'])
-        except Exception:
-            pass
+            after_seq = int(after_seq or 0)
+        except (TypeError, ValueError):
+            after_seq = 0
+        messages, truncated = history.resync(
+            conversation_id, after_seq, getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 200),
+        )
+        return [m.to_json() for m in messages], truncated
 
     @database_sync_to_async
-    def check_participant(self):
-        """Verify the user is a participant in the conversation."""
-        from chat.models import Conversation
-        return Conversation.objects.filter(
-            id=self.conversation_id,
-            participants=self.user
-        ).exists()
+    def check_participant(self, conversation_id):
+        """
+        Verify the user is a participant in the conversation, remembering the
+        participant ids for sidebar notifications.
+        """
+        if not membership.is_member(self.user, conversation_id):
+            return False
+        self.participant_ids[conversation_id] = membership.participant_ids(conversation_id)
+        return True
+
+
+class ChatConsumer(ConversationActionsMixin, OutboundQueueMixin, AsyncWebsocketConsumer):
+    """
+    Handles a WebSocket connection bound to a single conversation
+    (ws/chat/<conversation_id>/). Kept for clients that have not moved to
+    the multiplexed stream in chat.multiplex. A reconnecting client resumes
+    with ?epoch=E&seq=S (the last stamped frame it saw) and &after_seq=M
+    (its last message seq); it then gets the missed frames or a 'resync',
+    and a 'subscribed' frame, as on the multiplexed stream.
+    """
+
+    async def connect(self):
+        self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
+        self.room_group_name = conversation_group(self.conversation_id)
+        self.user = self.scope['user']
+        self.participant_ids = {}
+
+        if self.user.is_anonymous:
+            await self.close()
+            return
+
+        # Verify user is a participant in this conversation
+        is_participant = await self.check_participant(self.conversation_id)
+        if not is_participant:
+            await self.close()
+            return
+
+        # Join room group
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        replay.join(self.conversation_id)
+        self.replay_joined = True
+        await self.accept()
+
+        # Set user online (written only for the user's first socket)
+        await online_users.connected(self.user.id)
+        self.counted_online = True
+
+        if write_behind.enabled:
+            await self.load_sender_profile()
+
+        # Notify group that user is online
+        await self.announce_status(self.conversation_id, True)
+
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        if 'epoch' in params:
+            resume = {'epoch': params['epoch'][0], 'seq': params.get('seq', ['0'])[0]}
+            await self.send_subscribed(self.conversation_id, resume, params.get('after_seq', ['0'])[0])
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'replay_joined', False):
+            replay.leave(self.conversation_id)
+        if getattr(self, 'counted_online', False):
+            await online_users.disconnected(self.user.id)
+        await self.announce_status(self.conversation_id, False)
+        await self.channel_layer.group_discard(
+            self.room_group_name,
+            self.channel_name
+        )
+
+    async def receive(self, text_data):
+        await self.handle_conversation_frame(self.conversation_id, json.loads(text_data))
+
+    def resume_hint(self):
+        return {'conversations': [self.conversation_id]}
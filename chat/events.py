@@ -0,0 +1,51 @@
+"""
+Chat — Group Events
+Builds channel-layer events whose client frame is JSON-encoded once, at
+group_send time, so every recipient forwards the same ready-made string
+instead of re-serializing the event per socket.
+"""
+import json
+import uuid
+
+
+def conversation_group(conversation_id):
+    """Channel-layer group name for a conversation."""
+    return f'chat_{conversation_id}'
+
+
+def group_event(handler, frame, **meta):
+    """
+    Build a group_send event for the consumer method ``handler``.
+
+    ``frame`` is what the client receives; it is encoded here exactly once
+    and carried as ``text``. Keyword arguments become unencoded event fields
+    that handlers can use for per-recipient filtering (e.g. ``username``).
+    A ``coalesce`` key marks the frame as ephemeral for outbound queues: a
+    newer frame with the same key replaces it (see chat.outbound).
+    """
+    return {'type': handler, 'text': json.dumps(frame), **meta}
+
+
+def user_group(user_id):
+    """Channel-layer group reaching every multiplexed socket of one user."""
+    return f'user_{user_id}'
+
+
+def conversation_event(conversation_id, handler, frame, **meta):
+    """
+    group_event for a conversation group. The frame is tagged with its
+    conversation so a multiplexed socket can route it on the client, and the
+    event gets a unique ``eid`` so chat.replay numbers it once per process.
+    """
+    conversation_id = int(conversation_id)
+    return group_event(handler, {**frame, 'conversation_id': conversation_id},
+                       conversation_id=conversation_id, eid=uuid.uuid4().hex, **meta)
+
+
+def sidebar_event(conversation_id, message):
+    """Per-user event announcing a new message for the conversation list."""
+    return group_event('sidebar_update', {
+        'type': 'sidebar',
+        'conversation_id': int(conversation_id),
+        'message': message,
+    })
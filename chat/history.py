@@ -0,0 +1,73 @@
+"""
+Chat — Message History Pages
+Keyset pagination over a conversation's messages by seq. A page is the
+``limit`` messages just before or just after a seq (or the newest ones),
+read through the (conversation, seq) unique index, so its cost does not
+depend on how long the conversation is or how far back the page lies.
+The newest page is served from the recent-messages cache when it can be.
+"""
+from django.conf import settings
+
+from .recent import recent_messages
+
+
+def page_size():
+    return getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+
+
+def page_limit(value, default=None):
+    """A client-supplied page size, clamped to 1..CHAT_HISTORY_MAX_PAGE_SIZE."""
+    default = default or page_size()
+    if value in (None, ''):
+        return default
+    return max(1, min(int(value), getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 100)))
+
+
+def parse_cursor(params, default_limit=None):
+    """(before_seq, after_seq, limit) from query params; raises ValueError on junk."""
+    before_seq = int(params.get('before_seq') or 0) or None
+    after_seq = int(params.get('after_seq') or 0) or None
+    if before_seq and after_seq:
+        raise ValueError('before_seq and after_seq are exclusive')
+    return before_seq, after_seq, page_limit(params.get('limit'), default_limit)
+
+
+def page(conversation_id, before_seq=None, after_seq=None, limit=None):
+    """
+    One page of messages, oldest first, and whether more exist beyond it
+    (older for before_seq and the newest page, newer for after_seq).
+    Cached messages are shared: copy them before changing attributes.
+    """
+    from chat.models import Message
+    limit = limit or page_size()
+
+    if before_seq is None and after_seq is None:
+        newest = recent_messages.latest(conversation_id, limit + 1)
+        if newest is not None:
+            return newest[:limit][::-1], len(newest) > limit
+
+    rows = Message.objects.filter(conversation_id=conversation_id).select_related('sender__profile')
+    if after_seq is not None:
+        rows = list(rows.filter(seq__gt=after_seq).order_by('seq')[:limit + 1])
+        return rows[:limit], len(rows) > limit
+    if before_seq is not None:
+        rows = rows.filter(seq__lt=before_seq)
+    rows = list(rows.order_by('-seq')[:limit + 1])
+    return rows[:limit][::-1], len(rows) > limit
+
+
+def resync(conversation_id, after_seq=None, limit=None):
+    """
+    Messages for a client resuming from a gap no replay buffer covers:
+    those after after_seq (its last message seq seen) if they fit in one
+    page, else the newest page. Returns (messages, truncated); truncated
+    means messages before the first one returned may be missing (the client
+    should reload), which is the case whenever the newest page is not the
+    whole conversation and the client's position is unknown.
+    """
+    if after_seq:
+        messages, more = page(conversation_id, after_seq=after_seq, limit=limit)
+        if not more:
+            return messages, False
+    messages, older = page(conversation_id, limit=limit)
+    return messages, bool(after_seq) or older
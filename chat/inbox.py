@@ -0,0 +1,115 @@
+"""
+Chat — Inbox Rows
+Each ConversationMember row doubles as the user's inbox entry for that
+conversation: last message preview and time, the other participant, and
+the unread count. Message writes update the rows of every member in one
+UPDATE per conversation, so the sidebar renders from a single indexed
+query instead of walking participants and messages per conversation.
+
+All functions run inside the caller's transaction.
+"""
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+PREVIEW_LENGTH = 100
+
+# Per-user conversation settings on ConversationMember
+MEMBER_FLAGS = ('is_pinned', 'is_archived', 'is_muted')
+
+
+def preview(message):
+    if message.content:
+        return message.content[:PREVIEW_LENGTH]
+    return f'[{message.message_type}]'
+
+
+def inbox_rows(user, organization=None, archived=False, pinned=None):
+    """
+    The user's inbox (or archive), pinned conversations first and then by
+    most recent activity, with conversation and peer profile joined.
+    pinned=True limits it to the pinned ones.
+    """
+    from chat.models import ConversationMember
+    rows = ConversationMember.objects.filter(user=user, is_archived=archived)
+    if pinned is not None:
+        rows = rows.filter(is_pinned=pinned)
+    if organization:
+        rows = rows.filter(conversation__organization=organization)
+    return rows.select_related('conversation', 'peer__profile').order_by('-is_pinned', '-last_activity')
+
+
+def toggle_flag(user, conversation_id, flag):
+    """Flip one of the user's MEMBER_FLAGS on a conversation; returns the new value."""
+    from chat.models import ConversationMember
+    if flag not in MEMBER_FLAGS:
+        raise ValueError(f'Unknown member flag: {flag}')
+    rows = ConversationMember.objects.filter(user=user, conversation_id=conversation_id)
+    value = not rows.values_list(flag, flat=True).get()
+    rows.update(**{flag: value})
+    return value
+
+
+def record_messages(messages):
+    """New messages (with ids): move them into every member's row and bump unread counts."""
+    from chat.models import ConversationMember
+    by_conversation = {}
+    for message in messages:
+        by_conversation.setdefault(message.conversation_id, []).append(message)
+
+    for conversation_id, new in by_conversation.items():
+        last = max(new, key=lambda m: (m.seq or 0, m.id))
+        sent_by = {}
+        for message in new:
+            sent_by[message.sender_id] = sent_by.get(message.sender_id, 0) + 1
+        # Everyone's unread grows by the messages they did not send themselves
+        own = Case(
+            *[When(user_id=sender_id, then=Value(count)) for sender_id, count in sent_by.items()],
+            default=Value(0), output_field=IntegerField(),
+        )
+        ConversationMember.objects.filter(conversation_id=conversation_id).update(
+            last_message_id=last.id,
+            last_message_preview=preview(last),
+            last_message_deleted=last.is_deleted,
+            last_activity=last.timestamp,
+            unread_count=F('unread_count') + len(new) - own,
+        )
+
+
+def update_message(conversation_id, message_id, text, is_deleted=False):
+    """An edit or soft delete: refresh the preview where this is the last message."""
+    from chat.models import ConversationMember
+    ConversationMember.objects.filter(
+        conversation_id=conversation_id, last_message_id=message_id,
+    ).update(last_message_preview=text[:PREVIEW_LENGTH], last_message_deleted=is_deleted)
+
+
+def unread_since(message_id):
+    """Subquery counting a member's messages from others after message_id (for .update())."""
+    from chat.models import Message
+    count = Message.objects.filter(
+        conversation_id=OuterRef('conversation_id'), id__gt=message_id,
+    ).exclude(sender_id=OuterRef('user_id')).order_by().values('conversation_id').annotate(
+        n=Count('id')
+    ).values('n')
+    return Coalesce(Subquery(count), 0)
+
+
+def refresh(conversation_ids):
+    """
+    Rebuild the rows of these conversations from scratch: after membership
+    changes or hard deletes, which are rare enough not to need a fast path.
+    """
+    from chat.models import Conversation, ConversationMember, Message
+    for conversation in Conversation.objects.filter(id__in=list(conversation_ids)).prefetch_related('participants'):
+        last = Message.objects.filter(conversation=conversation).order_by('-seq').first()
+        participant_ids = [u.id for u in conversation.participants.all()]
+        for member in ConversationMember.objects.filter(conversation=conversation):
+            peer_id = next((uid for uid in participant_ids if uid != member.user_id), None)
+            ConversationMember.objects.filter(id=member.id).update(
+                peer_id=peer_id,
+                last_message_id=last.id if last else 0,
+                last_message_preview=preview(last) if last else '',
+                last_message_deleted=last.is_deleted if last else False,
+                last_activity=last.timestamp if last else conversation.created_at,
+                unread_count=unread_since(member.last_read_message_id),
+            )
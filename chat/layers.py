@@ -0,0 +1,340 @@
+"""
+Chat — SQLite Channel Layer
+A cross-process channel layer for single-host, multi-worker deployments
+that needs no external service. Messages and group memberships live in a
+shared SQLite file (WAL mode); each event loop runs one poller that drains
+the messages addressed to its own process-specific channels into local
+queues.
+
+Messages are pickled, so the database file must only be writable by the
+workers of this deployment.
+"""
+import asyncio
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS channel_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_messages_channel ON channel_messages (channel, expires);
+CREATE INDEX IF NOT EXISTS channel_messages_owner ON channel_messages (owner, id);
+CREATE TABLE IF NOT EXISTS channel_groups (
+    group_name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (group_name, channel)
+);
+'''
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by a SQLite file shared by every worker on the host.
+
+    Options (CHANNEL_LAYERS['default']['CONFIG']):
+    - path: database file, required
+    - expiry: seconds an undelivered message is kept (default 60)
+    - group_expiry: seconds a group membership lasts without renewal (default 86400)
+    - capacity / channel_capacity: per-channel message limits, as in channels
+    - poll_interval / max_poll_interval: poller backoff bounds in seconds
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, poll_interval=0.005, max_poll_interval=0.05,
+                 cleanup_interval=30, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.cleanup_interval = cleanup_interval
+        # All SQLite work happens on one thread that owns the connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-layer')
+        self._thread_state = threading.local()
+        # Local delivery state per event loop (a WSGI worker runs one per stream)
+        self._loops = {}
+
+    # ── Database (executor thread only) ─────────────────────────────────
+
+    def _db(self):
+        conn = getattr(self._thread_state, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._thread_state.conn = conn
+        return conn
+
+    def _owner(self, channel):
+        """Owner (the creating event loop) of a process-specific channel, or '' for normal ones."""
+        if '!' not in channel:
+            return ''
+        return channel[:channel.index('!')].rsplit('.', 1)[-1]
+
+    def _send_sync(self, channel, body):
+        conn = self._db()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            (queued,) = conn.execute(
+                'SELECT COUNT(*) FROM channel_messages WHERE channel = ? AND expires > ?',
+                (channel, now),
+            ).fetchone()
+            if queued >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            conn.execute(
+                'INSERT INTO channel_messages (channel, owner, expires, body) VALUES (?, ?, ?, ?)',
+                (channel, self._owner(channel), now + self.expiry, body),
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _group_send_sync(self, group, body):
+        conn = self._db()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            members = [row[0] for row in conn.execute(
+                'SELECT channel FROM channel_groups WHERE group_name = ? AND expires > ?',
+                (group, now),
+            )]
+            queued = dict(conn.execute(
+                'SELECT m.channel, COUNT(*) FROM channel_messages m '
+                'JOIN channel_groups g ON g.channel = m.channel AND g.group_name = ? '
+                'WHERE m.expires > ? GROUP BY m.channel',
+                (group, now),
+            ).fetchall())
+            # Full channels are skipped, matching group_send semantics elsewhere
+            conn.executemany(
+                'INSERT INTO channel_messages (channel, owner, expires, body) VALUES (?, ?, ?, ?)',
+                [
+                    (channel, self._owner(channel), now + self.expiry, body)
+                    for channel in members
+                    if queued.get(channel, 0) < self.get_capacity(channel)
+                ],
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _pop_sync(self, channel):
+        """Take the oldest live message for a normal (non-specific) channel."""
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT id, body FROM channel_messages WHERE channel = ? AND expires > ? ORDER BY id LIMIT 1',
+                (channel, time.time()),
+            ).fetchone()
+            if row:
+                conn.execute('DELETE FROM channel_messages WHERE id = ?', (row[0],))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return row[1] if row else None
+
+    def _drain_owned_sync(self, owner):
+        """Take every live message addressed to one event loop's channels."""
+        conn = self._db()
+        # Idle polls stay read-only so they never contend for the write lock
+        if conn.execute('SELECT 1 FROM channel_messages WHERE owner = ? LIMIT 1',
+                        (owner,)).fetchone() is None:
+            return []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, channel, expires, body FROM channel_messages WHERE owner = ? ORDER BY id',
+                (owner,),
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    'DELETE FROM channel_messages WHERE owner = ? AND id <= ?',
+                    (owner, rows[-1][0]),
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        now = time.time()
+        return [(channel, expires, body) for _, channel, expires, body in rows if expires > now]
+
+    def _cleanup_sync(self):
+        conn = self._db()
+        now = time.time()
+        conn.execute('DELETE FROM channel_messages WHERE expires <= ?', (now,))
+        conn.execute('DELETE FROM channel_groups WHERE expires <= ?', (now,))
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ── Local delivery ──────────────────────────────────────────────────
+
+    def _bind_loop(self):
+        """The calling event loop's delivery state, with its poller running."""
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = _LoopState(loop)
+        if state.poller is None or state.poller.done():
+            state.poller = loop.create_task(self._poll(state))
+        return state
+
+    async def _poll(self, state):
+        interval = self.poll_interval
+        next_cleanup = time.time() + self.cleanup_interval
+        try:
+            while True:
+                rows = await self._run(self._drain_owned_sync, state.owner)
+                for channel, expires, body in rows:
+                    queue = state.queues.get(channel)
+                    if queue is None:
+                        continue  # Nobody receives on this channel any more
+                    try:
+                        queue.put_nowait((expires, body))
+                    except asyncio.QueueFull:
+                        pass  # Over capacity: drop, as a full channel would
+                interval = self.poll_interval if rows else min(interval * 2, self.max_poll_interval)
+
+                if time.time() >= next_cleanup:
+                    next_cleanup = time.time() + self.cleanup_interval
+                    await self._run(self._cleanup_sync)
+                    state.forget_idle_channels(time.time() - max(self.expiry, self.cleanup_interval))
+                await asyncio.sleep(interval)
+        finally:
+            # The loop is shutting down (asyncio.run cancels its tasks): drop its state
+            if self._loops.get(state.loop) is state:
+                del self._loops[state.loop]
+
+    # ── Channel layer API ───────────────────────────────────────────────
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        await self._run(self._send_sync, channel, pickle.dumps(message))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        state = self._bind_loop()
+        if self._owner(channel) == state.owner:
+            queue = state.queue(channel, self.get_capacity(channel))
+            # A channel with a receiver waiting on it is never idle
+            state.receivers[channel] = state.receivers.get(channel, 0) + 1
+            try:
+                while True:
+                    expires, body = await queue.get()
+                    if expires > time.time():
+                        return pickle.loads(body)
+            finally:
+                state.receivers[channel] -= 1
+                if not state.receivers[channel]:
+                    del state.receivers[channel]
+                state.last_used[channel] = time.time()
+
+        interval = self.poll_interval
+        while True:
+            body = await self._run(self._pop_sync, channel)
+            if body is not None:
+                return pickle.loads(body)
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    async def new_channel(self, prefix='specific'):
+        state = self._bind_loop()
+        channel = f'{prefix}.{state.owner}!{uuid.uuid4().hex}'
+        # Create the queue now so nothing sent before the first receive() is lost
+        state.queue(channel, self.get_capacity(channel))
+        return channel
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(self._execute_sync,
+                        'INSERT OR REPLACE INTO channel_groups (group_name, channel, expires) VALUES (?, ?, ?)',
+                        (group, channel, time.time() + self.group_expiry))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(self._execute_sync,
+                        'DELETE FROM channel_groups WHERE group_name = ? AND channel = ?',
+                        (group, channel))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        # Pickled once for every member of the group
+        await self._run(self._group_send_sync, group, pickle.dumps(message))
+
+    async def flush(self):
+        await self._run(self._execute_sync, 'DELETE FROM channel_messages', ())
+        await self._run(self._execute_sync, 'DELETE FROM channel_groups', ())
+        for state in list(self._loops.values()):
+            state.queues.clear()
+            state.last_used.clear()
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        for state in list(self._loops.values()):
+            if state.poller is None:
+                continue
+            if state.loop is loop:
+                state.poller.cancel()
+            elif not state.loop.is_closed():
+                state.loop.call_soon_threadsafe(state.poller.cancel)
+
+    def _execute_sync(self, sql, params):
+        self._db().execute(sql, params)
+
+
+class _LoopState:
+    """
+    Local queues and the poller of one event loop. Each loop drains only
+    the channels it created (its own owner prefix), so several loops in one
+    process, such as concurrent streams in a WSGI worker, never take each
+    other's messages.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.owner = uuid.uuid4().hex
+        self.poller = None
+        self.queues = {}
+        self.last_used = {}
+        self.receivers = {}
+
+    def queue(self, channel, capacity):
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue(maxsize=capacity)
+        self.last_used[channel] = time.time()
+        return queue
+
+    def forget_idle_channels(self, cutoff):
+        """Drop queues nobody has touched since cutoff and nobody waits on."""
+        for channel, last_used in list(self.last_used.items()):
+            queue = self.queues.get(channel)
+            if channel in self.receivers or last_used >= cutoff:
+                continue
+            if queue is None or queue.empty():
+                self.queues.pop(channel, None)
+                self.last_used.pop(channel, None)
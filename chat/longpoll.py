@@ -0,0 +1,64 @@
+"""
+Chat — Long Polling
+Parks an HTTP poll until something changes in its conversation. The
+waiting request subscribes a fresh channel to the conversation's channel
+layer group, the same group the WebSocket consumers listen on, so it wakes
+on the events they forward. The conversation's last_seq, read from the
+database and moved by every committed message insert in any process,
+tells whether an event changed anything the poll can return; events that
+did not (typing, a message still waiting for the write-behind flush) put
+the request back to sleep.
+
+Events only reach a waiter on the event loop the consumers run on (ASGI).
+Under WSGI, or when a write happens behind a per-process channel layer,
+last_seq is also rechecked every CHAT_LONG_POLL_RECHECK seconds.
+"""
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .events import conversation_group
+
+
+def max_wait():
+    return getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 25)
+
+
+def recheck_interval():
+    return getattr(settings, 'CHAT_LONG_POLL_RECHECK', 3)
+
+
+def last_seq(conversation_id):
+    """The conversation's highest persisted message seq (0 if it has none)."""
+    from chat.models import Conversation
+    return Conversation.objects.filter(id=conversation_id).values_list('last_seq', flat=True).first() or 0
+
+
+def poll_etag(conversation_id, seq, after_id):
+    """ETag of a poll: database state only, so every worker agrees on it."""
+    return f'"msgs-{conversation_id}-{seq}-{after_id}"'
+
+
+async def wait_for_change(conversation_id, seq, timeout):
+    """Wait up to ``timeout`` seconds for last_seq to move past ``seq``; returns the current one."""
+    layer = get_channel_layer()
+    group = conversation_group(conversation_id)
+    channel = await layer.new_channel('longpoll')
+    await layer.group_add(group, channel)
+    deadline = time.monotonic() + timeout
+    try:
+        # Subscribed before the first check, so a change in between still wakes us
+        while True:
+            current = await sync_to_async(last_seq)(conversation_id)
+            remaining = deadline - time.monotonic()
+            if current != seq or remaining <= 0:
+                return current
+            try:
+                await asyncio.wait_for(layer.receive(channel), min(remaining, recheck_interval()))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await layer.group_discard(group, channel)
@@ -0,0 +1,85 @@
+"""
+Chat — Fan-out Benchmark
+Measures the per-recipient cost of delivering one group event through the
+in-memory channel layer, encoding the frame per recipient (the old handlers)
+versus once at group_send time (chat.events.group_event).
+"""
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.events import group_event
+
+SAMPLE_MESSAGE = {
+    'id': 123456,
+    'uid': '6f1c1d1e-5a0b-4c83-9a55-0d1f5e0b7a11',
+    'sender': 'alice',
+    'sender_id': 42,
+    'sender_avatar': '/static/img/default-avatar.svg',
+    'content': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 3,
+    'message_type': 'text',
+    'media_url': None,
+    'timestamp': '2026-01-01T12:00:00+00:00',
+    'is_delivered': False,
+    'is_read': False,
+    'is_edited': False,
+    'is_deleted': False,
+    'reply_to': None,
+    'reactions': {'👍': 2, '🔥': 1},
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per-recipient cost of chat group fan-out before and after serialize-once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--rounds', type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{"recipients":>10}  {"handler before":>14}  {"handler after":>13}'
+            f'  {"total before":>12}  {"total after":>11}   (µs per recipient)'
+        )
+        for n in options['recipients']:
+            handler_before, total_before = asyncio.run(self.run(n, options['rounds'], encode_once=False))
+            handler_after, total_after = asyncio.run(self.run(n, options['rounds'], encode_once=True))
+            self.stdout.write(
+                f'{n:>10}  {handler_before:>14.2f}  {handler_after:>13.2f}'
+                f'  {total_before:>12.2f}  {total_after:>11.2f}'
+            )
+
+    async def run(self, recipients, rounds, encode_once):
+        """
+        Return (handler, total) mean time per delivered frame in microseconds.
+        ``handler`` covers only the consumer-side work of turning the received
+        event into wire text; ``total`` also includes group_send and receive.
+        """
+        layer = InMemoryChannelLayer(capacity=rounds + 1)
+        channels = [await layer.new_channel() for _ in range(recipients)]
+        for name in channels:
+            await layer.group_add('bench', name)
+
+        handler_time = 0.0
+        started = time.perf_counter()
+        for _ in range(rounds):
+            if encode_once:
+                event = group_event('chat_message', {'type': 'message', 'message': SAMPLE_MESSAGE})
+            else:
+                event = {'type': 'chat_message', 'message': SAMPLE_MESSAGE}
+            await layer.group_send('bench', event)
+            for name in channels:
+                received = await layer.receive(name)
+                t0 = time.perf_counter()
+                if encode_once:
+                    text = received['text']
+                else:
+                    text = json.dumps({'type': 'message', 'message': received['message']})
+                handler_time += time.perf_counter() - t0
+                assert text
+        total_time = time.perf_counter() - started
+        deliveries = rounds * recipients
+        return handler_time / deliveries * 1e6, total_time / deliveries * 1e6
@@ -0,0 +1,75 @@
+"""
+Chat — Presence Benchmark
+Bytes sent and CPU spent for one user connecting while N users are online:
+the old full-list broadcast (every client re-sent the whole list, encoded
+per recipient) versus one snapshot for the newcomer plus a join delta
+encoded once and forwarded to everyone.
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.events import group_event
+from chat.outbound import OutboundQueue
+
+
+def fake_users(n):
+    return [
+        {
+            'user_id': i,
+            'username': f'User Number {i}',
+            'avatar': f'/media/avatars/user_{i}.png',
+            'ip': f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}',
+        }
+        for i in range(n)
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark presence fan-out bytes and CPU per connect, full list vs snapshot + delta.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+', default=[100, 1000, 10000])
+        parser.add_argument('--sample', type=int, default=200,
+                            help='Recipients timed for the full-list case (scaled to all users)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{"users":>7}  {"full-list bytes":>16}  {"delta bytes":>12}'
+            f'  {"full-list CPU ms":>16}  {"delta CPU ms":>12}   (per connect)'
+        )
+        for n in options['users']:
+            old_bytes, old_ms = self.full_list(n, min(n, options['sample']))
+            new_bytes, new_ms = self.delta(n)
+            self.stdout.write(f'{n:>7}  {old_bytes:>16,}  {new_bytes:>12,}  {old_ms:>16.2f}  {new_ms:>12.2f}')
+
+    def full_list(self, n, sample):
+        """Every recipient gets the whole list minus itself, encoded per recipient."""
+        users = fake_users(n)
+        sent = 0
+        started = time.process_time()
+        for recipient in users[:sample]:
+            filtered = [u for u in users if u['user_id'] != recipient['user_id']]
+            sent += len(json.dumps({'type': 'presence_update', 'users': filtered}))
+        elapsed = time.process_time() - started
+        scale = n / sample
+        return int(sent * scale), elapsed * scale * 1000
+
+    def delta(self, n):
+        """The newcomer gets one snapshot; everyone gets one pre-encoded join delta."""
+        users = fake_users(n)
+        queues = [OutboundQueue(max_messages=10, max_bytes=10 * 1024 * 1024) for _ in range(n)]
+        started = time.process_time()
+        snapshot = json.dumps({'type': 'presence_snapshot', 'version': 1, 'users': users[:-1]})
+        event = group_event('presence_delta', {
+            'type': 'presence_delta',
+            'version': 2,
+            'joined': [users[-1]],
+            'left': [],
+        }, coalesce='presence:2')
+        queues[-1].put(snapshot, 'presence_snapshot')
+        for queue in queues:
+            queue.put(event['text'], event['coalesce'])
+        elapsed = time.process_time() - started
+        return len(snapshot) + n * len(event['text']), elapsed * 1000
@@ -0,0 +1,159 @@
+"""
+Chat — Channel Layer Check
+Runs several worker processes against one SQLiteChannelLayer file and
+checks group fan-out (every channel gets every message, in order), group
+discard, capacity and expiry, then reports delivery throughput.
+Exits non-zero if any check fails.
+"""
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from channels.exceptions import ChannelFull
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import SQLiteChannelLayer
+
+GROUP = 'layer-check'
+
+
+def run_worker(path, capacity, channels, messages, timeout, ready, results):
+    results.put(asyncio.run(_worker(path, capacity, channels, messages, timeout, ready)))
+
+
+async def _worker(path, capacity, channels, messages, timeout, ready):
+    layer = SQLiteChannelLayer(path, capacity=capacity)
+    names = [await layer.new_channel() for _ in range(channels + 1)]
+    for name in names:
+        await layer.group_add(GROUP, name)
+    # The last channel leaves again and must not receive anything
+    discarded = names.pop()
+    await layer.group_discard(GROUP, discarded)
+    ready.put(os.getpid())
+
+    async def collect(name):
+        seqs = []
+        try:
+            while len(seqs) < messages:
+                seqs.append((await asyncio.wait_for(layer.receive(name), timeout))['seq'])
+        except asyncio.TimeoutError:
+            pass
+        return seqs
+
+    received = await asyncio.gather(*(collect(name) for name in names))
+    errors = [
+        f'{name}: got {len(seqs)}/{messages} messages{"" if seqs == sorted(seqs) else " out of order"}'
+        for name, seqs in zip(names, received)
+        if seqs != list(range(messages))
+    ]
+    try:
+        await asyncio.wait_for(layer.receive(discarded), 0.2)
+        errors.append(f'{discarded}: received a message after group_discard')
+    except asyncio.TimeoutError:
+        pass
+    await layer.close()
+    return os.getpid(), time.time(), sum(map(len, received)), errors
+
+
+class Command(BaseCommand):
+    help = 'Check SQLiteChannelLayer fan-out, capacity and expiry across several worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--channels', type=int, default=25, help='Channels per worker')
+        parser.add_argument('--messages', type=int, default=100, help='Group messages to send')
+        parser.add_argument('--timeout', type=float, default=10.0)
+        parser.add_argument('--path', help='Database file (default: a temporary file)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.sqlite3', prefix='channel-layer-')
+            os.close(fd)
+        try:
+            failures = self.check_fanout(path, options)
+            failures += asyncio.run(self.check_limits(path))
+        finally:
+            if not options['path']:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+
+        if failures:
+            for failure in failures:
+                self.stderr.write(f'  FAIL {failure}')
+            raise CommandError(f'{len(failures)} channel layer check(s) failed')
+        self.stdout.write(self.style.SUCCESS('All channel layer checks passed'))
+
+    def check_fanout(self, path, options):
+        workers, messages = options['workers'], options['messages']
+        per_worker = options['channels']
+        capacity = messages + 1
+        ctx = multiprocessing.get_context('spawn')
+        ready, results = ctx.Queue(), ctx.Queue()
+        procs = [
+            ctx.Process(target=run_worker, args=(
+                path, capacity, per_worker, messages, options['timeout'], ready, results,
+            ))
+            for _ in range(workers)
+        ]
+        for proc in procs:
+            proc.start()
+        for _ in procs:
+            ready.get(timeout=60)
+
+        started = time.time()
+        asyncio.run(self.send_group(path, capacity, messages))
+        sent = time.time()
+        reports = [results.get(timeout=options['timeout'] + 60) for _ in procs]
+        for proc in procs:
+            proc.join()
+
+        delivered = sum(report[2] for report in reports)
+        finished = max(report[1] for report in reports)
+        expected = workers * per_worker * messages
+        self.stdout.write(
+            f'fan-out: {workers} workers x {per_worker} channels x {messages} messages, '
+            f'{delivered}/{expected} delivered'
+        )
+        self.stdout.write(
+            f'  group_send {messages / max(sent - started, 1e-9):,.0f} msg/s, '
+            f'delivery {delivered / max(finished - started, 1e-9):,.0f} msg/s'
+        )
+        return [error for report in reports for error in report[3]]
+
+    async def send_group(self, path, capacity, messages):
+        layer = SQLiteChannelLayer(path, capacity=capacity)
+        for seq in range(messages):
+            await layer.group_send(GROUP, {'type': 'check', 'seq': seq})
+        await layer.close()
+
+    async def check_limits(self, path):
+        failures = []
+        layer = SQLiteChannelLayer(path, capacity=5, expiry=1)
+        await layer.flush()
+
+        for seq in range(5):
+            await layer.send('check.capacity', {'type': 'check', 'seq': seq})
+        try:
+            await layer.send('check.capacity', {'type': 'check', 'seq': 5})
+            failures.append('capacity: sixth send to a 5-message channel did not raise ChannelFull')
+        except ChannelFull:
+            pass
+        first = await layer.receive('check.capacity')
+        if first['seq'] != 0:
+            failures.append(f'capacity: expected seq 0 first, got {first["seq"]}')
+
+        await layer.send('check.expiry', {'type': 'check'})
+        await asyncio.sleep(1.1)
+        try:
+            await asyncio.wait_for(layer.receive('check.expiry'), 0.3)
+            failures.append('expiry: received a message after it expired')
+        except asyncio.TimeoutError:
+            pass
+
+        self.stdout.write(f'limits: capacity and expiry {"ok" if not failures else "FAILED"}')
+        await layer.close()
+        return failures
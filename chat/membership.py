@@ -0,0 +1,122 @@
+"""
+Chat — Membership Cache
+Bounded LRU caches of user → conversation ids and conversation → participant
+ids, used by every authorization check in the chat app.
+
+Entries are versioned: invalidation bumps a per-key counter in
+chat.versions, which every worker shares, and drops the local entry; other
+processes see the new version once their last check of it is older than
+CHAT_CACHE_VERSION_TTL_MS, and reload. Within that window a warm lookup
+costs no query at all. A load that races with an invalidation is stored
+under the old version, so it is reloaded at the next check.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from .versions import fresh, versions as shared_versions
+
+
+class VersionedLRUCache:
+    """Thread-safe LRU of frozensets, keyed by id and validated by version."""
+
+    def __init__(self, name, loader, max_entries, versions=None):
+        self.name = name
+        self.loader = loader
+        self.max_entries = max_entries
+        self.versions = versions or shared_versions
+        self._entries = OrderedDict()  # {key: (version, value, monotonic time of the last version check)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _version_key(self, key):
+        return f'chat:{self.name}:v:{key}'
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and fresh(entry[2]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        version = self.versions.get(self._version_key(key))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries[key] = (version, entry[1], time.monotonic())
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = frozenset(self.loader(key))
+        with self._lock:
+            self._entries[key] = (version, value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        self.versions.bump(self._version_key(key))
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _load_user_conversations(user_id):
+    from chat.models import Conversation
+    return Conversation.objects.filter(participants=user_id).values_list('id', flat=True)
+
+
+def _load_conversation_participants(conversation_id):
+    from chat.models import Conversation
+    return Conversation.participants.through.objects.filter(
+        conversation_id=conversation_id
+    ).values_list('user_id', flat=True)
+
+
+_size = getattr(settings, 'CHAT_MEMBERSHIP_CACHE_SIZE', 10000)
+user_conversations = VersionedLRUCache('user_conversations', _load_user_conversations, _size)
+conversation_participants = VersionedLRUCache('conversation_participants', _load_conversation_participants, _size)
+
+
+def conversation_ids(user):
+    """Ids of every conversation the user participates in."""
+    return user_conversations.get(user.id)
+
+
+def participant_ids(conversation_id):
+    """Ids of every participant in the conversation."""
+    return conversation_participants.get(int(conversation_id))
+
+
+def is_member(user, conversation_id):
+    """Authorization check: is the user a participant in the conversation?"""
+    if user.is_anonymous:
+        return False
+    try:
+        return int(conversation_id) in conversation_ids(user)
+    except (TypeError, ValueError):
+        return False
+
+
+def invalidate(user_ids=(), conversation_ids=()):
+    """Drop cached memberships once the surrounding transaction commits."""
+    user_ids, conversation_ids = list(user_ids), list(conversation_ids)
+
+    def bump():
+        for user_id in user_ids:
+            user_conversations.invalidate(user_id)
+        for conversation_id in conversation_ids:
+            conversation_participants.invalidate(conversation_id)
+
+    transaction.on_commit(bump)
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-16 09:12
+
+import uuid
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def populate_uids(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    for pk in Message.objects.values_list('pk', flat=True).iterator():
+        Message.objects.filter(pk=pk).update(uid=uuid.uuid4())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_conversation_organization'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='uid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_uids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
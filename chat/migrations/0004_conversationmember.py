@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_members(apps, schema_editor):
+    """Create a member row per participant, seeding the cursor from legacy is_read flags."""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMember = apps.get_model('chat', 'ConversationMember')
+    Message = apps.get_model('chat', 'Message')
+    members = []
+    for conv in Conversation.objects.prefetch_related('participants'):
+        for user in conv.participants.all():
+            last_read = Message.objects.filter(
+                conversation=conv, is_read=True
+            ).exclude(sender=user).aggregate(m=Max('id'))['m'] or 0
+            members.append(ConversationMember(
+                conversation=conv, user=user, last_read_message_id=last_read,
+            ))
+    ConversationMember.objects.bulk_create(members, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_uid'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='chat.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_members, migrations.RunPython.noop),
+    ]
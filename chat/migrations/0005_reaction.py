@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:29
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def split_reactions(apps, schema_editor):
+    """Turn {emoji: [usernames]} blobs into Reaction rows plus {emoji: count}."""
+    Message = apps.get_model('chat', 'Message')
+    Reaction = apps.get_model('chat', 'Reaction')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    user_ids = {}
+    for msg in Message.objects.exclude(reactions={}).iterator():
+        rows = []
+        for emoji, usernames in (msg.reactions or {}).items():
+            if not isinstance(usernames, list):
+                continue
+            for username in usernames:
+                if username not in user_ids:
+                    user_ids[username] = User.objects.filter(username=username).values_list('id', flat=True).first()
+                if user_ids[username]:
+                    rows.append(Reaction(message=msg, user_id=user_ids[username], emoji=emoji[:32]))
+        Reaction.objects.bulk_create(rows, ignore_conflicts=True)
+        counts = {}
+        for row in rows:
+            counts[row.emoji] = counts.get(row.emoji, 0) + 1
+        Message.objects.filter(pk=msg.pk).update(reactions=counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_conversationmember'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_set', to='chat.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reactions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('message', 'user', 'emoji')},
+            },
+        ),
+        migrations.RunPython(split_reactions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    """Give existing messages seq 1..n per conversation in timestamp order."""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    for conv_id in Conversation.objects.values_list('id', flat=True).iterator():
+        ids = Message.objects.filter(conversation_id=conv_id).order_by('timestamp', 'id').values_list('id', flat=True)
+        seq = 0
+        for seq, pk in enumerate(ids, start=1):
+            Message.objects.filter(pk=pk).update(seq=seq)
+        Conversation.objects.filter(pk=conv_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_reaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='message',
+            unique_together={('conversation', 'seq')},
+        ),
+    ]
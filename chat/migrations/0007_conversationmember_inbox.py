@@ -0,0 +1,79 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_inbox_rows(apps, schema_editor):
+    """Compute peer, last message and unread count for existing members."""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMember = apps.get_model('chat', 'ConversationMember')
+    Message = apps.get_model('chat', 'Message')
+    for conversation in Conversation.objects.prefetch_related('participants').iterator(chunk_size=500):
+        last = Message.objects.filter(conversation=conversation).order_by('-seq').first()
+        participant_ids = [u.id for u in conversation.participants.all()]
+        for member in ConversationMember.objects.filter(conversation=conversation):
+            if last is None:
+                preview = ''
+            elif last.content:
+                preview = last.content[:100]
+            else:
+                preview = f'[{last.message_type}]'
+            ConversationMember.objects.filter(pk=member.pk).update(
+                peer_id=next((uid for uid in participant_ids if uid != member.user_id), None),
+                last_message_id=last.id if last else 0,
+                last_message_preview=preview,
+                last_message_deleted=last.is_deleted if last else False,
+                last_activity=last.timestamp if last else conversation.created_at,
+                unread_count=Message.objects.filter(
+                    conversation=conversation, id__gt=member.last_read_message_id,
+                ).exclude(sender_id=member.user_id).count(),
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmember',
+            name='peer',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_message_deleted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversationmember',
+            index=models.Index(fields=['user', '-last_activity'], name='chat_member_inbox_idx'),
+        ),
+        migrations.RunPython(fill_inbox_rows, migrations.RunPython.noop),
+    ]
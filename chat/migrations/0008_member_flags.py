@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:55
+
+from django.db import migrations, models
+
+
+def copy_conversation_flags(apps, schema_editor):
+    """Pinned and archived were shared by all participants; start every member from them."""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMember = apps.get_model('chat', 'ConversationMember')
+    for field in ('is_pinned', 'is_archived'):
+        ConversationMember.objects.filter(
+            conversation__in=Conversation.objects.filter(**{field: True}),
+        ).update(**{field: True})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_conversationmember_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmember',
+            name='is_pinned',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='is_archived',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='is_muted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(copy_conversation_flags, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='conversationmember',
+            name='chat_member_inbox_idx',
+        ),
+        migrations.AddIndex(
+            model_name='conversationmember',
+            index=models.Index(fields=['user', 'is_archived', '-is_pinned', '-last_activity'], name='chat_member_inbox_idx'),
+        ),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='is_pinned',
+        ),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='is_archived',
+        ),
+    ]
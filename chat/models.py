@@ -1,9 +1,18 @@
 """
 Chat — Models
 Conversation and Message models for the chat system.
+Signal receivers keep the membership cache in step with participants and
+the inbox rows (see chat.inbox) in step with messages.
 """
-from django.db import models
+import uuid
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from . import inbox, membership
+from .recent import recent_messages
 
 
 class Conversation(models.Model):
@@ -14,8 +23,8 @@ class Conversation(models.Model):
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    is_pinned = models.BooleanField(default=False)
-    is_archived = models.BooleanField(default=False)
+    # Highest Message.seq handed out in this conversation
+    last_seq = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ['-updated_at']
@@ -26,10 +35,69 @@ class Conversation(models.Model):
 
     @property
     def last_message(self):
-        return self.messages.order_by('-timestamp').first()
+        """The newest message, one row by seq; lists read the inbox row's preview instead."""
+        return self.messages.select_related('sender__profile').order_by('-seq').first()
 
     def unread_count(self, user):
-        return self.messages.filter(is_read=False).exclude(sender=user).count()
+        return self.members.filter(user=user).values_list('unread_count', flat=True).first() or 0
+
+    @staticmethod
+    def allocate_seq(conversation_id, count=1):
+        """
+        Reserve ``count`` consecutive message seq numbers and return the first.
+        Must run inside the transaction that inserts the messages: the UPDATE
+        locks the conversation row until commit, and a rollback gives the
+        numbers back, so seqs stay dense.
+        """
+        Conversation.objects.filter(id=conversation_id).update(last_seq=F('last_seq') + count)
+        last_seq = Conversation.objects.filter(id=conversation_id).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
+
+class ConversationMember(models.Model):
+    """
+    Per-participant conversation state, one row per (conversation, user).
+    The read cursor is the highest message id the user has seen; it only
+    moves forward and replaces per-message is_read updates.
+    The rest is the user's inbox entry, kept current by chat.inbox, and
+    the user's own pin/archive/mute settings for the conversation.
+    """
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name='members'
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='conversation_memberships'
+    )
+    last_read_message_id = models.BigIntegerField(default=0)
+    # The other participant, shown on the inbox row
+    peer = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=inbox.PREVIEW_LENGTH, blank=True, default='')
+    last_message_deleted = models.BooleanField(default=False)
+    # Time of the last message, or of creation; the inbox sort key
+    last_activity = models.DateTimeField(default=timezone.now)
+    # Messages from others after last_read_message_id
+    unread_count = models.PositiveIntegerField(default=0)
+    is_pinned = models.BooleanField(default=False)
+    is_archived = models.BooleanField(default=False)
+    # No notifications for new messages
+    is_muted = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('conversation', 'user')
+        indexes = [
+            # Inbox and archive (pinned first, then by activity) and the
+            # pinned list are each one range scan of this index
+            models.Index(
+                fields=['user', 'is_archived', '-is_pinned', '-last_activity'],
+                name='chat_member_inbox_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} in {self.conversation_id}'
 
 
 class Message(models.Model):
@@ -51,26 +119,51 @@ class Message(models.Model):
     content = models.TextField(blank=True, default='')
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
     media = models.FileField(upload_to='chat_media/%Y/%m/', blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Assigned up front (not auto_now_add) so write-behind messages keep the
+    # uid and timestamp they were broadcast with when they are persisted later.
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Dense 1, 2, 3... per conversation, assigned when the row is inserted
+    seq = models.BigIntegerField(editable=False)
     is_delivered = models.BooleanField(default=False)
+    # Legacy flag; read state lives in ConversationMember.last_read_message_id
     is_read = models.BooleanField(default=False)
     is_edited = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
     reply_to = models.ForeignKey(
         'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies'
     )
+    # Cached {emoji: count} summary of the Reaction rows, rewritten on each toggle
     reactions = models.JSONField(default=dict, blank=True)
 
     class Meta:
         ordering = ['timestamp']
+        unique_together = ('conversation', 'seq')
 
     def __str__(self):
         preview = self.content[:50] if self.content else f'[{self.message_type}]'
         return f'{self.sender.username}: {preview}'
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None:
+            with transaction.atomic():
+                self.seq = Conversation.allocate_seq(self.conversation_id)
+                super().save(*args, **kwargs)
+            return
+        super().save(*args, **kwargs)
+
+    def reaction_summary(self, mine=()):
+        """Compact per-emoji summary; ``mine`` is the viewer's emojis on this message."""
+        return [
+            {'emoji': emoji, 'count': count, 'me': emoji in mine}
+            for emoji, count in (self.reactions or {}).items()
+        ]
+
     def to_json(self):
         return {
             'id': self.id,
+            'uid': str(self.uid),
+            'seq': self.seq,
             'sender': self.sender.username,
             'sender_id': self.sender.id,
             'sender_avatar': self.sender.profile.avatar_url,
@@ -85,3 +178,100 @@ class Message(models.Model):
             'reply_to': self.reply_to_id,
             'reactions': self.reactions,
         }
+
+
+class Reaction(models.Model):
+    """One user's emoji on one message; toggling adds or deletes the row."""
+    message = models.ForeignKey(
+        Message, on_delete=models.CASCADE, related_name='reaction_set'
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='reactions'
+    )
+    emoji = models.CharField(max_length=32)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('message', 'user', 'emoji')
+
+    def __str__(self):
+        return f'{self.user.username} {self.emoji} on {self.message_id}'
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def invalidate_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is None for clear(); remember who is about to be removed
+        if reverse:
+            instance._membership_cleared = list(instance.conversations.values_list('id', flat=True))
+        else:
+            instance._membership_cleared = list(instance.participants.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    changed = pk_set if action != 'post_clear' else getattr(instance, '_membership_cleared', [])
+    if reverse:
+        membership.invalidate(user_ids=[instance.pk], conversation_ids=changed)
+    else:
+        membership.invalidate(user_ids=changed, conversation_ids=[instance.pk])
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def sync_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep one ConversationMember row per participant."""
+    if action == 'post_add':
+        if reverse:
+            pairs = [(conv_id, instance.pk) for conv_id in pk_set]
+        else:
+            pairs = [(instance.pk, user_id) for user_id in pk_set]
+        ConversationMember.objects.bulk_create(
+            [ConversationMember(conversation_id=c, user_id=u) for c, u in pairs],
+            ignore_conflicts=True,
+        )
+        inbox.refresh({c for c, _ in pairs})
+    elif action == 'post_remove':
+        if reverse:
+            ConversationMember.objects.filter(user=instance, conversation_id__in=pk_set).delete()
+            inbox.refresh(pk_set)
+        else:
+            ConversationMember.objects.filter(conversation=instance, user_id__in=pk_set).delete()
+            inbox.refresh([instance.pk])
+    elif action == 'post_clear':
+        if reverse:
+            ConversationMember.objects.filter(user=instance).delete()
+            inbox.refresh(getattr(instance, '_membership_cleared', []))
+        else:
+            ConversationMember.objects.filter(conversation=instance).delete()
+
+
+@receiver(pre_delete, sender=Conversation)
+def remember_participants(sender, instance, **kwargs):
+    instance._membership_cleared = list(instance.participants.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Conversation)
+def invalidate_deleted_conversation(sender, instance, **kwargs):
+    membership.invalidate(
+        user_ids=getattr(instance, '_membership_cleared', []),
+        conversation_ids=[instance.pk],
+    )
+
+
+@receiver(post_save, sender=Message)
+def update_recent_messages(sender, instance, created, **kwargs):
+    if created:
+        recent_messages.append([instance])
+        inbox.record_messages([instance])
+    else:
+        recent_messages.invalidate(instance.conversation_id)
+        inbox.update_message(
+            instance.conversation_id, instance.id,
+            '' if instance.is_deleted else inbox.preview(instance), instance.is_deleted,
+        )
+
+
+@receiver(post_delete, sender=Message)
+def drop_recent_messages(sender, instance, **kwargs):
+    recent_messages.invalidate(instance.conversation_id)
+    inbox.refresh([instance.conversation_id])
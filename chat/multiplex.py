@@ -0,0 +1,115 @@
+"""
+Chat — Multiplexed WebSocket
+One socket per user carrying every conversation stream, presence and
+sidebar updates. Clients subscribe and unsubscribe to conversations with
+in-band frames instead of opening ws/chat/<id>/ per conversation.
+"""
+import json
+from . import replay
+from .consumers import ConversationActionsMixin
+from .events import conversation_group, user_group
+from .online import online_users
+from .presence import PresenceConsumer
+from .writebehind import write_behind
+
+
+class MultiplexConsumer(ConversationActionsMixin, PresenceConsumer):
+    """
+    Handles ws/stream/. Client frames:
+    - {"type": "subscribe", "conversation_id": N}, optionally with
+      "resume": {"epoch": E, "seq": S} and "after_seq": M (last message seq
+      seen) after a reconnect
+    - {"type": "unsubscribe", "conversation_id": N}
+    - {"type": "heartbeat"}
+    - {"type": "presence_sync"} / {"type": "nearby_sync"} to request a fresh
+      presence / nearby snapshot
+    - any ChatConsumer frame plus "conversation_id" for a subscribed conversation
+    Conversation frames sent to the client carry "conversation_id" too, and
+    all but typing/status frames carry the replay "seq" and "epoch".
+    """
+
+    async def connect(self):
+        self.subscriptions = set()
+        self.participant_ids = {}
+
+        # Authenticates, registers presence and accepts the socket
+        await super().connect()
+        if self.user.is_anonymous:
+            return
+
+        self.user_group_name = user_group(self.user.id)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+
+        await online_users.connected(self.user.id)
+        self.counted_online = True
+        if write_behind.enabled:
+            await self.load_sender_profile()
+
+    async def disconnect(self, close_code):
+        if self.user.is_anonymous:
+            return
+        for conversation_id in list(self.subscriptions):
+            await self.unsubscribe(conversation_id)
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        await super().disconnect(close_code)
+        # After the presence socket is gone, so it does not count as another live one
+        if getattr(self, 'counted_online', False):
+            await online_users.disconnected(self.user.id)
+
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            return
+        msg_type = data.get('type')
+
+        if msg_type == 'heartbeat':
+            await self.touch_presence()
+            await self.send(text_data=json.dumps({'type': 'heartbeat_ack'}))
+            return
+        if msg_type in ('presence_sync', 'nearby_sync'):
+            await self.send_snapshot(msg_type.split('_')[0])
+            return
+
+        try:
+            conversation_id = int(data.get('conversation_id'))
+        except (TypeError, ValueError):
+            return
+
+        if msg_type == 'subscribe':
+            await self.subscribe(conversation_id, data.get('resume'), data.get('after_seq'))
+        elif msg_type == 'unsubscribe':
+            await self.unsubscribe(conversation_id)
+            await self.send(text_data=json.dumps({
+                'type': 'unsubscribed',
+                'conversation_id': conversation_id,
+            }))
+        elif conversation_id in self.subscriptions:
+            await self.handle_conversation_frame(conversation_id, data)
+
+    def resume_hint(self):
+        return {'conversations': sorted(self.subscriptions)}
+
+    async def subscribe(self, conversation_id, resume=None, after_seq=None):
+        if conversation_id not in self.subscriptions:
+            if not await self.check_participant(conversation_id):
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'conversation_id': conversation_id,
+                    'error': 'not_a_participant',
+                }))
+                return
+            await self.channel_layer.group_add(conversation_group(conversation_id), self.channel_name)
+            self.subscriptions.add(conversation_id)
+            replay.join(conversation_id)
+            await self.announce_status(conversation_id, True)
+
+        await self.send_subscribed(conversation_id, resume, after_seq)
+
+    async def unsubscribe(self, conversation_id):
+        if conversation_id not in self.subscriptions:
+            return
+        self.subscriptions.discard(conversation_id)
+        replay.leave(conversation_id)
+        await self.announce_status(conversation_id, False)
+        await self.channel_layer.group_discard(conversation_group(conversation_id), self.channel_name)
@@ -0,0 +1,102 @@
+"""
+Chat — Online Status
+Counts each user's open sockets in this process and writes
+UserProfile.is_online / last_seen only when the count leaves or reaches
+zero. Going offline waits CHAT_ONLINE_GRACE_SECONDS, so a page reload (or
+switching conversations) reconnects before anything is written; before
+writing offline it also asks presence_store whether the user still has a
+presence socket on another worker that beat within
+CHAT_ONLINE_FRESH_SECONDS. If so the check is repeated once that heartbeat
+would go stale, so a socket left behind by a crashed worker cannot keep the
+user online, whether or not a presence sweeper is running.
+"""
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .presence_store import presence_store
+
+logger = logging.getLogger(__name__)
+
+
+@database_sync_to_async
+def write_status(user_id, is_online):
+    from accounts.models import UserProfile
+    UserProfile.objects.filter(user_id=user_id).update(is_online=is_online, last_seen=timezone.now())
+
+
+class OnlineTracker:
+
+    def __init__(self, grace_seconds=None, fresh_seconds=None):
+        self.grace_seconds = grace_seconds if grace_seconds is not None else getattr(
+            settings, 'CHAT_ONLINE_GRACE_SECONDS', 5)
+        self.fresh_seconds = fresh_seconds if fresh_seconds is not None else getattr(
+            settings, 'CHAT_ONLINE_FRESH_SECONDS', 40)
+        self.connections = {}    # {user_id: open sockets in this process}
+        self._going_offline = {}  # {user_id: task writing offline after the grace period}
+
+    def is_connected(self, user_id):
+        return self.connections.get(user_id, 0) > 0
+
+    async def connected(self, user_id):
+        """A socket opened; write online if the user had none (and none closing)."""
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        if self.connections[user_id] > 1:
+            return
+        pending = self._going_offline.pop(user_id, None)
+        if pending is not None:
+            pending.cancel()
+            return
+        await self._write(user_id, True)
+
+    async def disconnected(self, user_id):
+        """A socket closed; the user's last one starts the grace period."""
+        count = self.connections.get(user_id, 0) - 1
+        if count > 0:
+            self.connections[user_id] = count
+            return
+        self.connections.pop(user_id, None)
+        if self.grace_seconds <= 0:
+            await self._go_offline(user_id)
+        else:
+            self._going_offline[user_id] = asyncio.ensure_future(self._offline_later(user_id))
+
+    async def _offline_later(self, user_id, delay=None):
+        await asyncio.sleep(self.grace_seconds if delay is None else delay)
+        self._going_offline.pop(user_id, None)
+        await self._go_offline(user_id)
+
+    async def _go_offline(self, user_id):
+        heartbeat = await presence_store.last_heartbeat(user_id)
+        if self.is_connected(user_id) or user_id in self._going_offline:
+            # Reconnected during the lookup (and maybe closed again, with a
+            # newer grace period pending): this pass no longer decides
+            return
+        if heartbeat is not None:
+            stale_in = heartbeat + self.fresh_seconds - time.time()
+            if stale_in > 0:
+                # Still beating elsewhere; look again once it would have gone quiet
+                self._going_offline[user_id] = asyncio.ensure_future(
+                    self._offline_later(user_id, stale_in))
+                return
+        await self._write(user_id, False)
+
+    async def _write(self, user_id, is_online):
+        try:
+            await write_status(user_id, is_online)
+        except Exception:
+            logger.exception('Could not store online status for user %s', user_id)
+
+    def stats(self):
+        return {
+            'users': len(self.connections),
+            'sockets': sum(self.connections.values()),
+            'going_offline': len(self._going_offline),
+        }
+
+
+online_users = OnlineTracker()
@@ -0,0 +1,186 @@
+"""
+Chat — Outbound Queues
+Per-connection bounded send queues. Group handlers enqueue frames and
+return at once; a writer task per socket drains the queue to the client.
+When a slow client lets the queue fill, ephemeral frames (typing, presence,
+online status) are coalesced or dropped first; if reliable frames such as
+chat messages still overflow, the socket is closed with a resume hint.
+
+The queue only fills if the server's send waits for the client. uvicorn's
+websockets protocol does: a send blocks while the socket's write buffer is
+over its high-water mark (64 KiB). daphne's send returns at once and
+buffers without limit in the transport, so the caps never apply there.
+That is why the Dockerfile serves the app with uvicorn.
+"""
+import asyncio
+import json
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Close code sent when a client falls too far behind (4000-4999: app-defined)
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Seconds to try handing a stalled client its resume hint before closing
+RESUME_HINT_TIMEOUT = 1
+
+# Live queues, for the metrics endpoint
+_queues = weakref.WeakSet()
+
+
+class OutboundQueue:
+    """
+    FIFO of encoded frames capped by count and bytes.
+
+    Frames put with a ``coalesce`` key are ephemeral: a newer frame with the
+    same key replaces the queued one in place, and ephemeral frames are
+    evicted (oldest first) to make room. Frames without a key are reliable
+    and are never dropped; put() returns False when one does not fit.
+    """
+
+    def __init__(self, label='', max_messages=None, max_bytes=None):
+        self.label = label
+        self.max_messages = max_messages or getattr(settings, 'CHAT_OUTBOUND_MAX_MESSAGES', 256)
+        self.max_bytes = max_bytes or getattr(settings, 'CHAT_OUTBOUND_MAX_BYTES', 1024 * 1024)
+        self._frames = deque()  # [coalesce_key, text]
+        self._keyed = {}
+        self._bytes = 0
+        self._ready = asyncio.Event()
+        self.created = time.time()
+        self.high_water = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        _queues.add(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def _full(self):
+        return len(self._frames) > self.max_messages or self._bytes > self.max_bytes
+
+    def put(self, text, coalesce=None):
+        """Queue a frame. Returns False if a reliable frame overflowed the queue."""
+        if coalesce is not None and coalesce in self._keyed:
+            entry = self._keyed[coalesce]
+            self._bytes += len(text) - len(entry[1])
+            entry[1] = text
+            self.coalesced += 1
+            return True
+
+        entry = [coalesce, text]
+        self._frames.append(entry)
+        self._bytes += len(text)
+        if coalesce is not None:
+            self._keyed[coalesce] = entry
+
+        while self._full():
+            victim = next((e for e in self._frames if e[0] is not None), None)
+            if victim is None:
+                return False
+            self._frames.remove(victim)
+            del self._keyed[victim[0]]
+            self._bytes -= len(victim[1])
+            self.dropped += 1
+
+        self.high_water = max(self.high_water, len(self._frames))
+        self._ready.set()
+        return True
+
+    async def get(self):
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        key, text = self._frames.popleft()
+        if key is not None:
+            del self._keyed[key]
+        self._bytes -= len(text)
+        self.sent += 1
+        return text
+
+    def stats(self):
+        return {
+            'connection': self.label,
+            'depth': len(self._frames),
+            'bytes': self._bytes,
+            'high_water': self.high_water,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'age_seconds': round(time.time() - self.created, 1),
+        }
+
+
+def snapshot():
+    """Queue statistics for every open connection in this process, deepest first."""
+    return sorted((q.stats() for q in list(_queues)), key=lambda s: s['depth'], reverse=True)
+
+
+class OutboundQueueMixin:
+    """
+    Routes text frames of an AsyncWebsocketConsumer through an OutboundQueue.
+    Handlers pass ``coalesce=<key>`` for frames that may be merged or dropped.
+    Override resume_hint() to tell a disconnected client how to catch up.
+    """
+
+    outbox = None
+    _writer = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce=None):
+        if text_data is None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if self.outbox is None:
+            user = self.scope.get('user')
+            self.outbox = OutboundQueue(label=f'{getattr(user, "id", None)}:{self.channel_name}')
+            self._writer = asyncio.ensure_future(self._drain_outbox())
+        elif self._writer is None:
+            return  # Already closing for overflow
+        if not self.outbox.put(text_data, coalesce):
+            await self.close_slow_consumer()
+
+    async def _drain_outbox(self):
+        while True:
+            text = await self.outbox.get()
+            await super().send(text_data=text)
+
+    def resume_hint(self):
+        return {}
+
+    async def close_slow_consumer(self):
+        stats = self.outbox.stats()
+        logger.warning(
+            'Closing slow WebSocket %s: %d frames / %d bytes queued',
+            stats['connection'], stats['depth'], stats['bytes'],
+        )
+        self._stop_writer()
+        # The client is stalled, so this send may never complete
+        try:
+            await asyncio.wait_for(super().send(text_data=json.dumps({
+                'type': 'resume',
+                'reason': 'slow_consumer',
+                **self.resume_hint(),
+            })), RESUME_HINT_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    def _stop_writer(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    async def websocket_disconnect(self, message):
+        self._stop_writer()
+        if self.outbox is not None:
+            _queues.discard(self.outbox)
+        await super().websocket_disconnect(message)
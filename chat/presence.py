@@ -1,23 +1,179 @@
 """
 Chat — WebSocket Presence System
 Real-time nearby user discovery via WebSocket.
-Maintains an in-memory dict of active users and broadcasts updates.
+Presence is partitioned: each socket joins the group for its organization
+and, when CHAT_PRESENCE_NETWORK_SCOPE is set, its client IP or subnet, so a
+change only reaches the users who could see it. Within a partition a
+connecting client gets one snapshot of who is online; after that only
+join/leave deltas are broadcast. Deltas are versioned so a client that
+misses one asks for a fresh snapshot.
+Each socket also joins a "nearby" partition for its organization and exact
+client IP, which pushes devices appearing on and leaving the user's network
+the same way (nearby_snapshot / nearby_delta), replacing the HTTP
+heartbeat poll except as a fallback.
+Open sockets are registered in presence_store, which can be shared by all
+workers and expires sockets that stop sending heartbeats.
+Joins and leaves are collected for CHAT_PRESENCE_WINDOW_MS and sent as one
+merged delta per window; a connect-then-disconnect inside a window cancels out.
 """
+import asyncio
+import ipaddress
 import json
+import logging
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .events import group_event
+from .outbound import OutboundQueueMixin
+from .presence_store import presence_store
 
-# In-memory active users store: {channel_name: {user_id, username, avatar, ip}}
-ACTIVE_USERS = {}
+logger = logging.getLogger(__name__)
 
 
-class PresenceConsumer(AsyncWebsocketConsumer):
+def network_key(ip, scope=None):
+    """The network part of a presence group name for this client IP, or '' if unscoped."""
+    scope = scope or getattr(settings, 'CHAT_PRESENCE_NETWORK_SCOPE', None)
+    if not scope:
+        return ''
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return 'unknown'
+    if scope == 'subnet':
+        if address.version == 4:
+            prefix = getattr(settings, 'CHAT_PRESENCE_SUBNET_PREFIX', 24)
+        else:
+            prefix = getattr(settings, 'CHAT_PRESENCE_SUBNET_PREFIX_V6', 64)
+        address = ipaddress.ip_network(f'{address}/{prefix}', strict=False).network_address
+    # Group names only allow ASCII letters, digits, hyphens, underscores and periods
+    return address.exploded.replace(':', '-')
+
+
+def presence_group_name(organization_id, ip):
+    name = f'presence.org-{organization_id or "none"}'
+    network = network_key(ip)
+    if network:
+        name += f'.net-{network}'
+    return name
+
+
+def nearby_group_name(organization_id, ip):
+    return f'nearby.org-{organization_id or "none"}.net-{network_key(ip, "ip")}'
+
+
+class PresenceGroup:
+    """
+    Join/leave changes for one presence partition, waiting to be flushed as
+    one delta at most once per window. ``joined`` maps user_id → entry to
+    announce; ``left`` maps user_id → the entry clients last saw, so a user
+    who drops and comes back with the same entry inside the window sends
+    nothing. Who is online, and the delta version, live in presence_store.
+    The group name's first part ("presence" or "nearby") names the frames.
+    """
+
+    def __init__(self, group_name, window_ms=None):
+        self.group_name = group_name
+        self.kind = group_name.split('.', 1)[0]
+        self.window_ms = window_ms if window_ms is not None else getattr(settings, 'CHAT_PRESENCE_WINDOW_MS', 250)
+        self.joined = {}
+        self.left = {}
+        self._flush_task = None
+
+    async def join(self, entry):
+        uid = entry['user_id']
+        if self.left.pop(uid, None) != entry:
+            self.joined[uid] = entry
+        await self._schedule()
+
+    async def leave(self, entry):
+        uid = entry['user_id']
+        if self.joined.pop(uid, None) is None:
+            self.left[uid] = entry
+        await self._schedule()
+
+    async def _schedule(self):
+        if self.window_ms <= 0:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window_ms / 1000)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Broadcast the merged changes, if any survived the window, encoded once."""
+        joined, left = list(self.joined.values()), list(self.left)
+        self.joined, self.left = {}, {}
+        if joined or left:
+            version = await presence_store.next_version(self.group_name)
+            await get_channel_layer().group_send(
+                self.group_name,
+                group_event(f'{self.kind}_delta', {
+                    'type': f'{self.kind}_delta',
+                    'version': version,
+                    'joined': joined,
+                    'left': left,
+                }, coalesce=f'{self.kind}:{version}')
+            )
+        if not self.joined and not self.left and self._flush_task is None:
+            PRESENCE_GROUPS.pop(self.group_name, None)
+
+
+# Partitions with changes pending in this process: {group_name: PresenceGroup}
+PRESENCE_GROUPS = {}
+
+
+def presence_group(group_name):
+    group = PRESENCE_GROUPS.get(group_name)
+    if group is None:
+        group = PRESENCE_GROUPS[group_name] = PresenceGroup(group_name)
+    return group
+
+
+_sweeper = None
+
+
+def ensure_sweeper():
+    """Start this process's sweeper for expired presence sockets, once per event loop."""
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.ensure_future(sweep_forever())
+
+
+async def sweep_forever():
+    interval = getattr(settings, 'CHAT_PRESENCE_SWEEP_INTERVAL', 15)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            for group_name, entry in await presence_store.sweep():
+                await presence_group(group_name).leave(entry)
+        except Exception:
+            logger.exception('Presence sweep failed')
+
+
+class PresenceConsumer(OutboundQueueMixin, AsyncWebsocketConsumer):
     """
     Handles WebSocket connections for the presence/nearby system.
     Each authenticated client connects on page load:
-    - connect(): registers user in ACTIVE_USERS, joins 'presence' group, broadcasts
-    - disconnect(): removes user from ACTIVE_USERS, broadcasts
-    - receive(): handles heartbeat pings
+    - connect(): registers the socket in presence_store under its presence
+      and nearby partitions, joins those groups, sends a snapshot of each
+      and, for the user's first socket in a partition, queues a join
+    - disconnect(): removes the socket; the user's last socket queues a leave
+    - receive(): handles heartbeat pings (renewing the socket's TTL) and
+      snapshot requests ("presence_sync", "nearby_sync")
+
+    Server frames:
+    - {"type": "presence_snapshot", "version": V, "users": [...]}
+    - {"type": "presence_delta", "version": V, "joined": [...], "left": [user_id, ...]}
+    - nearby_snapshot / nearby_delta: the same for devices on the client's IP,
+      with "device_name" in each entry; not sent if the organization has
+      nearby mode turned off
+    A delta whose version is not the last one seen + 1 means one was missed.
+    A snapshot may already include changes still waiting for the window, so
+    clients apply deltas as upserts/removals rather than strict transitions.
     """
 
     async def connect(self):
@@ -27,8 +183,6 @@ class PresenceConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        self.group_name = 'presence'
-
         # Get user info
         user_info = await self.get_user_info()
 
@@ -42,89 +196,122 @@ class PresenceConsumer(AsyncWebsocketConsumer):
                 client_ip = header_value.decode('utf-8').split(',')[0].strip()
                 break
 
-        # Register in active users
-        ACTIVE_USERS[self.channel_name] = {
+        # Register in this tenant/network's partitions
+        organization_id = user_info['organization_id']
+        entry = {
             'user_id': self.user.id,
             'username': user_info['display_name'],
             'avatar': user_info['avatar'],
             'ip': client_ip,
         }
-
-        # Join presence group
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.partitions = {'presence': (presence_group_name(organization_id, client_ip), entry)}
+        if user_info['nearby_enabled']:
+            device_name = dict(self.scope.get('headers', [])).get(b'user-agent', b'').decode('utf-8', 'replace')
+            self.partitions['nearby'] = (
+                nearby_group_name(organization_id, client_ip),
+                {**entry, 'device_name': device_name[:250]},
+            )
+        first_socket = {}
+        for kind, (group_name, group_entry) in self.partitions.items():
+            first_socket[kind] = await presence_store.add(group_name, self.channel_name, self.user.id, group_entry)
+            await self.channel_layer.group_add(group_name, self.channel_name)
+        ensure_sweeper()
         await self.accept()
 
-        # Broadcast updated user list to all
-        await self.broadcast_presence()
+        for kind, (group_name, group_entry) in self.partitions.items():
+            await self.send_snapshot(kind)
+            if first_socket[kind]:
+                await presence_group(group_name).join(group_entry)
 
     async def disconnect(self, close_code):
-        # Remove from active users
-        ACTIVE_USERS.pop(self.channel_name, None)
-
-        # Leave group
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
-
-        # Broadcast updated list
-        await self.broadcast_presence()
+        if not hasattr(self, 'partitions'):
+            return
+        for group_name, entry, last_socket in await presence_store.remove(self.channel_name):
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+            if last_socket:
+                await presence_group(group_name).leave(entry)
 
     async def receive(self, text_data):
         """Handle heartbeat or other client messages."""
         try:
             data = json.loads(text_data)
             if data.get('type') == 'heartbeat':
-                # Just acknowledge — connection staying open is enough
+                await self.touch_presence()
                 await self.send(text_data=json.dumps({'type': 'heartbeat_ack'}))
+            elif data.get('type') in ('presence_sync', 'nearby_sync'):
+                await self.send_snapshot(data['type'].split('_')[0])
         except (json.JSONDecodeError, Exception):
             pass
 
-    async def broadcast_presence(self):
-        """Send updated active users list to all connected clients."""
-        users_list = self.get_active_users_list()
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type': 'presence_update',
-                'users': users_list,
-            }
-        )
-
-    async def presence_update(self, event):
-        """Handler for presence_update group messages — send to client."""
-        # Filter out the current user from the list they receive
-        users = [u for u in event['users'] if u['user_id'] != self.user.id]
+    async def send_snapshot(self, kind='presence'):
+        """Send this client everyone else online in one of its partitions, once."""
+        if kind not in self.partitions:
+            return
+        group_name = self.partitions[kind][0]
+        version = await presence_store.version(group_name)
+        users = [u for u in await presence_store.users(group_name) if u['user_id'] != self.user.id]
         await self.send(text_data=json.dumps({
-            'type': 'presence_update',
+            'type': f'{kind}_snapshot',
+            'version': version,
             'users': users,
-        }))
-
-    @staticmethod
-    def get_active_users_list():
-        """Build a deduplicated list of active users from ACTIVE_USERS dict."""
-        seen_ids = set()
-        users = []
-        for channel, info in ACTIVE_USERS.items():
-            uid = info['user_id']
-            if uid not in seen_ids:
-                seen_ids.add(uid)
-                users.append({
-                    'user_id': uid,
-                    'username': info['username'],
-                    'avatar': info['avatar'],
-                    'ip': info['ip'],
-                })
-        return users
+        }), coalesce=f'{kind}_snapshot')
+
+    async def touch_presence(self):
+        """Heartbeat: keep this socket's presence entry from expiring."""
+        await presence_store.touch(self.channel_name)
+
+    async def presence_delta(self, event):
+        """
+        Handler for presence_delta group messages — forward to client.
+        Clients skip their own entry. Each delta has its own coalesce key,
+        so a backed-up socket may drop it (and will resync) but never merges it.
+        """
+        await self.send(text_data=event['text'], coalesce=event['coalesce'])
+
+    async def nearby_delta(self, event):
+        """Handler for nearby_delta group messages — forward to client, like presence_delta."""
+        await self.send(text_data=event['text'], coalesce=event['coalesce'])
 
     @database_sync_to_async
     def get_user_info(self):
-        """Fetch display name and avatar for the connected user."""
+        """Fetch display name, avatar and active organization (and its nearby mode) for the connected user."""
         try:
             profile = self.user.profile
             avatar = profile.avatar_url
         except Exception:
+            profile = None
             avatar = '/static/img/default-avatar.svg'
 
         display_name = self.user.get_full_name() or self.user.username
+        organization_id = self.get_organization_id(profile)
+        nearby_enabled = True
+        if organization_id:
+            from organizations.models import Organization
+            nearby_enabled = Organization.objects.filter(
+                id=organization_id, nearby_mode_enabled=True,
+            ).exists()
         return {
             'display_name': display_name,
             'avatar': avatar,
+            'organization_id': organization_id,
+            'nearby_enabled': nearby_enabled,
         }
+
+    def get_organization_id(self, profile):
+        """
+        Same resolution as OrganizationMiddleware: the session's active org
+        if the user is still an active member, else the profile's active
+        organization, else the user's first active membership.
+        """
+        from organizations.models import OrganizationMembership
+        memberships = OrganizationMembership.objects.filter(
+            user=self.user, is_active=True, organization__is_active=True,
+        )
+        session = self.scope.get('session')
+        org_id = session.get('active_org_id') if session is not None else None
+        if org_id and memberships.filter(organization_id=org_id).exists():
+            return org_id
+        if profile is not None and profile.active_organization_id:
+            if memberships.filter(organization_id=profile.active_organization_id).exists():
+                return profile.active_organization_id
+        return memberships.values_list('organization_id', flat=True).first()
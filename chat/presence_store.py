@@ -0,0 +1,288 @@
+"""
+Chat — Presence Store
+Registry of open presence sockets and the groups (partitions) each one is
+in, shared by every worker that uses the same backend. Each row expires
+CHAT_PRESENCE_TTL seconds after the socket's last heartbeat, so sockets of
+a worker that died without running disconnect() age out; a sweeper in each
+process removes expired rows and reports users who have no live socket
+left in a partition.
+
+Backends (CHAT_PRESENCE_STORE):
+- 'memory': per process, the default for single-worker deployments
+- 'sqlite': a file shared by the workers on one host (CHAT_PRESENCE_STORE_PATH)
+
+Every lookup goes through a dict or an index keyed by channel, partition
+and user, so its cost does not grow with the number of connected users.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+def presence_ttl():
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 75)
+
+
+class MemoryPresenceStore:
+    """Presence registry for a single worker process."""
+
+    def __init__(self):
+        self._rows = {}        # {(channel_name, group_name): (user_id, entry, expires)}
+        self._by_channel = {}  # {channel_name: {group_name, ...}}
+        self._by_group = {}    # {group_name: {user_id: {channel_name, ...}}}
+        self._by_user = {}     # {user_id: {(channel_name, group_name), ...}}
+        self._versions = {}    # {group_name: last delta version}
+
+    def _live(self, group, user_id, now):
+        channels = self._by_group.get(group, {}).get(user_id, ())
+        return any(self._rows[c, group][2] > now for c in channels)
+
+    async def add(self, group, channel, user_id, entry):
+        """Register a socket in a group; True if the user had no other live socket there."""
+        now = time.time()
+        first = not self._live(group, user_id, now)
+        self._rows[channel, group] = (user_id, entry, now + presence_ttl())
+        self._by_channel.setdefault(channel, set()).add(group)
+        self._by_group.setdefault(group, {}).setdefault(user_id, set()).add(channel)
+        self._by_user.setdefault(user_id, set()).add((channel, group))
+        return first
+
+    async def touch(self, channel):
+        expires = time.time() + presence_ttl()
+        for group in self._by_channel.get(channel, ()):
+            user_id, entry, _ = self._rows[channel, group]
+            self._rows[channel, group] = (user_id, entry, expires)
+
+    def _forget(self, channel, group):
+        user_id, entry, _ = self._rows.pop((channel, group))
+        self._by_channel[channel].discard(group)
+        if not self._by_channel[channel]:
+            del self._by_channel[channel]
+        users = self._by_group[group]
+        users[user_id].discard(channel)
+        if not users[user_id]:
+            del users[user_id]
+            if not users:
+                del self._by_group[group]
+        self._by_user[user_id].discard((channel, group))
+        if not self._by_user[user_id]:
+            del self._by_user[user_id]
+        return user_id, entry
+
+    async def remove(self, channel):
+        """
+        Forget a socket in every group; returns (group, entry, whether the
+        user has no live socket left in that group) for each.
+        """
+        now = time.time()
+        removed = []
+        for group in list(self._by_channel.get(channel, ())):
+            user_id, entry = self._forget(channel, group)
+            removed.append((group, entry, not self._live(group, user_id, now)))
+        return removed
+
+    async def users(self, group):
+        """One entry per user with a live socket in the group."""
+        now = time.time()
+        users = []
+        for channels in self._by_group.get(group, {}).values():
+            live = [self._rows[c, group] for c in channels if self._rows[c, group][2] > now]
+            if live:
+                users.append(live[0][1])
+        return users
+
+    async def last_heartbeat(self, user_id):
+        """When the user's most recently beating live socket last beat, or None."""
+        now = time.time()
+        expires = [e for e in (self._rows[key][2] for key in self._by_user.get(user_id, ())) if e > now]
+        return max(expires) - presence_ttl() if expires else None
+
+    async def version(self, group):
+        return self._versions.get(group, 0)
+
+    async def next_version(self, group):
+        self._versions[group] = self._versions.get(group, 0) + 1
+        return self._versions[group]
+
+    async def sweep(self):
+        """Drop expired sockets; returns (group, entry) for each user left with none in that group."""
+        now = time.time()
+        gone = {}
+        for channel, group in [key for key, row in self._rows.items() if row[2] <= now]:
+            user_id, entry = self._forget(channel, group)
+            gone[group, user_id] = entry
+        return [
+            (group, entry) for (group, user_id), entry in gone.items()
+            if not self._live(group, user_id, now)
+        ]
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS presence_members (
+    channel TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (channel, group_name)
+);
+CREATE INDEX IF NOT EXISTS presence_members_group ON presence_members (group_name, user_id, expires);
+CREATE INDEX IF NOT EXISTS presence_members_user ON presence_members (user_id, expires);
+CREATE INDEX IF NOT EXISTS presence_members_expires ON presence_members (expires);
+CREATE TABLE IF NOT EXISTS presence_versions (
+    group_name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+'''
+
+
+class SQLitePresenceStore:
+    """Presence registry in a SQLite file (WAL mode) shared by the workers on one host."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        # All SQLite work happens on one thread that owns the connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='presence-store')
+        self._thread_state = threading.local()
+
+    # ── Database (executor thread only) ─────────────────────────────────
+
+    def _db(self):
+        conn = getattr(self._thread_state, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._thread_state.conn = conn
+        return conn
+
+    def _transaction(self, fn, *args):
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn, *args)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    @staticmethod
+    def _has_live(conn, group, user_id, now):
+        return conn.execute(
+            'SELECT 1 FROM presence_members WHERE group_name = ? AND user_id = ? AND expires > ? LIMIT 1',
+            (group, user_id, now),
+        ).fetchone() is not None
+
+    def _add_sync(self, conn, group, channel, user_id, entry):
+        now = time.time()
+        first = not self._has_live(conn, group, user_id, now)
+        conn.execute(
+            'INSERT OR REPLACE INTO presence_members (channel, group_name, user_id, entry, expires) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (channel, group, user_id, json.dumps(entry), now + presence_ttl()),
+        )
+        return first
+
+    def _remove_sync(self, conn, channel):
+        rows = conn.execute(
+            'DELETE FROM presence_members WHERE channel = ? RETURNING group_name, user_id, entry',
+            (channel,),
+        ).fetchall()
+        now = time.time()
+        return [
+            (group, json.loads(entry), not self._has_live(conn, group, user_id, now))
+            for group, user_id, entry in rows
+        ]
+
+    def _sweep_sync(self, conn):
+        now = time.time()
+        gone = {}
+        for group, user_id, entry in conn.execute(
+            'DELETE FROM presence_members WHERE expires <= ? RETURNING group_name, user_id, entry', (now,),
+        ).fetchall():
+            gone[group, user_id] = entry
+        return [
+            (group, json.loads(entry)) for (group, user_id), entry in gone.items()
+            if not self._has_live(conn, group, user_id, now)
+        ]
+
+    def _next_version_sync(self, conn, group):
+        (version,) = conn.execute(
+            'INSERT INTO presence_versions (group_name, version) VALUES (?, 1) '
+            'ON CONFLICT (group_name) DO UPDATE SET version = version + 1 RETURNING version',
+            (group,),
+        ).fetchone()
+        return version
+
+    def _query_sync(self, sql, params):
+        return self._db().execute(sql, params).fetchall()
+
+    # ── Public API ──────────────────────────────────────────────────────
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def add(self, group, channel, user_id, entry):
+        """Register a socket in a group; True if the user had no other live socket there."""
+        return await self._run(self._transaction, self._add_sync, group, channel, user_id, entry)
+
+    async def touch(self, channel):
+        await self._run(
+            self._query_sync,
+            'UPDATE presence_members SET expires = ? WHERE channel = ?',
+            (time.time() + presence_ttl(), channel),
+        )
+
+    async def remove(self, channel):
+        """
+        Forget a socket in every group; returns (group, entry, whether the
+        user has no live socket left in that group) for each.
+        """
+        return await self._run(self._transaction, self._remove_sync, channel)
+
+    async def users(self, group):
+        """One entry per user with a live socket in the group."""
+        rows = await self._run(
+            self._query_sync,
+            'SELECT user_id, MAX(entry) FROM presence_members WHERE group_name = ? AND expires > ? GROUP BY user_id',
+            (group, time.time()),
+        )
+        return [json.loads(entry) for _, entry in rows]
+
+    async def last_heartbeat(self, user_id):
+        """When the user's most recently beating live socket last beat, or None."""
+        rows = await self._run(
+            self._query_sync,
+            'SELECT MAX(expires) FROM presence_members WHERE user_id = ? AND expires > ?',
+            (user_id, time.time()),
+        )
+        return rows[0][0] - presence_ttl() if rows and rows[0][0] is not None else None
+
+    async def version(self, group):
+        rows = await self._run(
+            self._query_sync, 'SELECT version FROM presence_versions WHERE group_name = ?', (group,),
+        )
+        return rows[0][0] if rows else 0
+
+    async def next_version(self, group):
+        return await self._run(self._transaction, self._next_version_sync, group)
+
+    async def sweep(self):
+        """Drop expired sockets; returns (group, entry) for each user left with none in that group."""
+        return await self._run(self._transaction, self._sweep_sync)
+
+
+def build_store():
+    if getattr(settings, 'CHAT_PRESENCE_STORE', 'memory') == 'sqlite':
+        return SQLitePresenceStore(settings.CHAT_PRESENCE_STORE_PATH)
+    return MemoryPresenceStore()
+
+
+presence_store = build_store()
@@ -0,0 +1,66 @@
+"""
+Chat — Reactions
+Race-free reaction toggles backed by one Reaction row per
+(message, user, emoji), with a cached {emoji: count} summary on Message.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Min
+
+from .models import Message, Reaction
+from .recent import recent_messages
+
+MAX_EMOJI_LENGTH = Reaction._meta.get_field('emoji').max_length
+
+
+def toggle_reaction(user, conversation_id, message_id, emoji):
+    """
+    Add the user's emoji to the message, or remove it if already present.
+    Returns (added, counts, message_seq) or None if the message is not in
+    the conversation.
+
+    The message row is locked while the Reaction table is changed and the
+    summary recomputed, so concurrent toggles on a popular message serialize
+    instead of overwriting each other's counts.
+    """
+    if not emoji or len(emoji) > MAX_EMOJI_LENGTH:
+        return None
+
+    with transaction.atomic():
+        msg = Message.objects.select_for_update().filter(
+            id=message_id, conversation_id=conversation_id
+        ).only('id', 'seq').first()
+        if msg is None:
+            return None
+
+        deleted, _ = Reaction.objects.filter(message=msg, user=user, emoji=emoji).delete()
+        added = not deleted
+        if added:
+            try:
+                with transaction.atomic():
+                    Reaction.objects.create(message=msg, user=user, emoji=emoji)
+            except IntegrityError:
+                pass  # A concurrent toggle already added it
+
+        rows = (
+            Reaction.objects.filter(message=msg)
+            .values('emoji')
+            .annotate(n=Count('id'), first=Min('id'))
+            .order_by('first')
+        )
+        counts = {row['emoji']: row['n'] for row in rows}
+        Message.objects.filter(id=msg.id).update(reactions=counts)
+        recent_messages.patch(conversation_id, msg.id, reactions=counts)
+    return added, counts, msg.seq
+
+
+def my_reactions(user, message_ids):
+    """{message_id: {emoji, ...}} for the user's reactions on the given messages."""
+    mine = defaultdict(set)
+    rows = Reaction.objects.filter(
+        user=user, message_id__in=list(message_ids)
+    ).values_list('message_id', 'emoji')
+    for message_id, emoji in rows:
+        mine[message_id].add(emoji)
+    return mine
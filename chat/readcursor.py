@@ -0,0 +1,126 @@
+"""
+Chat — Read Cursors
+Read receipts as per-user high-water marks. Acks arriving over WebSockets
+are coalesced per (user, conversation) and written after a short debounce,
+one small monotonic UPDATE per cursor instead of one per message.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def read_position(conversation_id, message_id):
+    """
+    The id a read ack for message_id may set: the conversation's highest
+    message id not above it, or None if the conversation has none. Keeps a
+    bogus or foreign id from parking the cursor past future messages.
+    """
+    from chat.models import Message
+    return Message.objects.filter(
+        conversation_id=conversation_id, id__lte=message_id,
+    ).order_by('-id').values_list('id', flat=True).first()
+
+
+def advance_read_cursor(user_id, conversation_id, message_id):
+    """
+    Move the user's cursor forward to message_id, clamped by read_position(),
+    and recount what is left unread behind it in the same UPDATE. Returns
+    the id stored, or None if the cursor did not move.
+    """
+    from chat.inbox import unread_since
+    from chat.models import ConversationMember
+    message_id = read_position(conversation_id, message_id)
+    if message_id is None:
+        return None
+    moved = ConversationMember.objects.filter(
+        user_id=user_id,
+        conversation_id=conversation_id,
+        last_read_message_id__lt=message_id,
+    ).update(last_read_message_id=message_id, unread_count=unread_since(message_id))
+    return message_id if moved else None
+
+
+def read_cursor(user_id, conversation_id):
+    """The highest message id the user has read in the conversation (0 if none)."""
+    from chat.models import ConversationMember
+    return ConversationMember.objects.filter(
+        user_id=user_id, conversation_id=conversation_id,
+    ).values_list('last_read_message_id', flat=True).first() or 0
+
+
+class ReadCursorBuffer:
+    """
+    Keeps the highest acked message id per (user_id, conversation_id) and
+    flushes all of them ``debounce`` seconds after the first pending ack.
+    The ids last flushed are remembered too (the most recently flushed
+    ``remember`` cursors), so an ack that was already written is dropped.
+    """
+
+    def __init__(self, debounce_ms=None, remember=None):
+        self.debounce = (debounce_ms or getattr(settings, 'CHAT_READ_RECEIPT_DEBOUNCE_MS', 500)) / 1000
+        self.remember = remember or getattr(settings, 'CHAT_READ_CURSORS_REMEMBERED', 10000)
+        self._pending = {}
+        self._flushed = OrderedDict()  # {(user_id, conversation_id): last id handed to _persist}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def advance(self, user_id, conversation_id, message_id):
+        """
+        Record an ack. Returns False if it does not move past an ack already
+        pending or flushed for the same cursor, so callers can skip the
+        broadcast. Must be called from the event loop.
+        """
+        key = (user_id, conversation_id)
+        with self._lock:
+            if max(self._pending.get(key, 0), self._flushed.get(key, 0)) >= message_id:
+                return False
+            self._pending[key] = message_id
+
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.debounce, self._on_timer)
+        return True
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            for key, message_id in pending.items():
+                self._flushed[key] = message_id
+                self._flushed.move_to_end(key)
+            while len(self._flushed) > self.remember:
+                self._flushed.popitem(last=False)
+        return pending
+
+    async def flush(self):
+        pending = self._take()
+        if pending:
+            try:
+                await database_sync_to_async(self._persist)(pending)
+            except Exception:
+                logger.exception('Failed to persist %d read cursors', len(pending))
+
+    def flush_sync(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending = self._take()
+        if pending:
+            self._persist(pending)
+
+    def _persist(self, pending):
+        for (user_id, conversation_id), message_id in pending.items():
+            advance_read_cursor(user_id, conversation_id, message_id)
+
+
+read_cursors = ReadCursorBuffer()
+atexit.register(read_cursors.flush_sync)
@@ -0,0 +1,220 @@
+"""
+Chat — Recent Messages Cache
+The newest messages of each conversation, kept in memory so the
+conversation page, the polling endpoint and the API stop re-reading the
+same tail from the Message table.
+
+Each conversation keeps up to CHAT_RECENT_MESSAGES_PER_CONVERSATION messages
+(with their sender and profile loaded and their to_json() memoized), and
+conversations are evicted least-recently-used once the estimated size of
+all tails passes CHAT_RECENT_MESSAGES_MAX_BYTES. Like the membership
+cache, every write bumps the conversation's counter in chat.versions, so
+other processes reload once their last version check is older than
+CHAT_CACHE_VERSION_TTL_MS. The writing process updates its tail in place
+only when the bump went from the version that tail holds; after a
+concurrent write elsewhere it drops the tail and reloads instead.
+Cached Message instances are shared: copy them before changing attributes.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from .versions import fresh, versions as shared_versions
+
+# Rough per-message overhead of a Message with its sender and profile loaded
+MESSAGE_OVERHEAD_BYTES = 2048
+
+
+def _message_size(message):
+    return MESSAGE_OVERHEAD_BYTES + len(message.content or '')
+
+
+class Tail:
+    """The newest messages of one conversation, oldest first."""
+
+    __slots__ = ('version', 'checked', 'messages', 'complete', 'size', '_json')
+
+    def __init__(self, version, messages, complete):
+        self.version = version
+        self.checked = time.monotonic()  # When version was last confirmed current
+        self.messages = messages
+        self.complete = complete  # True when this is the whole conversation
+        self.size = sum(map(_message_size, messages))
+        self._json = None
+
+    def as_json(self):
+        if self._json is None:
+            self._json = [m.to_json() for m in self.messages]
+        return self._json
+
+
+class RecentMessageCache:
+
+    def __init__(self, per_conversation=None, max_bytes=None, versions=None):
+        self.per_conversation = per_conversation or getattr(settings, 'CHAT_RECENT_MESSAGES_PER_CONVERSATION', 100)
+        self.max_bytes = max_bytes or getattr(settings, 'CHAT_RECENT_MESSAGES_MAX_BYTES', 32 * 1024 * 1024)
+        self.versions = versions or shared_versions
+        self._tails = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ── Reads ───────────────────────────────────────────────────────────
+
+    def _version_key(self, conversation_id):
+        return f'chat:recent:v:{conversation_id}'
+
+    def tail(self, conversation_id):
+        conversation_id = int(conversation_id)
+        with self._lock:
+            tail = self._tails.get(conversation_id)
+            if tail is not None and fresh(tail.checked):
+                self._tails.move_to_end(conversation_id)
+                self.hits += 1
+                return tail
+
+        version = self.versions.get(self._version_key(conversation_id))
+        with self._lock:
+            tail = self._tails.get(conversation_id)
+            if tail is not None and tail.version == version:
+                tail.checked = time.monotonic()
+                self._tails.move_to_end(conversation_id)
+                self.hits += 1
+                return tail
+            self.misses += 1
+
+        tail = self._load(conversation_id, version)
+        with self._lock:
+            self._store(conversation_id, tail)
+        return tail
+
+    def _load(self, conversation_id, version):
+        from chat.models import Message
+        rows = list(
+            Message.objects.filter(conversation_id=conversation_id)
+            .select_related('sender__profile')
+            .order_by('-seq')[:self.per_conversation + 1]
+        )
+        complete = len(rows) <= self.per_conversation
+        return Tail(version, rows[:self.per_conversation][::-1], complete)
+
+    def _store(self, conversation_id, tail):
+        old = self._tails.pop(conversation_id, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._tails[conversation_id] = tail
+        self._bytes += tail.size
+        while self._bytes > self.max_bytes and len(self._tails) > 1:
+            _, evicted = self._tails.popitem(last=False)
+            self._bytes -= evicted.size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._tails.clear()
+            self._bytes = 0
+
+    def messages(self, conversation_id):
+        """Every message of the conversation, or None if it is longer than the cached tail."""
+        tail = self.tail(conversation_id)
+        return list(tail.messages) if tail.complete else None
+
+    def messages_json(self, conversation_id, after_id=0):
+        """
+        to_json() of every message with id > after_id, or None if the cached
+        tail does not reach back that far.
+        """
+        tail = self.tail(conversation_id)
+        if not tail.complete and (not tail.messages or tail.messages[0].id > after_id):
+            return None
+        return [m for m in tail.as_json() if m['id'] > after_id]
+
+    def latest(self, conversation_id, count):
+        """The newest ``count`` messages, newest first, or None if the tail is shorter."""
+        tail = self.tail(conversation_id)
+        if not tail.complete and len(tail.messages) < count:
+            return None
+        return tail.messages[::-1][:count]
+
+    # ── Writes ──────────────────────────────────────────────────────────
+    # All of them take effect once the surrounding transaction commits.
+
+    def _bump(self, conversation_id):
+        return self.versions.bump(self._version_key(conversation_id))
+
+    def _apply(self, conversation_id, change):
+        """
+        Bump the version and, if the cached tail is the one this bump
+        replaces, rebuild it via change(messages). Bumps are atomic (see
+        chat.versions), so a tail one version behind saw every earlier write.
+        """
+        conversation_id = int(conversation_id)
+
+        def apply():
+            version = self._bump(conversation_id)
+            with self._lock:
+                tail = self._tails.get(conversation_id)
+                if tail is None or tail.version != version - 1:
+                    self._drop(conversation_id)
+                    return
+                messages = change(list(tail.messages))
+                complete = tail.complete and len(messages) <= self.per_conversation
+                self._store(conversation_id, Tail(version, messages[-self.per_conversation:], complete))
+
+        transaction.on_commit(apply)
+
+    def append(self, messages):
+        """Add newly saved messages (each with an id) to their conversations' tails."""
+        by_conversation = {}
+        for message in messages:
+            by_conversation.setdefault(message.conversation_id, []).append(message)
+        for conversation_id, new in by_conversation.items():
+            self._apply(conversation_id, lambda tail, new=new: tail + new)
+
+    def patch(self, conversation_id, message_id, **fields):
+        """Apply an UPDATE already made in the database to the cached copy of one message."""
+        message_id = int(message_id)
+
+        def change(tail):
+            for i, message in enumerate(tail):
+                if message.id == message_id:
+                    updated = copy.copy(message)
+                    for name, value in fields.items():
+                        setattr(updated, name, value)
+                    tail[i] = updated
+            return tail
+
+        self._apply(conversation_id, change)
+
+    def invalidate(self, conversation_id):
+        conversation_id = int(conversation_id)
+
+        def drop():
+            self._bump(conversation_id)
+            with self._lock:
+                self._drop(conversation_id)
+
+        transaction.on_commit(drop)
+
+    def _drop(self, conversation_id):
+        tail = self._tails.pop(conversation_id, None)
+        if tail is not None:
+            self._bytes -= tail.size
+
+    def stats(self):
+        return {
+            'conversations': len(self._tails),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+recent_messages = RecentMessageCache()
@@ -0,0 +1,128 @@
+"""
+Chat — Event Replay
+Per-conversation ring buffers of the recent conversation events delivered
+in this process, so a reconnecting client can resume from the last event it
+saw instead of reloading the page.
+
+Events are numbered as they are first delivered to a local socket (each
+carries a unique ``eid``, so one event delivered to several sockets gets one
+number). A buffer is only trustworthy while some local socket is subscribed;
+when the last one leaves it is dropped, and the next buffer for that
+conversation starts under a new epoch. Clients resume with (epoch, seq);
+anything the buffer cannot answer falls back to a database query.
+
+Sockets normally share one event loop, but WSGI event streams each run on
+their own thread, so the module-level functions take a lock.
+"""
+import threading
+import uuid
+from collections import deque
+
+from django.conf import settings
+
+
+class ReplayBuffer:
+    """Ring of (seq, eid, text) for one conversation."""
+
+    def __init__(self, size):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.subscribers = 0
+        self._events = deque()
+        self._by_eid = {}
+        self._size = size
+
+    def record(self, eid, text):
+        """Number the event on first sight and return its stamped frame text."""
+        entry = self._by_eid.get(eid)
+        if entry is not None:
+            return entry[2]
+        self.seq += 1
+        # Frames are JSON objects encoded once upstream; splice the stamp in
+        stamped = f'{text[:-1]}, "seq": {self.seq}, "epoch": "{self.epoch}"}}'
+        entry = (self.seq, eid, stamped)
+        self._events.append(entry)
+        self._by_eid[eid] = entry
+        while len(self._events) > self._size:
+            _, old_eid, _ = self._events.popleft()
+            del self._by_eid[old_eid]
+        return stamped
+
+    def since(self, epoch, seq):
+        """Stamped frames after seq, or None if the buffer cannot cover the gap."""
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        first = self._events[0][0] if self._events else self.seq + 1
+        if seq < first - 1:
+            return None
+        return [text for s, _, text in self._events if s > seq]
+
+
+_buffers = {}
+_lock = threading.Lock()
+
+
+def join(conversation_id):
+    """A local socket subscribed; returns the conversation's buffer."""
+    with _lock:
+        buffer = _buffers.get(conversation_id)
+        if buffer is None:
+            buffer = _buffers[conversation_id] = ReplayBuffer(
+                getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 200)
+            )
+        buffer.subscribers += 1
+        return buffer
+
+
+def leave(conversation_id):
+    """A local socket unsubscribed; drop the buffer once nobody here listens."""
+    with _lock:
+        buffer = _buffers.get(conversation_id)
+        if buffer is None:
+            return
+        buffer.subscribers -= 1
+        if buffer.subscribers <= 0:
+            del _buffers[conversation_id]
+
+
+def record(event):
+    """
+    Stamp a conversation event with its replay seq. Ephemeral events (those
+    with a coalesce key) and events for unbuffered conversations pass through.
+    """
+    buffer = _buffers.get(event.get('conversation_id'))
+    if buffer is None or 'eid' not in event or event.get('coalesce'):
+        return event['text']
+    with _lock:
+        return buffer.record(event['eid'], event['text'])
+
+
+def record_with_id(event):
+    """record(), plus the event's "epoch:seq" id when it was stamped (else None)."""
+    text = record(event)
+    buffer = _buffers.get(event.get('conversation_id'))
+    with _lock:
+        entry = buffer._by_eid.get(event.get('eid')) if buffer is not None else None
+    if entry is None or event.get('coalesce'):
+        return text, None
+    return text, f'{buffer.epoch}:{entry[0]}'
+
+
+def resume(conversation_id, epoch, seq):
+    """Missed stamped frames since (epoch, seq), or None if a DB resync is needed."""
+    buffer = _buffers.get(conversation_id)
+    if buffer is None or not epoch:
+        return None
+    try:
+        seq = int(seq)
+    except (TypeError, ValueError):
+        return None
+    with _lock:
+        return buffer.since(epoch, seq)
+
+
+def position(conversation_id):
+    """The (epoch, seq) a client that is up to date right now should hold."""
+    with _lock:
+        buffer = _buffers.get(conversation_id)
+        return (buffer.epoch, buffer.seq) if buffer else (None, 0)
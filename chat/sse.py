@@ -0,0 +1,180 @@
+"""
+Chat — Server-Sent Events
+A one-way event stream per user for clients that cannot open a WebSocket.
+The stream joins the user's sidebar group and, optionally, one
+conversation's group on the channel layer, and writes the same frames the
+WebSocket consumers forward, each as one SSE "data:" line. Replay-stamped
+conversation frames get an "epoch:seq:message_seq" event id, so a
+reconnecting EventSource resumes through Last-Event-ID from the replay
+buffer, or from the database (a "resync" frame) when the buffer cannot
+cover the gap. message_seq is the conversation's last message seq when the
+stream opened (read before subscribing, so anything newer arrives live or
+in the resync) and a resync starts there. EventSource reconnects with its
+original URL, so ?after_seq= only counts when the id carries no position.
+
+Comment lines keep idle connections alive through proxies, and the stream
+ends after CHAT_SSE_MAX_SECONDS; EventSource reconnects on its own.
+
+Under WSGI every stream runs its own event loop, and the events it must
+see are sent from other requests, threads or processes. That takes a
+channel layer shared across them (chat.layers.SQLiteChannelLayer keeps
+state per loop); with the in-memory layer the stream is refused and the
+client long-polls instead.
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+
+from . import history, replay
+from .events import conversation_group, user_group
+
+# How long EventSource waits before reconnecting after the stream ends
+RETRY_MS = 3000
+
+
+def heartbeat_interval():
+    return getattr(settings, 'CHAT_SSE_HEARTBEAT', 15)
+
+
+def max_seconds():
+    return getattr(settings, 'CHAT_SSE_MAX_SECONDS', 300)
+
+
+def serves_wsgi(layer):
+    """Whether WSGI workers can stream with this layer (see the module docstring)."""
+    return not isinstance(layer, InMemoryChannelLayer)
+
+
+def format_event(text, event_id=None):
+    """One SSE event; frames are single-line JSON, so one data line each."""
+    if event_id:
+        return f'id: {event_id}\ndata: {text}\n\n'
+    return f'data: {text}\n\n'
+
+
+def parse_event_id(value):
+    """(epoch, seq, message_seq) from an "epoch:seq[:message_seq]" event id; missing parts are None, 0, 0."""
+    epoch, _, rest = (value or '').partition(':')
+    seq, _, message_seq = rest.partition(':')
+    try:
+        return (epoch or None), int(seq), int(message_seq or 0)
+    except ValueError:
+        return None, 0, 0
+
+
+async def _resume(conversation_id, last_event_id, after_seq, message_seq):
+    """Frames for what a reconnecting client missed, then its 'subscribed' frame."""
+    # Taken after group_add: anything newer reaches the stream live
+    epoch, seq = replay.position(conversation_id)
+    frames = []
+    replayed = 0
+    if last_event_id:
+        last_epoch, last_seq, seen_seq = parse_event_id(last_event_id)
+        missed = replay.resume(conversation_id, last_epoch, last_seq)
+        if missed is not None:
+            frames = [(text, None) for text in missed]
+            replayed = len(missed)
+        else:
+            messages, truncated = await sync_to_async(history.resync)(
+                conversation_id, seen_seq or after_seq,
+                getattr(settings, 'CHAT_REPLAY_BUFFER_SIZE', 200),
+            )
+            frames = [(json.dumps({
+                'type': 'resync',
+                'conversation_id': conversation_id,
+                'messages': [m.to_json() for m in messages],
+                'truncated': truncated,
+            }), None)]
+    frames.append((json.dumps({
+        'type': 'subscribed',
+        'conversation_id': conversation_id,
+        'epoch': epoch,
+        'seq': seq,
+        'replayed': replayed,
+    }), f'{epoch}:{seq}:{message_seq}' if epoch else None))
+    return frames
+
+
+async def event_stream(user, conversation_id=None, last_event_id=None, after_seq=0, message_seq=0):
+    """
+    Async iterator of SSE chunks for one client; cleans up when closed.
+    message_seq is the conversation's last message seq, read before calling.
+    """
+    layer = get_channel_layer()
+    channel = await layer.new_channel('sse')
+    groups = [user_group(user.id)]
+    if conversation_id:
+        groups.append(conversation_group(conversation_id))
+        replay.join(conversation_id)
+    for group in groups:
+        await layer.group_add(group, channel)
+
+    try:
+        yield f'retry: {RETRY_MS}\n\n'
+        if conversation_id:
+            for text, event_id in await _resume(conversation_id, last_event_id, after_seq, message_seq):
+                yield format_event(text, event_id)
+
+        deadline = time.monotonic() + max_seconds()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = await asyncio.wait_for(
+                    layer.receive(channel), min(remaining, heartbeat_interval()),
+                )
+            except asyncio.TimeoutError:
+                yield ': ping\n\n'
+                continue
+            if 'text' not in event:
+                continue
+            # Same rule as ChatConsumer.typing_indicator: no echo of one's own typing
+            if event['type'] == 'typing_indicator' and event.get('username') == user.username:
+                continue
+            text, event_id = replay.record_with_id(event)
+            yield format_event(text, event_id and f'{event_id}:{message_seq}')
+    finally:
+        for group in groups:
+            await layer.group_discard(group, channel)
+        if conversation_id:
+            replay.leave(conversation_id)
+
+
+def sync_stream(chunks):
+    """
+    Serve an async event_stream() from a WSGI worker: it runs on its own
+    event loop in a helper thread and hands chunks over through a queue.
+    Closing the generator (client gone) stops it at its next chunk, which
+    is at most one heartbeat away.
+    """
+    handoff = queue.Queue()
+    stop = threading.Event()
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                if stop.is_set():
+                    break
+                handoff.put(chunk)
+        finally:
+            await chunks.aclose()
+
+    def run():
+        try:
+            asyncio.run(pump())
+        finally:
+            handoff.put(None)
+
+    threading.Thread(target=run, name='sse-stream', daemon=True).start()
+    try:
+        while (chunk := handoff.get()) is not None:
+            yield chunk
+    finally:
+        stop.set()
@@ -0,0 +1,1487 @@
+import asyncio
+import contextlib
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.lastseen import last_seen
+from chat import history, inbox, membership, replay, sse
+from chat.consumers import ChatConsumer
+from chat.events import conversation_event, conversation_group, group_event
+from chat.layers import SQLiteChannelLayer
+from chat.models import Conversation, ConversationMember, Message, Reaction
+from chat.online import OnlineTracker, online_users
+from chat.outbound import OutboundQueueMixin
+from chat.reactions import my_reactions, toggle_reaction
+from chat.presence import PRESENCE_GROUPS, PresenceGroup, nearby_group_name, network_key, presence_group_name
+from chat.presence_store import MemoryPresenceStore, SQLitePresenceStore
+from chat.readcursor import ReadCursorBuffer, advance_read_cursor, read_cursor
+from chat.recent import RecentMessageCache, recent_messages
+from chat.routing import websocket_urlpatterns
+from chat.versions import CacheVersions, SQLiteVersions
+from chat.writebehind import MessageWriteBehind
+from organizations.models import Organization, OrganizationMembership
+
+
+def conversation(*users):
+    # Rolled-back tests reuse user and conversation ids; forget what earlier ones cached
+    membership.user_conversations.clear()
+    membership.conversation_participants.clear()
+    recent_messages.clear()
+    conv = Conversation.objects.create()
+    conv.participants.add(*users)
+    return conv
+
+
+class SocketTestCase(TestCase):
+    """WebSockets opened through the app's routes, closed again when the test is done."""
+
+    def setUp(self):
+        for patcher in (mock.patch.object(online_users, 'grace_seconds', 0),
+                        mock.patch('chat.presence.ensure_sweeper')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Pending presence flushes die with each test's event loop
+        PRESENCE_GROUPS.clear()
+
+    @contextlib.asynccontextmanager
+    async def sockets(self):
+        opened = []
+
+        async def connect(user, path, ip=None, device=None):
+            headers = [(b'x-forwarded-for', ip.encode())] if ip else []
+            if device:
+                headers.append((b'user-agent', device.encode()))
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, headers)
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            opened.append(communicator)
+            return communicator
+
+        try:
+            yield connect
+        finally:
+            for communicator in opened:
+                await communicator.disconnect()
+
+    async def frame(self, communicator, frame_type):
+        """The next frame of the given type, skipping any others."""
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=2))
+            if frame['type'] == frame_type:
+                return frame
+
+    async def delta(self, communicator, user, kind='presence'):
+        """The next delta that mentions the user (clients also get their own)."""
+        while True:
+            frame = await self.frame(communicator, f'{kind}_delta')
+            if user.id in frame['left'] + [u['user_id'] for u in frame['joined']]:
+                return frame
+
+    async def frame_types(self, communicator, timeout=0.2):
+        """Types of every frame that arrives before the socket goes quiet."""
+        types = []
+        while not await communicator.receive_nothing(timeout):
+            types.append(json.loads(await communicator.receive_from())['type'])
+        return types
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = str(Path(self.tmp) / 'layer.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_group_messages_cross_processes(self):
+        call_command('check_channel_layer', workers=2, channels=3, messages=20,
+                     timeout=10, path=self.path, stdout=io.StringIO())
+
+    def test_idle_receiver_outlives_cleanup(self):
+        async def run():
+            layer = SQLiteChannelLayer(self.path, expiry=0.05, cleanup_interval=0.05)
+            channel = await layer.new_channel()
+            await layer.group_add('idle', channel)
+            waiting = asyncio.ensure_future(layer.receive(channel))
+            # Several cleanup rounds pass while the receiver sits in receive()
+            await asyncio.sleep(0.5)
+            await layer.group_send('idle', {'type': 'chat.ping'})
+            message = await asyncio.wait_for(waiting, 2)
+            await layer.close()
+            return message
+
+        self.assertEqual(asyncio.run(run()), {'type': 'chat.ping'})
+
+    def test_concurrent_event_loops_keep_their_channels(self):
+        layer = SQLiteChannelLayer(self.path)
+        ready = threading.Barrier(3)
+        results = {}
+
+        async def listen(name):
+            channel = await layer.new_channel()
+            await layer.group_add('loops', channel)
+            await asyncio.get_running_loop().run_in_executor(None, ready.wait)
+            try:
+                results[name] = (await asyncio.wait_for(layer.receive(channel), 5))['type']
+            except asyncio.TimeoutError:
+                results[name] = 'TIMEOUT'
+
+        threads = [
+            threading.Thread(target=asyncio.run, args=(listen(name),))
+            for name in ('first', 'second')
+        ]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        asyncio.run(layer.group_send('loops', {'type': 'chat.ping'}))
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {'first': 'chat.ping', 'second': 'chat.ping'})
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.dead_letter_path = Path(tmp) / 'dead_letters.jsonl'
+        self.writer = MessageWriteBehind(max_attempts=3, dead_letter_path=self.dead_letter_path)
+
+    def message(self, conv_id, content='hi'):
+        return Message(conversation_id=conv_id, sender=self.alice, content=content)
+
+    def test_batch_gets_dense_seqs_per_conversation(self):
+        other = conversation(self.alice, self.bob)
+        batch = [self.message(self.conv.id), self.message(other.id), self.message(self.conv.id)]
+        persisted, retry = self.writer._persist(batch)
+
+        self.assertEqual(retry, [])
+        self.assertEqual([m.seq for m in persisted if m.conversation_id == self.conv.id], [1, 2])
+        self.assertEqual(Message.objects.filter(conversation=self.conv).count(), 2)
+        self.assertEqual(Conversation.objects.get(id=other.id).last_seq, 1)
+
+    def test_deleted_conversation_does_not_block_the_batch(self):
+        gone = conversation(self.alice, self.bob)
+        gone_id = gone.id
+        gone.delete()
+        with self.assertLogs('chat.writebehind', 'WARNING'):
+            persisted, retry = self.writer._persist([self.message(gone_id), self.message(self.conv.id)])
+
+        self.assertEqual([m.conversation_id for m in persisted], [self.conv.id])
+        self.assertEqual(retry, [])
+        self.assertEqual(self.writer.stats['dropped'], 1)
+        self.assertTrue(Message.objects.filter(conversation=self.conv).exists())
+
+    def test_failing_conversation_is_dead_lettered_after_max_attempts(self):
+        broken = conversation(self.alice, self.bob)
+        allocate_seq = Conversation.allocate_seq
+
+        def flaky(conversation_id, count=1):
+            if conversation_id == broken.id:
+                raise DatabaseError('disk I/O error')
+            return allocate_seq(conversation_id, count)
+
+        stuck = self.message(broken.id)
+        with mock.patch.object(Conversation, 'allocate_seq', side_effect=flaky), \
+                self.assertLogs('chat.writebehind', 'ERROR'):
+            persisted, retry = self.writer._persist([stuck, self.message(self.conv.id)])
+            self.assertEqual(len(persisted), 1)
+            self.assertEqual(retry, [stuck])
+            self.assertIsNone(stuck.seq)
+            self.assertEqual(self.writer._persist(retry), ([], [stuck]))
+            self.assertEqual(self.writer._persist(retry), ([], []))
+
+        self.assertEqual(list(self.writer.dead_letters), [stuck])
+        self.assertEqual(self.writer.stats['dead_lettered'], 1)
+        self.assertFalse(Message.objects.filter(conversation=broken).exists())
+
+    def test_shutdown_retries_then_writes_what_still_fails_to_the_dead_letter_file(self):
+        broken = conversation(self.alice, self.bob)
+        allocate_seq = Conversation.allocate_seq
+        calls = []
+
+        def flaky(conversation_id, count=1):
+            if conversation_id == self.conv.id:
+                calls.append(conversation_id)
+                if len(calls) < 2:
+                    raise DatabaseError('database is locked')
+            if conversation_id == broken.id:
+                raise DatabaseError('disk I/O error')
+            return allocate_seq(conversation_id, count)
+
+        writer = MessageWriteBehind(max_attempts=10, max_delay_ms=1, dead_letter_path=self.dead_letter_path)
+        writer._pending = [self.message(self.conv.id, 'late'), self.message(broken.id, 'stuck')]
+        with mock.patch.object(Conversation, 'allocate_seq', side_effect=flaky), \
+                self.assertLogs('chat.writebehind', 'ERROR'):
+            writer.flush_sync()
+
+        # The transient failure was retried; the persistent one was set aside on disk
+        self.assertEqual(list(Message.objects.filter(conversation=self.conv).values_list('content', flat=True)),
+                         ['late'])
+        lines = self.dead_letter_path.read_text().splitlines()
+        self.assertEqual(len(lines), 1)
+        saved = next(serializers.deserialize('json', lines[0])).object
+        self.assertEqual((saved.conversation_id, saved.content), (broken.id, 'stuck'))
+
+
+class ReadCursorTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        self.messages = [
+            Message.objects.create(conversation=self.conv, sender=self.bob, content=str(n))
+            for n in range(3)
+        ]
+
+    def test_cursor_only_moves_forward(self):
+        first, _, last = self.messages
+        self.assertEqual(advance_read_cursor(self.alice.id, self.conv.id, last.id), last.id)
+        self.assertIsNone(advance_read_cursor(self.alice.id, self.conv.id, first.id))
+        self.assertEqual(read_cursor(self.alice.id, self.conv.id), last.id)
+        self.assertEqual(self.conv.unread_count(self.alice), 0)
+
+    def test_bogus_id_is_clamped_to_the_newest_message(self):
+        stored = advance_read_cursor(self.alice.id, self.conv.id, 999999)
+        self.assertEqual(stored, self.messages[-1].id)
+
+        # The next message is still unread
+        newer = Message.objects.create(conversation=self.conv, sender=self.bob, content='new')
+        self.assertEqual(self.conv.unread_count(self.alice), 1)
+        self.assertEqual(advance_read_cursor(self.alice.id, self.conv.id, newer.id), newer.id)
+
+    def test_id_from_another_conversation_does_not_move_the_cursor(self):
+        other = conversation(self.alice, self.bob)
+        foreign = Message.objects.create(conversation=other, sender=self.bob, content='x')
+        self.assertIsNone(advance_read_cursor(self.alice.id, other.id, self.messages[0].id))
+        self.assertEqual(read_cursor(self.alice.id, other.id), 0)
+        self.assertEqual(advance_read_cursor(self.alice.id, other.id, foreign.id), foreign.id)
+
+    async def test_socket_ack_records_and_returns_the_clamped_id(self):
+        consumer = ChatConsumer()
+        consumer.user = self.alice
+        buffer = ReadCursorBuffer(debounce_ms=10000)
+        with mock.patch('chat.consumers.read_cursors', buffer):
+            stored = await consumer.mark_as_read(self.conv.id, '999999')
+            again = await consumer.mark_as_read(self.conv.id, self.messages[-1].id)
+            junk = await consumer.mark_as_read(self.conv.id, 'abc')
+            await database_sync_to_async(buffer.flush_sync)()
+
+        self.assertEqual(stored, self.messages[-1].id)
+        self.assertIsNone(again)
+        self.assertIsNone(junk)
+        cursor = await database_sync_to_async(read_cursor)(self.alice.id, self.conv.id)
+        self.assertEqual(cursor, self.messages[-1].id)
+
+    async def test_ack_already_flushed_is_not_broadcast_again(self):
+        first, _, last = self.messages
+        buffer = ReadCursorBuffer(debounce_ms=10000, remember=1)
+        self.assertTrue(buffer.advance(self.alice.id, self.conv.id, last.id))
+        await database_sync_to_async(buffer.flush_sync)()
+
+        self.assertFalse(buffer.advance(self.alice.id, self.conv.id, last.id))
+        self.assertFalse(buffer.advance(self.alice.id, self.conv.id, first.id))
+        # Only the most recently flushed cursors are remembered
+        self.assertTrue(buffer.advance(self.bob.id, self.conv.id, last.id))
+        await database_sync_to_async(buffer.flush_sync)()
+        self.assertTrue(buffer.advance(self.alice.id, self.conv.id, last.id))
+        await database_sync_to_async(buffer.flush_sync)()
+
+
+class MembershipCacheTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+
+    def worker(self):
+        """A second process's view of the cache: its own LRU, the shared versions."""
+        return membership.VersionedLRUCache(
+            'user_conversations', membership._load_user_conversations, 100,
+        )
+
+    @override_settings(CHAT_CACHE_VERSION_TTL_MS=0)
+    def test_removal_invalidates_every_worker(self):
+        workers = [self.worker(), self.worker()]
+        for worker in workers:
+            self.assertIn(self.conv.id, worker.get(self.bob.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conv.participants.remove(self.bob)
+
+        for worker in workers:
+            self.assertNotIn(self.conv.id, worker.get(self.bob.id))
+        self.assertFalse(membership.is_member(self.bob, self.conv.id))
+
+    def test_unchanged_membership_is_served_from_the_lru(self):
+        worker = self.worker()
+        worker.get(self.alice.id)
+        worker.get(self.alice.id)
+        self.assertEqual((worker.hits, worker.misses), (1, 1))
+
+    def test_warm_membership_check_runs_no_query(self):
+        membership.is_member(self.alice, self.conv.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(self.alice, self.conv.id))
+
+    @override_settings(CHAT_CACHE_VERSION_TTL_MS=60000)
+    def test_other_workers_writes_are_seen_after_the_version_ttl(self):
+        worker = self.worker()
+        worker.get(self.bob.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conv.participants.remove(self.bob)
+        self.assertIn(self.conv.id, worker.get(self.bob.id))
+        with override_settings(CHAT_CACHE_VERSION_TTL_MS=0):
+            self.assertNotIn(self.conv.id, worker.get(self.bob.id))
+
+
+class CacheVersionsTests(SimpleTestCase):
+    def test_concurrent_sqlite_bumps_never_share_a_version(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        # One store per thread stands in for one per worker process
+        stores = [SQLiteVersions(Path(tmp) / 'versions.sqlite3') for _ in range(4)]
+        seen = []
+
+        def bump(store):
+            seen.extend(store.bump('k') for _ in range(50))
+
+        threads = [threading.Thread(target=bump, args=(store,)) for store in stores]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(seen), list(range(1, 201)))
+        self.assertEqual(stores[0].get('k'), 200)
+
+    def test_cache_counters_need_an_atomic_incr(self):
+        with self.assertRaises(ImproperlyConfigured):
+            CacheVersions()
+
+
+class RecentMessageCacheTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+
+    def test_tail_is_ordered_by_seq(self):
+        later = timezone.now()
+        # Write-behind stamps messages on arrival and numbers them on commit,
+        # so timestamps and seqs can disagree
+        Message.objects.create(conversation=self.conv, sender=self.alice, content='first',
+                               timestamp=later)
+        Message.objects.create(conversation=self.conv, sender=self.bob, content='second',
+                               timestamp=later - timedelta(seconds=1))
+        tail = RecentMessageCache().tail(self.conv.id)
+        self.assertEqual([m.content for m in tail.messages], ['first', 'second'])
+
+    @override_settings(CHAT_CACHE_VERSION_TTL_MS=0)
+    def test_writes_reach_every_worker(self):
+        workers = [RecentMessageCache(), RecentMessageCache()]
+        for worker in workers:
+            self.assertEqual(worker.messages(self.conv.id), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(conversation=self.conv, sender=self.alice, content='hi')
+
+        for worker in workers:
+            self.assertEqual([m.content for m in worker.messages(self.conv.id)], ['hi'])
+
+    @override_settings(CHAT_CACHE_VERSION_TTL_MS=0)
+    def test_interleaved_writes_leave_no_worker_with_a_partial_tail(self):
+        first, second = RecentMessageCache(), RecentMessageCache()
+        for worker in (first, second):
+            self.assertEqual(worker.messages(self.conv.id), [])
+
+        # Each worker saves a message; both rows exist before either bump runs
+        with self.captureOnCommitCallbacks():
+            one = Message.objects.create(conversation=self.conv, sender=self.alice, content='one')
+            two = Message.objects.create(conversation=self.conv, sender=self.bob, content='two')
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.append([one])
+            second.append([two])
+        for apply in callbacks:
+            apply()
+
+        # The first patched its tail from the version it held; the second was
+        # a version behind and dropped its tail instead of patching it
+        self.assertEqual(len(first._tails[self.conv.id].messages), 1)
+        self.assertNotIn(self.conv.id, second._tails)
+        for worker in (first, second):
+            self.assertEqual([m.content for m in worker.messages(self.conv.id)], ['one', 'two'])
+
+    def test_last_message_reads_one_row(self):
+        for n in range(3):
+            Message.objects.create(conversation=self.conv, sender=self.alice, content=str(n))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.conv.last_message.content, '2')
+
+
+# Keep test logins out of the file-based session store
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class LongPollTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        self.first = Message.objects.create(conversation=self.conv, sender=self.bob, content='one')
+        self.url = reverse('chat:messages_http', args=[self.conv.id])
+        self.addCleanup(last_seen.flush_sync)
+
+    async def test_unchanged_poll_gets_304(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(self.url, {'after_id': self.first.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['messages'], [])
+
+        again = await self.async_client.get(self.url, {'after_id': self.first.id},
+                                            headers={'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+    def test_unchanged_poll_loads_the_user_once(self):
+        self.async_client.force_login(self.alice)
+        get = async_to_sync(self.async_client.get)
+        response = get(self.url, {'after_id': self.first.id})
+        with CaptureQueriesContext(connection) as queries:
+            again = get(self.url, {'after_id': self.first.id}, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 304)
+        # Session, user, organization membership, then the conversation's last_seq
+        self.assertEqual(len(queries), 4)
+        self.assertEqual(sum('FROM "auth_user"' in q['sql'] for q in queries), 1)
+
+    async def test_etag_follows_writes_from_other_workers(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(self.url, {'after_id': self.first.id})
+
+        # Another worker's write-behind flush: no signals or events reach this one
+        def flush_elsewhere():
+            message = Message(conversation_id=self.conv.id, sender=self.bob, content='two')
+            with self.captureOnCommitCallbacks(execute=True):
+                MessageWriteBehind()._persist([message])
+
+        await database_sync_to_async(flush_elsewhere)()
+        again = await self.async_client.get(self.url, {'after_id': self.first.id},
+                                            headers={'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual([m['content'] for m in again.json()['messages']], ['two'])
+        self.assertNotEqual(again['ETag'], response['ETag'])
+
+    @override_settings(CHAT_LONG_POLL_RECHECK=0.1)
+    async def test_wait_returns_when_a_message_arrives(self):
+        await self.async_client.aforce_login(self.alice)
+
+        def send():
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(conversation=self.conv, sender=self.bob, content='late')
+
+        async def send_later():
+            await asyncio.sleep(0.3)
+            await database_sync_to_async(send)()
+
+        response, _ = await asyncio.gather(
+            self.async_client.get(self.url, {'after_id': self.first.id, 'wait': 5}),
+            send_later(),
+        )
+        self.assertEqual([m['content'] for m in response.json()['messages']], ['late'])
+
+    async def test_outsider_gets_404(self):
+        outsider = await database_sync_to_async(User.objects.create_user)('eve')
+        await self.async_client.aforce_login(outsider)
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class EventStreamTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        self.client.force_login(self.alice)
+        self.addCleanup(last_seen.flush_sync)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def sqlite_layer(self):
+        return override_settings(CHAT_SSE_HEARTBEAT=0.2, CHANNEL_LAYERS={'default': {
+            'BACKEND': 'chat.layers.SQLiteChannelLayer',
+            'CONFIG': {'path': str(Path(self.tmp) / 'layer.sqlite3')},
+        }})
+
+    def test_wsgi_stream_is_refused_without_a_shared_layer(self):
+        response = self.client.get(reverse('chat:event_stream'), {'conversation': self.conv.id})
+        self.assertEqual(response.status_code, 503)
+
+    def test_concurrent_wsgi_streams_each_get_the_event(self):
+        with self.sqlite_layer():
+            responses = [
+                self.client.get(reverse('chat:event_stream'), {'conversation': self.conv.id})
+                for _ in range(2)
+            ]
+            subscribed = threading.Barrier(3, timeout=10)
+            received = {}
+
+            def read(index, response):
+                for chunk in response.streaming_content:
+                    chunk = chunk.decode()
+                    if '"subscribed"' in chunk:
+                        subscribed.wait()
+                    elif chunk.startswith('id:') or chunk.startswith('data:'):
+                        received[index] = json.loads(chunk.split('data: ', 1)[1])
+                        return
+
+            readers = [
+                threading.Thread(target=read, args=(index, response))
+                for index, response in enumerate(responses)
+            ]
+            for reader in readers:
+                reader.start()
+            subscribed.wait()
+            async_to_sync(get_channel_layer().group_send)(
+                conversation_group(self.conv.id),
+                conversation_event(self.conv.id, 'chat_message', {'type': 'chat_message', 'message': 'hi'}),
+            )
+            for reader in readers:
+                reader.join(10)
+            for response in responses:
+                response.close()
+
+        self.assertEqual([received[i]['message'] for i in (0, 1)], ['hi', 'hi'])
+        # Both streams stamped the one event with the same replay position
+        self.assertEqual(received[0]['seq'], received[1]['seq'])
+
+    async def opening_frames(self, **resume):
+        """Frames a conversation stream sends before it starts waiting for events."""
+        chunks = sse.event_stream(self.alice, self.conv.id, **resume)
+        frames = []
+        try:
+            async for chunk in chunks:
+                if chunk.startswith(('id:', 'data:')):
+                    frames.append(json.loads(chunk.split('data: ', 1)[1]))
+                    if frames[-1]['type'] == 'subscribed':
+                        return frames
+        finally:
+            await chunks.aclose()
+
+    async def test_last_event_id_replays_what_was_missed(self):
+        buffer = replay.join(self.conv.id)
+        self.addCleanup(replay.leave, self.conv.id)
+        # A stream from the test before may still hold this conversation's buffer
+        seen = buffer.seq + 1
+        for n in range(3):
+            replay.record(conversation_event(self.conv.id, 'chat_message', {'type': 'message', 'n': n}))
+        frames = await self.opening_frames(last_event_id=f'{buffer.epoch}:{seen}')
+        self.assertEqual([(f['type'], f.get('n')) for f in frames],
+                         [('message', 1), ('message', 2), ('subscribed', None)])
+        self.assertEqual(frames[-1]['replayed'], 2)
+
+    async def test_unknown_event_id_resyncs_from_the_database(self):
+        create = database_sync_to_async(Message.objects.create)
+        first = await create(conversation=self.conv, sender=self.bob, content='one')
+        await create(conversation=self.conv, sender=self.bob, content='two')
+        frames = await self.opening_frames(last_event_id='gone:4', after_seq=first.seq)
+        self.assertEqual([f['type'] for f in frames], ['resync', 'subscribed'])
+        self.assertEqual([m['content'] for m in frames[0]['messages']], ['two'])
+
+    def test_event_ids_carry_the_message_position(self):
+        first = Message.objects.create(conversation=self.conv, sender=self.bob, content='one')
+        with self.sqlite_layer():
+            response = self.client.get(reverse('chat:event_stream'), {'conversation': self.conv.id})
+            event_id = next(c.decode() for c in response.streaming_content if c.startswith(b'id:'))
+            response.close()
+        self.assertEqual(sse.parse_event_id(event_id.split()[1])[2], first.seq)
+
+    async def test_position_in_the_event_id_wins_over_a_stale_after_seq(self):
+        create = database_sync_to_async(Message.objects.create)
+        first = await create(conversation=self.conv, sender=self.bob, content='one')
+        await create(conversation=self.conv, sender=self.bob, content='two')
+        # EventSource reconnects with its first URL, so after_seq is whatever it was then
+        frames = await self.opening_frames(last_event_id=f'gone:4:{first.seq}', after_seq=0)
+        self.assertEqual([m['content'] for m in frames[0]['messages']], ['two'])
+        self.assertFalse(frames[0]['truncated'])
+
+    @override_settings(CHAT_REPLAY_BUFFER_SIZE=2)
+    async def test_resync_without_a_position_sends_the_newest_page(self):
+        create = database_sync_to_async(Message.objects.create)
+        for content in ('one', 'two', 'three'):
+            await create(conversation=self.conv, sender=self.bob, content=content)
+        frames = await self.opening_frames(last_event_id='gone:4')
+        self.assertEqual([m['content'] for m in frames[0]['messages']], ['two', 'three'])
+        # The client may be missing 'one' and anything before it
+        self.assertTrue(frames[0]['truncated'])
+
+
+class StalledSocket(OutboundQueueMixin, AsyncWebsocketConsumer):
+    """A socket whose server send blocks once the client stops reading, like uvicorn's."""
+
+    def __init__(self):
+        super().__init__()
+        self.scope = {'user': None}
+        self.channel_name = 'test.socket'
+        self.stalled = asyncio.Event()
+        self.delivered = []
+        self.close_code = None
+
+    async def base_send(self, message):
+        if message['type'] == 'websocket.close':
+            self.close_code = message.get('code')
+            return
+        if self.stalled.is_set():
+            await asyncio.Event().wait()
+        self.delivered.append(message['text'])
+
+
+@override_settings(CHAT_OUTBOUND_MAX_MESSAGES=5)
+class OutboundQueueTests(SimpleTestCase):
+    async def test_frames_reach_a_reading_client_in_order(self):
+        socket = StalledSocket()
+        for n in range(20):
+            await socket.send(text_data=str(n))
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.05)
+        self.assertEqual(socket.delivered, [str(n) for n in range(20)])
+        self.assertIsNone(socket.close_code)
+
+    async def test_stalled_client_is_closed_with_a_resume_hint(self):
+        socket = StalledSocket()
+        socket.stalled.set()
+        with mock.patch('chat.outbound.RESUME_HINT_TIMEOUT', 0.05), self.assertLogs('chat.outbound', 'WARNING'):
+            for n in range(10):
+                await socket.send(text_data=str(n))
+                await asyncio.sleep(0)
+        self.assertEqual(socket.close_code, 4008)
+        self.assertIsNone(socket._writer)
+
+    async def test_ephemeral_frames_are_coalesced_while_stalled(self):
+        socket = StalledSocket()
+        socket.stalled.set()
+        await socket.send(text_data='first')
+        await asyncio.sleep(0)  # The writer takes 'first' and blocks on it
+        for n in range(50):
+            await socket.send(text_data=f'typing {n}', coalesce='typing')
+        self.assertEqual(len(socket.outbox), 1)
+        self.assertEqual(socket.outbox.coalesced, 49)
+        self.assertIsNone(socket.close_code)
+        socket._stop_writer()
+
+
+class OnlineTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.store = MemoryPresenceStore()
+        self.write_status = mock.AsyncMock()
+        for patcher in (mock.patch('chat.online.presence_store', self.store),
+                        mock.patch('chat.online.write_status', self.write_status)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def beat(self, seconds_ago):
+        await self.store.add('presence', 'other-worker', 1, {'user_id': 1})
+        user_id, entry, expires = self.store._rows['other-worker', 'presence']
+        self.store._rows['other-worker', 'presence'] = (user_id, entry, expires - seconds_ago)
+
+    async def test_last_socket_closing_writes_offline(self):
+        tracker = OnlineTracker(grace_seconds=0)
+        await tracker.connected(1)
+        await tracker.disconnected(1)
+        self.assertEqual(self.write_status.await_args_list, [mock.call(1, True), mock.call(1, False)])
+
+    async def test_fresh_socket_elsewhere_keeps_the_user_online(self):
+        tracker = OnlineTracker(grace_seconds=0, fresh_seconds=40)
+        await self.beat(seconds_ago=5)
+        await tracker.connected(1)
+        await tracker.disconnected(1)
+        self.assertEqual(self.write_status.await_args_list, [mock.call(1, True)])
+        self.assertEqual(tracker.stats()['going_offline'], 1)
+        tracker._going_offline.pop(1).cancel()
+
+    async def test_stale_socket_elsewhere_is_not_trusted(self):
+        tracker = OnlineTracker(grace_seconds=0, fresh_seconds=40)
+        await self.beat(seconds_ago=60)  # Not expired yet (TTL 75), but quiet too long
+        await tracker.connected(1)
+        await tracker.disconnected(1)
+        self.assertEqual(self.write_status.await_args, mock.call(1, False))
+
+    async def test_socket_that_stops_beating_is_rechecked(self):
+        tracker = OnlineTracker(grace_seconds=0, fresh_seconds=40)
+        await self.beat(seconds_ago=39.9)
+        await tracker.connected(1)
+        await tracker.disconnected(1)
+        self.assertEqual(self.write_status.await_count, 1)
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.write_status.await_args, mock.call(1, False))
+        self.assertEqual(tracker.stats()['going_offline'], 0)
+
+    async def test_reconnecting_cancels_the_recheck(self):
+        tracker = OnlineTracker(grace_seconds=0, fresh_seconds=40)
+        await self.beat(seconds_ago=39.9)
+        await tracker.connected(1)
+        await tracker.disconnected(1)
+        await tracker.connected(1)
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.write_status.await_args_list, [mock.call(1, True)])
+
+    async def test_reconnecting_during_the_heartbeat_lookup_stays_online(self):
+        tracker = OnlineTracker(grace_seconds=0.01)
+        looking_up, reconnected = asyncio.Event(), asyncio.Event()
+
+        async def slow_lookup(user_id):
+            looking_up.set()
+            await reconnected.wait()
+            return None
+
+        await tracker.connected(1)
+        await tracker.disconnected(1)
+        with mock.patch.object(self.store, 'last_heartbeat', side_effect=slow_lookup):
+            await looking_up.wait()
+            await tracker.connected(1)
+            reconnected.set()
+            await asyncio.sleep(0.05)
+        self.assertEqual(self.write_status.await_args_list, [mock.call(1, True), mock.call(1, True)])
+        self.assertEqual(tracker.stats(), {'users': 1, 'sockets': 1, 'going_offline': 0})
+
+
+class PresenceStoreHeartbeatTests(SimpleTestCase):
+    async def check_last_heartbeat(self, store):
+        self.assertIsNone(await store.last_heartbeat(1))
+        before = time.time()
+        await store.add('presence', 'a', 1, {'user_id': 1})
+        await store.add('presence', 'b', 2, {'user_id': 2})
+        self.assertGreaterEqual(await store.last_heartbeat(1), before - 0.01)
+        await store.remove('a')
+        self.assertIsNone(await store.last_heartbeat(1))
+
+    async def test_memory_store(self):
+        await self.check_last_heartbeat(MemoryPresenceStore())
+
+    async def test_sqlite_store(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        store = SQLitePresenceStore(Path(path) / 'presence.sqlite3')
+        self.addCleanup(store._executor.shutdown)
+        await self.check_last_heartbeat(store)
+
+
+class GroupEventTests(SimpleTestCase):
+    def test_frame_is_encoded_once_with_metadata_alongside(self):
+        event = group_event('typing_indicator', {'type': 'typing'}, username='alice', coalesce='k')
+        self.assertEqual(event, {
+            'type': 'typing_indicator', 'text': '{"type": "typing"}', 'username': 'alice', 'coalesce': 'k',
+        })
+
+    def test_conversation_events_are_tagged_and_unique(self):
+        first = conversation_event('7', 'chat_message', {'type': 'message'})
+        second = conversation_event('7', 'chat_message', {'type': 'message'})
+        self.assertEqual(json.loads(first['text']), {'type': 'message', 'conversation_id': 7})
+        self.assertEqual(first['conversation_id'], 7)
+        self.assertNotEqual(first['eid'], second['eid'])
+
+
+class ChatSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+
+    async def test_recipients_forward_the_encoded_text_unchanged(self):
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, f'/ws/chat/{self.conv.id}/')
+            bob = await connect(self.bob, f'/ws/chat/{self.conv.id}/')
+            # Compact separators: a handler that re-encoded the frame would add spaces
+            text = '{"type":"note","conversation_id":%d}' % self.conv.id
+            await get_channel_layer().group_send(conversation_group(self.conv.id),
+                                                 {'type': 'chat_message', 'text': text})
+            for socket in (alice, bob):
+                while (received := await socket.receive_from(timeout=2)) != text:
+                    self.assertNotIn('"note"', received)
+
+    async def test_message_reaches_every_participant_identically(self):
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, f'/ws/chat/{self.conv.id}/')
+            bob = await connect(self.bob, f'/ws/chat/{self.conv.id}/')
+            await alice.send_to(text_data=json.dumps({'type': 'message', 'content': 'hi'}))
+            sent, received = await self.frame(alice, 'message'), await self.frame(bob, 'message')
+        self.assertEqual(sent, received)
+        self.assertEqual(received['message']['content'], 'hi')
+
+    async def test_outsider_is_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conv.id}/')
+        communicator.scope['user'] = await database_sync_to_async(User.objects.create_user)('eve')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class MultiplexSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.first = conversation(self.alice, self.bob)
+        self.second = conversation(self.alice, self.bob)
+
+    async def test_one_socket_carries_several_conversations(self):
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/stream/')
+            bob = await connect(self.bob, '/ws/stream/')
+            for conv in (self.first, self.second):
+                await alice.send_json_to({'type': 'subscribe', 'conversation_id': conv.id})
+                await self.frame(alice, 'subscribed')
+                await bob.send_json_to({'type': 'subscribe', 'conversation_id': conv.id})
+                await self.frame(bob, 'subscribed')
+
+            await bob.send_json_to({'type': 'message', 'conversation_id': self.second.id, 'content': 'hi'})
+            message = await self.frame(alice, 'message')
+        self.assertEqual(message['conversation_id'], self.second.id)
+        self.assertEqual(message['message']['content'], 'hi')
+
+    async def test_sidebar_update_reaches_unsubscribed_participants(self):
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/stream/')
+            bob = await connect(self.bob, '/ws/stream/')
+            await bob.send_json_to({'type': 'subscribe', 'conversation_id': self.first.id})
+            await self.frame(bob, 'subscribed')
+            await bob.send_json_to({'type': 'message', 'conversation_id': self.first.id, 'content': 'hi'})
+            sidebar = await self.frame(alice, 'sidebar')
+        self.assertEqual(sidebar['conversation_id'], self.first.id)
+        self.assertEqual(sidebar['message']['content'], 'hi')
+
+    async def test_frames_for_other_conversations_are_refused(self):
+        outsider_conv = await database_sync_to_async(conversation)(self.bob)
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/stream/')
+            await alice.send_json_to({'type': 'subscribe', 'conversation_id': outsider_conv.id})
+            error = await self.frame(alice, 'error')
+            # Not subscribed, so the message is dropped
+            await alice.send_json_to({'type': 'message', 'conversation_id': outsider_conv.id, 'content': 'hi'})
+            await alice.send_json_to({'type': 'heartbeat'})
+            await self.frame(alice, 'heartbeat_ack')
+        self.assertEqual(error['error'], 'not_a_participant')
+        self.assertFalse(await Message.objects.filter(conversation=outsider_conv).aexists())
+
+    async def test_unsubscribe_stops_the_stream(self):
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/stream/')
+            await alice.send_json_to({'type': 'subscribe', 'conversation_id': self.first.id})
+            await self.frame(alice, 'subscribed')
+            await alice.send_json_to({'type': 'unsubscribe', 'conversation_id': self.first.id})
+            await self.frame(alice, 'unsubscribed')
+            await get_channel_layer().group_send(conversation_group(self.first.id), conversation_event(
+                self.first.id, 'chat_message', {'type': 'message'}))
+            self.assertNotIn('message', await self.frame_types(alice))
+
+
+class ReactionTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        self.message = Message.objects.create(conversation=self.conv, sender=self.alice, content='hi')
+
+    def toggle(self, user, emoji, message=None):
+        return toggle_reaction(user, self.conv.id, (message or self.message).id, emoji)
+
+    def test_toggling_adds_then_removes(self):
+        self.assertEqual(self.toggle(self.alice, '👍'), (True, {'👍': 1}, self.message.seq))
+        self.assertEqual(self.toggle(self.alice, '👍'), (False, {}, self.message.seq))
+        self.assertFalse(Reaction.objects.exists())
+
+    def test_summary_counts_every_user_in_first_reaction_order(self):
+        self.toggle(self.alice, '🎉')
+        self.toggle(self.alice, '👍')
+        added, counts, _ = self.toggle(self.bob, '👍')
+        self.assertTrue(added)
+        self.assertEqual(list(counts.items()), [('🎉', 1), ('👍', 2)])
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.reactions, counts)
+        self.assertEqual(my_reactions(self.bob, [self.message.id]), {self.message.id: {'👍'}})
+
+    def test_summary_is_recomputed_from_rows(self):
+        # A stale summary (e.g. from a lost read-modify-write) does not survive a toggle
+        Message.objects.filter(id=self.message.id).update(reactions={'👍': 7})
+        self.assertEqual(self.toggle(self.bob, '👍')[1], {'👍': 1})
+
+    def test_message_outside_the_conversation_is_refused(self):
+        other = Message.objects.create(conversation=conversation(self.alice), sender=self.alice, content='x')
+        self.assertIsNone(self.toggle(self.alice, '👍', message=other))
+        self.assertIsNone(self.toggle(self.alice, 'x' * 33))
+        self.assertFalse(Reaction.objects.exists())
+
+
+class ReplayBufferTests(SimpleTestCase):
+    def test_resume_returns_what_was_missed(self):
+        buffer = replay.ReplayBuffer(size=10)
+        for n in range(3):
+            stamped = buffer.record(f'e{n}', '{"n": %d}' % n)
+        self.assertEqual(json.loads(stamped), {'n': 2, 'seq': 3, 'epoch': buffer.epoch})
+        self.assertEqual([json.loads(t)['n'] for t in buffer.since(buffer.epoch, 1)], [1, 2])
+        self.assertEqual(buffer.since(buffer.epoch, 3), [])
+
+    def test_one_event_is_numbered_once(self):
+        buffer = replay.ReplayBuffer(size=10)
+        self.assertEqual(buffer.record('e', '{}'), buffer.record('e', '{}'))
+        self.assertEqual(buffer.seq, 1)
+
+    def test_gaps_it_cannot_cover_need_a_resync(self):
+        buffer = replay.ReplayBuffer(size=2)
+        for n in range(5):
+            buffer.record(f'e{n}', '{}')
+        self.assertIsNone(buffer.since(buffer.epoch, 1))   # Rolled out of the ring
+        self.assertEqual(len(buffer.since(buffer.epoch, 3)), 2)
+        self.assertIsNone(buffer.since('other', 3))        # Another process or buffer
+        self.assertIsNone(buffer.since(buffer.epoch, 9))   # Ahead of this buffer
+
+    def test_buffer_is_dropped_with_its_last_subscriber(self):
+        epoch = replay.join(4242).epoch
+        replay.join(4242)
+        replay.leave(4242)
+        self.assertEqual(replay.position(4242), (epoch, 0))
+        replay.leave(4242)
+        self.assertEqual(replay.position(4242), (None, 0))
+        self.assertNotEqual(replay.join(4242).epoch, epoch)
+        replay.leave(4242)
+
+    def test_ephemeral_events_are_not_stamped(self):
+        replay.join(4243)
+        self.addCleanup(replay.leave, 4243)
+        typing = conversation_event(4243, 'typing_indicator', {'type': 'typing'}, coalesce='typing')
+        self.assertEqual(replay.record(typing), typing['text'])
+        message = conversation_event(4243, 'chat_message', {'type': 'message'})
+        self.assertEqual(json.loads(replay.record(message))['seq'], 1)
+
+
+class ResumeSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+
+    async def subscribe(self, socket, **extra):
+        await socket.send_json_to({'type': 'subscribe', 'conversation_id': self.conv.id, **extra})
+        return await self.frame(socket, 'subscribed')
+
+    async def test_reconnecting_client_gets_missed_events(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/stream/')
+            await self.subscribe(bob)
+            alice = await connect(self.alice, '/ws/stream/')
+            await self.subscribe(alice)
+            await bob.send_json_to({'type': 'message', 'conversation_id': self.conv.id, 'content': 'one'})
+            seen = await self.frame(alice, 'message')
+            await self.frame(bob, 'message')
+            await alice.disconnect()
+
+            await bob.send_json_to({'type': 'message', 'conversation_id': self.conv.id, 'content': 'two'})
+            await self.frame(bob, 'message')
+            alice = await connect(self.alice, '/ws/stream/')
+            await alice.send_json_to({'type': 'subscribe', 'conversation_id': self.conv.id,
+                                      'resume': {'epoch': seen['epoch'], 'seq': seen['seq']}})
+            missed = await self.frame(alice, 'message')
+            subscribed = await self.frame(alice, 'subscribed')
+        self.assertEqual(missed['message']['content'], 'two')
+        self.assertEqual(missed['seq'], seen['seq'] + 1)
+        self.assertEqual(subscribed['replayed'], 1)
+        self.assertEqual(subscribed['seq'], missed['seq'])
+
+    async def test_unknown_epoch_resyncs_from_the_database(self):
+        first = await database_sync_to_async(Message.objects.create)(
+            conversation=self.conv, sender=self.bob, content='one')
+        await database_sync_to_async(Message.objects.create)(
+            conversation=self.conv, sender=self.bob, content='two')
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/stream/')
+            await alice.send_json_to({'type': 'subscribe', 'conversation_id': self.conv.id,
+                                      'resume': {'epoch': 'gone', 'seq': 5}, 'after_seq': first.seq})
+            resync = await self.frame(alice, 'resync')
+            subscribed = await self.frame(alice, 'subscribed')
+        self.assertEqual([m['content'] for m in resync['messages']], ['two'])
+        self.assertFalse(resync['truncated'])
+        self.assertEqual(subscribed['replayed'], 0)
+
+    @override_settings(CHAT_REPLAY_BUFFER_SIZE=2)
+    async def test_resync_without_after_seq_sends_the_newest_page(self):
+        for content in ('one', 'two', 'three'):
+            await database_sync_to_async(Message.objects.create)(
+                conversation=self.conv, sender=self.bob, content=content)
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/stream/')
+            await alice.send_json_to({'type': 'subscribe', 'conversation_id': self.conv.id,
+                                      'resume': {'epoch': 'gone', 'seq': 5}})
+            resync = await self.frame(alice, 'resync')
+        self.assertEqual([m['content'] for m in resync['messages']], ['two', 'three'])
+        self.assertTrue(resync['truncated'])
+
+    async def test_conversation_socket_resumes_from_its_query_string(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/stream/')
+            await self.subscribe(bob)
+            alice = await connect(self.alice, f'/ws/chat/{self.conv.id}/')
+            await bob.send_json_to({'type': 'message', 'conversation_id': self.conv.id, 'content': 'one'})
+            seen = await self.frame(alice, 'message')
+            await self.frame(bob, 'message')
+            await alice.disconnect()
+
+            await bob.send_json_to({'type': 'message', 'conversation_id': self.conv.id, 'content': 'two'})
+            await self.frame(bob, 'message')
+            alice = await connect(self.alice, f'/ws/chat/{self.conv.id}/?epoch={seen["epoch"]}&seq={seen["seq"]}')
+            missed = await self.frame(alice, 'message')
+            subscribed = await self.frame(alice, 'subscribed')
+        self.assertEqual(missed['message']['content'], 'two')
+        self.assertEqual(subscribed['replayed'], 1)
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class MessageSeqTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        self.addCleanup(last_seen.flush_sync)
+
+    def send(self, content, conv=None):
+        return Message.objects.create(conversation=conv or self.conv, sender=self.alice, content=content)
+
+    def test_seqs_are_dense_per_conversation(self):
+        other = conversation(self.alice)
+        seqs = [self.send('a').seq, self.send('b', other).seq, self.send('c').seq, self.send('d').seq]
+        self.assertEqual(seqs, [1, 1, 2, 3])
+        self.assertEqual(Conversation.objects.get(id=self.conv.id).last_seq, 3)
+
+    def test_rolled_back_insert_gives_its_seq_back(self):
+        self.send('a')
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            self.send('lost')
+            raise DatabaseError
+        self.assertEqual(self.send('b').seq, 2)
+
+    def test_gap_repair_returns_exactly_the_missing_range(self):
+        for n in range(6):
+            self.send(str(n))
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse('chat:messages_http', args=[self.conv.id]),
+                                   {'after_seq': 2, 'until_seq': 4})
+        self.assertEqual([m['seq'] for m in response.json()['messages']], [3, 4])
+
+
+@override_settings(CHAT_PRESENCE_WINDOW_MS=0)
+class PresenceSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    async def test_snapshot_once_then_deltas(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/presence/')
+            await self.frame(bob, 'presence_snapshot')
+            alice = await connect(self.alice, '/ws/presence/')
+            snapshot = await self.frame(alice, 'presence_snapshot')
+            joined = await self.delta(bob, self.alice)
+
+            await alice.disconnect()
+            left = await self.delta(bob, self.alice)
+        self.assertIn(self.bob.id, [u['user_id'] for u in snapshot['users']])
+        self.assertNotIn(self.alice.id, [u['user_id'] for u in snapshot['users']])
+        self.assertEqual(([u['user_id'] for u in joined['joined']], joined['left']), ([self.alice.id], []))
+        self.assertEqual((left['joined'], left['left']), ([], [self.alice.id]))
+        self.assertEqual(left['version'], joined['version'] + 1)
+
+    async def test_second_socket_of_a_user_sends_no_delta(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/presence/')
+            await connect(self.alice, '/ws/presence/')
+            await self.delta(bob, self.alice)
+            await self.delta(bob, self.alice, 'nearby')
+            second = await connect(self.alice, '/ws/presence/')
+            await second.disconnect()
+            self.assertNotIn('presence_delta', await self.frame_types(bob))
+
+
+class PresenceDeltaTests(SimpleTestCase):
+    def setUp(self):
+        self.store = MemoryPresenceStore()
+        patcher = mock.patch('chat.presence.presence_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def deltas(self, group, changes):
+        """Frames the group broadcasts while ``changes`` runs."""
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(group.group_name, channel)
+        await changes()
+        frames = []
+        while True:
+            try:
+                event = await asyncio.wait_for(layer.receive(channel), 0.1)
+            except asyncio.TimeoutError:
+                return frames
+            frames.append(json.loads(event['text']))
+
+    async def test_deltas_are_versioned(self):
+        group = PresenceGroup('presence.org-delta', window_ms=0)
+
+        async def changes():
+            await group.join({'user_id': 1})
+            await group.leave({'user_id': 1})
+
+        frames = await self.deltas(group, changes)
+        self.assertEqual([(f['version'], f['joined'], f['left']) for f in frames],
+                         [(1, [{'user_id': 1}], []), (2, [], [1])])
+
+    async def test_changes_inside_a_window_are_merged(self):
+        group = PresenceGroup('presence.org-merged', window_ms=30)
+
+        async def changes():
+            for user_id in (1, 2, 3):
+                await group.join({'user_id': user_id})
+            await group.leave({'user_id': 2})
+
+        frames = await self.deltas(group, changes)
+        self.assertEqual([([u['user_id'] for u in f['joined']], f['left']) for f in frames], [([1, 3], [])])
+
+    async def test_join_and_leave_inside_a_window_cancel_out(self):
+        group = PresenceGroup('presence.org-cancelled', window_ms=30)
+
+        async def changes():
+            await group.join({'user_id': 1})
+            await group.leave({'user_id': 1})
+
+        self.assertEqual(await self.deltas(group, changes), [])
+        self.assertEqual(await self.store.version(group.group_name), 0)
+
+    async def test_reconnect_inside_a_window_sends_only_a_changed_entry(self):
+        group = PresenceGroup('presence.org-reload', window_ms=30)
+
+        async def reload():
+            await group.leave({'user_id': 1, 'avatar': 'a'})
+            await group.join({'user_id': 1, 'avatar': 'a'})
+
+        async def new_avatar():
+            await group.leave({'user_id': 1, 'avatar': 'a'})
+            await group.join({'user_id': 1, 'avatar': 'b'})
+
+        self.assertEqual(await self.deltas(group, reload), [])
+        frames = await self.deltas(group, new_avatar)
+        self.assertEqual([(f['joined'], f['left']) for f in frames], [([{'user_id': 1, 'avatar': 'b'}], [])])
+
+
+class PresencePartitionTests(SimpleTestCase):
+    def test_unscoped_partitions_are_per_organization(self):
+        with self.settings(CHAT_PRESENCE_NETWORK_SCOPE=None):
+            self.assertEqual(presence_group_name(3, '10.0.0.7'), 'presence.org-3')
+            self.assertEqual(presence_group_name(None, '10.0.0.7'), 'presence.org-none')
+
+    @override_settings(CHAT_PRESENCE_NETWORK_SCOPE='subnet', CHAT_PRESENCE_SUBNET_PREFIX=24)
+    def test_subnet_scope(self):
+        self.assertEqual(presence_group_name(3, '10.0.0.7'), presence_group_name(3, '10.0.0.200'))
+        self.assertEqual(presence_group_name(3, '10.0.0.7'), 'presence.org-3.net-10.0.0.0')
+        self.assertNotEqual(presence_group_name(3, '10.0.1.7'), presence_group_name(3, '10.0.0.7'))
+        self.assertEqual(network_key('2001:db8::1'), network_key('2001:db8::ffff'))
+        self.assertEqual(network_key('not an ip'), 'unknown')
+
+    def test_nearby_partitions_are_per_ip(self):
+        self.assertEqual(nearby_group_name(3, '10.0.0.7'), 'nearby.org-3.net-10.0.0.7')
+        self.assertEqual(nearby_group_name(None, '2001:db8::1'),
+                         'nearby.org-none.net-2001-0db8-0000-0000-0000-0000-0000-0001')
+
+
+@override_settings(CHAT_PRESENCE_WINDOW_MS=0)
+class PresencePartitionSocketTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+        org = Organization.objects.create(name='Acme', slug='acme', nearby_mode_enabled=False)
+        OrganizationMembership.objects.create(organization=org, user=self.carol)
+
+    async def test_other_organizations_see_nothing(self):
+        async with self.sockets() as connect:
+            carol = await connect(self.carol, '/ws/presence/')
+            types = await self.frame_types(carol)
+            await connect(self.alice, '/ws/presence/')
+            types += await self.frame_types(carol)
+        self.assertEqual(types, ['presence_snapshot', 'presence_delta'])  # Only her own join
+
+    @override_settings(CHAT_PRESENCE_NETWORK_SCOPE='ip')
+    async def test_network_scope_splits_an_organization(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/presence/', ip='10.0.0.1')
+            await connect(self.alice, '/ws/presence/', ip='10.0.0.2')
+            await connect(self.alice, '/ws/presence/', ip='10.0.0.1')
+            joined = await self.delta(bob, self.alice)
+        self.assertEqual(joined['joined'][0]['ip'], '10.0.0.1')
+
+
+class PresenceStoreContract:
+    """Behaviour both presence stores share; subclasses provide make_store()."""
+
+    async def test_first_and_last_socket_of_a_user(self):
+        store = self.make_store()
+        self.assertTrue(await store.add('g', 'a1', 1, {'user_id': 1}))
+        self.assertFalse(await store.add('g', 'a2', 1, {'user_id': 1}))
+        self.assertTrue(await store.add('other', 'a2', 1, {'user_id': 1}))
+        self.assertEqual(await store.remove('a1'), [('g', {'user_id': 1}, False)])
+        self.assertCountEqual(await store.remove('a2'), [('g', {'user_id': 1}, True),
+                                                       ('other', {'user_id': 1}, True)])
+
+    async def test_one_entry_per_live_user(self):
+        store = self.make_store()
+        await store.add('g', 'a1', 1, {'user_id': 1})
+        await store.add('g', 'a2', 1, {'user_id': 1})
+        await store.add('g', 'b1', 2, {'user_id': 2})
+        with self.settings(CHAT_PRESENCE_TTL=0):
+            await store.add('g', 'c1', 3, {'user_id': 3})
+        self.assertCountEqual(await store.users('g'), [{'user_id': 1}, {'user_id': 2}])
+
+    async def test_sweep_reports_users_whose_sockets_all_expired(self):
+        store = self.make_store()
+        await store.add('g', 'a1', 1, {'user_id': 1})
+        with self.settings(CHAT_PRESENCE_TTL=0):
+            await store.add('g', 'a2', 1, {'user_id': 1})
+            await store.add('g', 'b1', 2, {'user_id': 2})
+            # A heartbeat renews the socket; this one beats too late
+            await store.touch('b1')
+        self.assertEqual(await store.sweep(), [('g', {'user_id': 2})])
+        self.assertEqual(await store.users('g'), [{'user_id': 1}])
+        self.assertEqual(await store.sweep(), [])
+
+    async def test_versions_count_up_per_group(self):
+        store = self.make_store()
+        self.assertEqual(await store.version('g'), 0)
+        self.assertEqual([await store.next_version('g'), await store.next_version('g')], [1, 2])
+        self.assertEqual(await store.version('g'), 2)
+        self.assertEqual(await store.version('other'), 0)
+
+
+class MemoryPresenceStoreTests(PresenceStoreContract, SimpleTestCase):
+    def make_store(self):
+        return MemoryPresenceStore()
+
+
+class SQLitePresenceStoreTests(PresenceStoreContract, SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def make_store(self):
+        store = SQLitePresenceStore(Path(self.tmp) / 'presence.sqlite3')
+        self.addCleanup(store._executor.shutdown)
+        return store
+
+    async def test_workers_share_sockets_and_versions(self):
+        first, second = self.make_store(), self.make_store()
+        self.assertTrue(await first.add('g', 'a1', 1, {'user_id': 1}))
+        self.assertFalse(await second.add('g', 'a2', 1, {'user_id': 1}))
+        self.assertEqual(await second.users('g'), [{'user_id': 1}])
+        await first.next_version('g')
+        self.assertEqual(await second.next_version('g'), 2)
+        # The other worker's socket still counts
+        self.assertEqual(await second.remove('a2'), [('g', {'user_id': 1}, False)])
+
+
+@override_settings(CHAT_PRESENCE_WINDOW_MS=0)
+class NearbyPushTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    async def test_devices_on_the_same_network_are_pushed(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/presence/', ip='10.0.0.1', device='Phone')
+            await self.frame(bob, 'nearby_snapshot')
+            alice = await connect(self.alice, '/ws/presence/', ip='10.0.0.1', device='Laptop')
+            snapshot = await self.frame(alice, 'nearby_snapshot')
+            joined = await self.delta(bob, self.alice, 'nearby')
+            await alice.disconnect()
+            left = await self.delta(bob, self.alice, 'nearby')
+        self.assertEqual([(u['user_id'], u['device_name']) for u in snapshot['users']], [(self.bob.id, 'Phone')])
+        self.assertEqual([(u['user_id'], u['device_name']) for u in joined['joined']], [(self.alice.id, 'Laptop')])
+        self.assertEqual(left['left'], [self.alice.id])
+
+    async def test_other_networks_are_not_nearby(self):
+        async with self.sockets() as connect:
+            bob = await connect(self.bob, '/ws/presence/', ip='10.0.0.1')
+            await connect(self.alice, '/ws/presence/', ip='10.0.0.2')
+            # Everyone shares the unscoped presence partition
+            await self.delta(bob, self.alice)
+            await bob.send_json_to({'type': 'nearby_sync'})
+            snapshot = await self.frame(bob, 'nearby_snapshot')
+            self.assertNotIn('nearby_delta', await self.frame_types(bob))
+        self.assertEqual(snapshot['users'], [])
+
+    async def test_organizations_with_nearby_off_get_no_nearby_frames(self):
+        org = await Organization.objects.acreate(name='Acme', slug='acme', nearby_mode_enabled=False)
+        await OrganizationMembership.objects.acreate(organization=org, user=self.alice)
+        async with self.sockets() as connect:
+            alice = await connect(self.alice, '/ws/presence/', ip='10.0.0.1')
+            await alice.send_json_to({'type': 'nearby_sync'})
+            types = await self.frame_types(alice)
+        self.assertNotIn('nearby_snapshot', types)
+        self.assertIn('presence_snapshot', types)
+
+
+class InboxTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+
+    def row(self, user, conv=None):
+        return ConversationMember.objects.get(user=user, conversation=conv or self.conv)
+
+    def send(self, sender, content):
+        return Message.objects.create(conversation=self.conv, sender=sender, content=content)
+
+    def test_rows_are_created_with_the_peer(self):
+        self.assertEqual(self.row(self.alice).peer_id, self.bob.id)
+        self.assertEqual(self.row(self.bob).peer_id, self.alice.id)
+
+    def test_messages_move_into_every_row(self):
+        self.send(self.alice, 'one')
+        last = self.send(self.bob, 'two' * 50)
+        for user in (self.alice, self.bob):
+            row = self.row(user)
+            self.assertEqual((row.last_message_id, row.last_activity), (last.id, last.timestamp))
+            self.assertEqual(row.last_message_preview, last.content[:inbox.PREVIEW_LENGTH])
+        self.assertEqual((self.row(self.alice).unread_count, self.row(self.bob).unread_count), (1, 1))
+
+    def test_reading_recounts_what_is_left(self):
+        first = self.send(self.bob, 'one')
+        self.send(self.bob, 'two')
+        advance_read_cursor(self.alice.id, self.conv.id, first.id)
+        self.assertEqual(self.row(self.alice).unread_count, 1)
+
+    def test_edits_and_deletes_refresh_the_preview(self):
+        earlier = self.send(self.bob, 'one')
+        last = self.send(self.bob, 'two')
+        last.content = 'edited'
+        last.save()
+        self.assertEqual(self.row(self.alice).last_message_preview, 'edited')
+        last.delete()
+        row = self.row(self.alice)
+        self.assertEqual((row.last_message_id, row.last_message_preview, row.unread_count), (earlier.id, 'one', 1))
+
+    def test_inbox_lists_pinned_first_then_by_activity(self):
+        older, newer = conversation(self.alice), conversation(self.alice)
+        Message.objects.create(conversation=older, sender=self.alice, content='a')
+        Message.objects.create(conversation=newer, sender=self.alice, content='b')
+        inbox.toggle_flag(self.alice, self.conv.id, 'is_pinned')
+        inbox.toggle_flag(self.alice, older.id, 'is_archived')
+        with self.assertNumQueries(1):
+            rows = [(r.conversation_id, r.peer and r.peer.profile.avatar_url) for r in inbox.inbox_rows(self.alice)]
+        self.assertEqual([c for c, _ in rows], [self.conv.id, newer.id])
+        self.assertEqual([r.conversation_id for r in inbox.inbox_rows(self.alice, archived=True)], [older.id])
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class MemberFlagTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.conv = conversation(self.alice, self.bob)
+        self.addCleanup(last_seen.flush_sync)
+
+    def test_toggles_only_change_the_users_row(self):
+        self.client.force_login(self.alice)
+        for name, flag in (('chat:toggle_pin', 'is_pinned'), ('chat:toggle_archive', 'is_archived'),
+                           ('chat:toggle_mute', 'is_muted')):
+            response = self.client.post(reverse(name, args=[self.conv.id]))
+            self.assertEqual(response.json(), {flag: True})
+        alice_row = ConversationMember.objects.get(user=self.alice, conversation=self.conv)
+        bob_row = ConversationMember.objects.get(user=self.bob, conversation=self.conv)
+        self.assertEqual((alice_row.is_pinned, alice_row.is_archived, alice_row.is_muted), (True, True, True))
+        self.assertEqual((bob_row.is_pinned, bob_row.is_archived, bob_row.is_muted), (False, False, False))
+        self.assertEqual(inbox.toggle_flag(self.alice, self.conv.id, 'is_pinned'), False)
+
+    def test_unknown_flags_and_outsiders_are_refused(self):
+        with self.assertRaises(ValueError):
+            inbox.toggle_flag(self.alice, self.conv.id, 'unread_count')
+        self.client.force_login(User.objects.create_user('eve'))
+        self.assertEqual(self.client.post(reverse('chat:toggle_pin', args=[self.conv.id])).status_code, 404)
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db', CHAT_HISTORY_MAX_PAGE_SIZE=10)
+class HistoryTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.conv = conversation(self.alice)
+        for n in range(12):
+            Message.objects.create(conversation=self.conv, sender=self.alice, content=str(n))
+        cache = RecentMessageCache(per_conversation=8)
+        patcher = mock.patch('chat.history.recent_messages', cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(last_seen.flush_sync)
+
+    def seqs(self, **cursor):
+        messages, more = history.page(self.conv.id, limit=5, **cursor)
+        return [m.seq for m in messages], more
+
+    def test_paging_back_covers_every_message_once(self):
+        seqs, more = self.seqs()
+        pages = [seqs]
+        while more:
+            seqs, more = self.seqs(before_seq=pages[-1][0])
+            pages.append(seqs)
+        self.assertEqual(pages, [[8, 9, 10, 11, 12], [3, 4, 5, 6, 7], [1, 2]])
+
+    def test_paging_forward(self):
+        self.assertEqual(self.seqs(after_seq=5), ([6, 7, 8, 9, 10], True))
+        self.assertEqual(self.seqs(after_seq=10), ([11, 12], False))
+
+    def test_newest_page_comes_from_the_cache(self):
+        self.seqs()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.seqs(), ([8, 9, 10, 11, 12], True))
+        # Only the shared version check, no message query
+        self.assertFalse([q for q in queries if 'chat_message' in q['sql']])
+        # Longer than the cached tail: read from the database
+        messages, more = history.page(self.conv.id, limit=10)
+        self.assertEqual(([m.seq for m in messages], more), (list(range(3, 13)), True))
+
+    def test_cursor_parsing(self):
+        self.assertEqual(history.parse_cursor({'before_seq': '9', 'limit': '500'}), (9, None, 10))
+        self.assertEqual(history.parse_cursor({}, default_limit=3), (None, None, 3))
+        for junk in ({'before_seq': 'x'}, {'before_seq': '3', 'after_seq': '1'}):
+            with self.assertRaises(ValueError):
+                history.parse_cursor(junk)
+
+    def test_history_view(self):
+        url = reverse('chat:message_history', args=[self.conv.id])
+        self.client.force_login(self.alice)
+        page = self.client.get(url, {'before_seq': 3}).json()
+        self.assertEqual(([m['seq'] for m in page['messages']], page['has_more']), ([1, 2], False))
+        self.assertEqual(self.client.get(url, {'after_seq': 'x'}).status_code, 400)
+        self.client.force_login(User.objects.create_user('eve'))
+        self.assertEqual(self.client.get(url).status_code, 404)
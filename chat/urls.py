@@ -13,8 +13,12 @@ urlpatterns = [
     path('<int:conversation_id>/upload/', views.upload_media, name='upload_media'),
     path('<int:conversation_id>/send-http/', views.send_message_http, name='send_http'),
     path('<int:conversation_id>/messages-http/', views.get_messages_http, name='messages_http'),
+    path('<int:conversation_id>/history/', views.message_history, name='message_history'),
     path('<int:conversation_id>/pin/', views.toggle_pin, name='toggle_pin'),
     path('<int:conversation_id>/archive/', views.toggle_archive, name='toggle_archive'),
+    path('<int:conversation_id>/mute/', views.toggle_mute, name='toggle_mute'),
     path('search/', views.search_messages, name='search_messages'),
+    path('events/', views.event_stream, name='event_stream'),
     path('archived/', views.archived_chats, name='archived_chats'),
+    path('metrics/', views.chat_metrics, name='chat_metrics'),
 ]
@@ -0,0 +1,127 @@
+"""
+Chat — Cache Versions
+Invalidation counters for the per-process chat caches (chat.membership and
+chat.recent). A write bumps its key's version; a cached entry is served only
+while the version it was loaded under is still current, and every worker
+must see the same counters.
+
+Bumps are atomic, so two workers invalidating one key at once get two
+different versions and neither can keep an entry loaded in between. The
+version a bump returns is therefore safe for updating an entry in place.
+
+Backends (CHAT_CACHE_VERSIONS):
+- 'memory': per process, the default for single-worker deployments
+- 'sqlite': a file shared by the workers on one host (CHAT_CACHE_VERSIONS_PATH)
+- 'cache': Django's cache, for deployments with CACHE_BACKEND=redis
+
+Callers remember a version check for CHAT_CACHE_VERSION_TTL_MS, so a warm
+lookup reads no counter and another worker's bump is seen that much later.
+"""
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+
+
+def version_ttl():
+    """Seconds a checked version is trusted without reading it again."""
+    return getattr(settings, 'CHAT_CACHE_VERSION_TTL_MS', 1000) / 1000
+
+
+def fresh(checked_at):
+    return time.monotonic() - checked_at < version_ttl()
+
+
+class MemoryVersions:
+    """Counters for a single worker process."""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache_versions (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+'''
+
+
+class SQLiteVersions:
+    """Counters in a SQLite file (WAL mode) shared by the workers on one host."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._thread_state = threading.local()
+
+    def _db(self):
+        conn = getattr(self._thread_state, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._thread_state.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._db().execute('SELECT version FROM cache_versions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, key):
+        # One statement, so concurrent bumps serialize on SQLite's write lock
+        return self._db().execute(
+            'INSERT INTO cache_versions (key, version) VALUES (?, 1) '
+            'ON CONFLICT (key) DO UPDATE SET version = version + 1 RETURNING version',
+            (key,),
+        ).fetchone()[0]
+
+
+# Django cache backends whose incr() is one atomic operation on the server
+ATOMIC_CACHE_BACKENDS = ('RedisCache', 'PyMemcacheCache', 'PyLibMCCache')
+
+
+class CacheVersions:
+    """Counters in Django's cache; only correct when its incr() is atomic."""
+
+    def __init__(self):
+        if type(caches['default']).__name__ not in ATOMIC_CACHE_BACKENDS:
+            raise ImproperlyConfigured(
+                "CHAT_CACHE_VERSIONS='cache' needs a cache with an atomic incr (CACHE_BACKEND=redis)"
+            )
+
+    def get(self, key):
+        return cache.get(key, 0)
+
+    def bump(self, key):
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # First bump: add() only succeeds for one worker, the others incr
+            if cache.add(key, 1, None):
+                return 1
+            return cache.incr(key)
+
+
+def build_versions():
+    backend = getattr(settings, 'CHAT_CACHE_VERSIONS', 'memory')
+    if backend == 'sqlite':
+        return SQLiteVersions(settings.CHAT_CACHE_VERSIONS_PATH)
+    if backend == 'cache':
+        return CacheVersions()
+    return MemoryVersions()
+
+
+versions = build_versions()
@@ -2,66 +2,80 @@
 Chat — Views
 Conversation listing, detail, creation, and media upload with WebSocket broadcast.
 """
+import copy
 import os
 import uuid
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
-from django.db.models import Q, Max, Count
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.db.models import Q
 from django.conf import settings
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import Conversation, Message
+from asgiref.sync import async_to_sync, sync_to_async
+from . import history, longpoll, membership, outbound, sse
+from .events import conversation_event, conversation_group, sidebar_event, user_group
+from .inbox import inbox_rows, toggle_flag
+from .models import Conversation, ConversationMember, Message
+from .online import online_users
+from .reactions import my_reactions
+from .readcursor import advance_read_cursor, read_cursor
+from .recent import recent_messages
+
+
+def _get_participant_conversation(user, conversation_id, organization=None):
+    """Fetch a conversation the user participates in (checked via the membership cache), or 404."""
+    if not membership.is_member(user, conversation_id):
+        raise Http404('Conversation not found')
+    qs = Conversation.objects.all()
+    if organization:
+        qs = qs.filter(organization=organization)
+    return get_object_or_404(qs, id=conversation_id)
 
 
 @login_required
 def chat_home(request):
-    qs = Conversation.objects.filter(
-        participants=request.user
-    )
-    # Org-scope filtering
     org = getattr(request, 'organization', None)
-    if org:
-        qs = qs.filter(organization=org)
-
-    conversations = [c for c in qs.order_by('-updated_at') if not c.is_archived]
-
     return render(request, 'chat/chat.html', {
-        'conversations': conversations,
+        'inbox': inbox_rows(request.user, organization=org),
         'active_conversation': None,
     })
 
 
 @login_required
 def conversation_view(request, conversation_id):
-    qs = Conversation.objects.filter(participants=request.user)
     org = getattr(request, 'organization', None)
-    if org:
-        qs = qs.filter(organization=org)
-
-    conversation = get_object_or_404(qs, id=conversation_id)
-    messages_qs = conversation.messages.order_by('timestamp')
+    conversation = _get_participant_conversation(request.user, conversation_id, organization=org)
+    # The newest page only; older pages are fetched from message_history on scroll.
+    # Cache entries are shared; copy them before setting my_reactions below
+    messages, has_older = history.page(conversation.id)
+    messages = [copy.copy(m) for m in messages]
 
-    # Mark messages as read
-    messages_qs.filter(is_read=False).exclude(sender=request.user).update(is_read=True)
+    # Mark messages as read by advancing the read cursor to the newest one
+    latest_id = max((m.id for m in messages), default=None)
+    if latest_id and advance_read_cursor(request.user.id, conversation.id, latest_id):
+        _broadcast_read_receipt(conversation.id, request.user, latest_id)
 
     # Get other participant
     other_user = conversation.participants.exclude(id=request.user.id).first()
+    other_read_upto = read_cursor(other_user.id, conversation.id) if other_user else 0
 
-    conv_qs = Conversation.objects.filter(
-        participants=request.user
-    )
-    if org:
-        conv_qs = conv_qs.filter(organization=org)
-
-    conversations = [c for c in conv_qs.order_by('-updated_at') if not c.is_archived]
+    # Flag the viewer's own reactions with one query for the whole page
+    mine = my_reactions(request.user, [m.id for m in messages if m.reactions])
+    for msg in messages:
+        msg.my_reactions = mine.get(msg.id, ())
 
+    # Built after the cursor moved, so this conversation shows as read
     return render(request, 'chat/chat.html', {
-        'conversations': conversations,
+        'inbox': inbox_rows(request.user, organization=org),
         'active_conversation': conversation,
-        'messages': messages_qs,
+        'member': ConversationMember.objects.filter(user=request.user, conversation=conversation).first(),
+        'messages': messages,
+        'has_older': has_older,
         'other_user': other_user,
+        'other_read_upto': other_read_upto,
     })
 
 
@@ -116,16 +130,41 @@ def _unique_filename(original_name):
     return f'{uuid.uuid4().hex[:12]}_{original_name}'
 
 
+def _broadcast_new_message(conversation, message_data):
+    """Send a new message to its conversation group and to each participant's sidebar."""
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        conversation_group(conversation.id),
+        conversation_event(conversation.id, 'chat_message', {
+            'type': 'message',
+            'message': message_data,
+        })
+    )
+    sidebar = sidebar_event(conversation.id, message_data)
+    for user_id in membership.participant_ids(conversation.id):
+        async_to_sync(channel_layer.group_send)(user_group(user_id), sidebar)
+
+
+def _broadcast_read_receipt(conversation_id, reader, message_id):
+    """Tell the conversation that reader's cursor moved up to message_id."""
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        conversation_group(conversation_id),
+        conversation_event(conversation_id, 'read_receipt', {
+            'type': 'read_receipt',
+            'message_id': message_id,
+            'reader': reader.username,
+        })
+    )
+
+
 @login_required
 def upload_media(request, conversation_id):
     """Upload a file via HTTP, save it, broadcast metadata via WebSocket."""
     if request.method != 'POST' or not request.FILES.get('media'):
         return JsonResponse({'error': 'No file provided'}, status=400)
 
-    conversation = get_object_or_404(
-        Conversation.objects.filter(participants=request.user),
-        id=conversation_id
-    )
+    conversation = _get_participant_conversation(request.user, conversation_id)
 
     uploaded = request.FILES['media']
 
@@ -163,39 +202,31 @@ def upload_media(request, conversation_id):
 
     # Broadcast message via WebSocket to the conversation group
     message_data = message.to_json()
-    channel_layer = get_channel_layer()
-    room_group_name = f'chat_{conversation_id}'
-    async_to_sync(channel_layer.group_send)(
-        room_group_name,
-        {
-            'type': 'chat_message',
-            'message': message_data,
-        }
-    )
+    _broadcast_new_message(conversation, message_data)
 
     return JsonResponse({'message': message_data})
 
 
+def _toggle_member_flag(request, conversation_id, flag):
+    """Pin, archive and mute are the requesting user's own settings."""
+    if not membership.is_member(request.user, conversation_id):
+        raise Http404('Conversation not found')
+    return JsonResponse({flag: toggle_flag(request.user, conversation_id, flag)})
+
+
 @login_required
 def toggle_pin(request, conversation_id):
-    conv = get_object_or_404(
-        Conversation.objects.filter(participants=request.user),
-        id=conversation_id
-    )
-    conv.is_pinned = not conv.is_pinned
-    conv.save(update_fields=['is_pinned'])
-    return JsonResponse({'is_pinned': conv.is_pinned})
+    return _toggle_member_flag(request, conversation_id, 'is_pinned')
 
 
 @login_required
 def toggle_archive(request, conversation_id):
-    conv = get_object_or_404(
-        Conversation.objects.filter(participants=request.user),
-        id=conversation_id
-    )
-    conv.is_archived = not conv.is_archived
-    conv.save(update_fields=['is_archived'])
-    return JsonResponse({'is_archived': conv.is_archived})
+    return _toggle_member_flag(request, conversation_id, 'is_archived')
+
+
+@login_required
+def toggle_mute(request, conversation_id):
+    return _toggle_member_flag(request, conversation_id, 'is_muted')
 
 
 @login_required
@@ -216,23 +247,14 @@ def search_messages(request):
 
 @login_required
 def archived_chats(request):
-    conversations = Conversation.objects.filter(
-        participants=request.user,
-        is_archived=True
-    ).annotate(
-        last_msg_time=Max('messages__timestamp')
-    ).order_by('-last_msg_time')
-    return render(request, 'chat/archived.html', {'conversations': conversations})
+    return render(request, 'chat/archived.html', {'inbox': inbox_rows(request.user, archived=True)})
 @login_required
 def send_message_http(request, conversation_id):
     """Fallback for sending messages via HTTP when WebSockets are unavailable."""
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required'}, status=405)
     
-    conversation = get_object_or_404(
-        Conversation.objects.filter(participants=request.user),
-        id=conversation_id
-    )
+    conversation = _get_participant_conversation(request.user, conversation_id)
     
     try:
         import json
@@ -258,11 +280,7 @@ def send_message_http(request, conversation_id):
     
     # Broadcast via WS if possible
     try:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'chat_{conversation_id}',
-            {'type': 'chat_message', 'message': message.to_json()}
-        )
+        _broadcast_new_message(conversation, message.to_json())
     except:
         pass
 
@@ -270,21 +288,148 @@ def send_message_http(request, conversation_id):
 
 
 @login_required
-def get_messages_http(request, conversation_id):
-    """Fallback for fetching new messages via HTTP polling."""
-    conversation = get_object_or_404(
-        Conversation.objects.filter(participants=request.user),
-        id=conversation_id
-    )
-    
-    after_id = request.GET.get('after_id')
-    messages_qs = conversation.messages.all()
-    
-    if after_id:
-        messages_qs = messages_qs.filter(id__gt=after_id)
-    
-    # Also mark as read
-    messages_qs.exclude(sender=request.user).update(is_read=True)
-    
-    data = [msg.to_json() for msg in messages_qs]
-    return JsonResponse({'messages': data})
+def message_history(request, conversation_id):
+    """
+    A page of history as JSON: ?before_seq=N for older messages, ?after_seq=N
+    for newer ones, neither for the newest page; ?limit= sets the page size.
+    """
+    if not membership.is_member(request.user, conversation_id):
+        raise Http404('Conversation not found')
+    try:
+        before_seq, after_seq, limit = history.parse_cursor(request.GET)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    messages, has_more = history.page(conversation_id, before_seq, after_seq, limit)
+    return JsonResponse({'messages': [m.to_json() for m in messages], 'has_more': has_more})
+
+
+def _poll_messages(user, conversation_id, after_id=0, after_seq=0, until_seq=0):
+    """New messages as JSON, with the user's read cursor moved past them."""
+    if after_seq or until_seq:
+        messages_qs = Message.objects.filter(
+            conversation_id=conversation_id, seq__gt=after_seq
+        ).select_related('sender__profile').order_by('seq')
+        if until_seq:
+            messages_qs = messages_qs.filter(seq__lte=until_seq)
+        data = [msg.to_json() for msg in messages_qs]
+    else:
+        data = recent_messages.messages_json(conversation_id, after_id)
+    if data is None:
+        messages_qs = Message.objects.filter(
+            conversation_id=conversation_id, id__gt=after_id
+        ).select_related('sender__profile')
+        data = [msg.to_json() for msg in messages_qs]
+
+    # Also mark as read — one cursor write, and only when something new arrived
+    if data:
+        latest_id = max(m['id'] for m in data)
+        if advance_read_cursor(user.id, conversation_id, latest_id):
+            _broadcast_read_receipt(conversation_id, user, latest_id)
+    return data
+
+
+def _poll_response(data, etag=None):
+    response = JsonResponse({'messages': data})
+    if etag:
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@login_required
+async def get_messages_http(request, conversation_id):
+    """
+    Fallback for fetching new messages via HTTP polling (?after_id=N), and
+    gap repair for clients that noticed a jump in seq (?after_seq=A&until_seq=B).
+
+    Polls carry an ETag built from the conversation's last_seq and the
+    client's cursor: one sent back in If-None-Match that still matches gets
+    a 304 after one primary-key read of last_seq, on top of the session,
+    user and organization lookups every request makes (the membership check
+    comes from chat.membership's cache). With ?wait=N (seconds, at most CHAT_LONG_POLL_TIMEOUT) a poll
+    with nothing new is held until a message arrives or N seconds pass.
+    """
+    user = await request.auser()
+    if not await sync_to_async(membership.is_member)(user, conversation_id):
+        raise Http404('Conversation not found')
+
+    try:
+        after_id = int(request.GET.get('after_id') or 0)
+        after_seq = int(request.GET.get('after_seq') or 0)
+        until_seq = int(request.GET.get('until_seq') or 0)
+        wait = max(0.0, min(float(request.GET.get('wait') or 0), longpoll.max_wait()))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    if after_seq or until_seq:
+        data = await sync_to_async(_poll_messages)(
+            user, conversation_id, after_seq=after_seq, until_seq=until_seq,
+        )
+        return _poll_response(data)
+
+    seq = await sync_to_async(longpoll.last_seq)(conversation_id)
+    etag = longpoll.poll_etag(conversation_id, seq, after_id)
+    unchanged = request.headers.get('If-None-Match') == etag
+    if not unchanged:
+        data = await sync_to_async(_poll_messages)(user, conversation_id, after_id)
+        if data or not wait:
+            return _poll_response(data, etag)
+
+    if wait:
+        current = await longpoll.wait_for_change(conversation_id, seq, wait)
+        if current != seq:
+            etag = longpoll.poll_etag(conversation_id, current, after_id)
+            return _poll_response(await sync_to_async(_poll_messages)(user, conversation_id, after_id), etag)
+    if unchanged:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    return _poll_response([], etag)
+
+
+@login_required
+async def event_stream(request):
+    """
+    Server-Sent Events fallback for clients without a WebSocket: the user's
+    sidebar updates plus, with ?conversation=N, that conversation's events.
+    Resumes from the Last-Event-ID header (or ?last_event_id=). The stream's
+    own event ids carry the client's message position; ?after_seq= (the last
+    message seq seen) is only used with an id that does not, such as the
+    socket's "epoch:seq" when a client switches over.
+    """
+    user = await request.auser()
+    try:
+        conversation_id = int(request.GET.get('conversation') or 0) or None
+        after_seq = int(request.GET.get('after_seq') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    if conversation_id and not await sync_to_async(membership.is_member)(user, conversation_id):
+        raise Http404('Conversation not found')
+
+    wsgi = not isinstance(request, ASGIRequest)
+    if wsgi and not sse.serves_wsgi(get_channel_layer()):
+        # EventSource gives up on a non-200 answer and the client long-polls
+        return JsonResponse({'error': 'Event streams are not available'}, status=503)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    message_seq = await sync_to_async(longpoll.last_seq)(conversation_id) if conversation_id else 0
+    chunks = sse.event_stream(user, conversation_id, last_event_id, after_seq, message_seq)
+    if wsgi:
+        chunks = sse.sync_stream(chunks)
+    response = StreamingHttpResponse(chunks, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@staff_member_required
+def chat_metrics(request):
+    """Runtime chat metrics for this worker process (staff only)."""
+    connections = outbound.snapshot()
+    return JsonResponse({
+        'connections': connections,
+        'queued_frames': sum(c['depth'] for c in connections),
+        'queued_bytes': sum(c['bytes'] for c in connections),
+        'recent_messages': recent_messages.stats(),
+        'online': online_users.stats(),
+    })
@@ -0,0 +1,261 @@
+"""
+Chat — Write-Behind Message Pipeline
+Opt-in group commit for messages received over WebSockets.
+Each message gets its uid and timestamp immediately so it can be broadcast
+at once; rows are persisted in small, time-bounded batches with bulk_create.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core import serializers
+from django.db import transaction
+
+from . import inbox
+from .events import conversation_event, conversation_group
+from .recent import recent_messages
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBehind:
+    """
+    Buffers unsaved Message instances and flushes them in batches.
+
+    A batch is flushed when it reaches ``max_batch`` messages or when the
+    oldest pending message has waited ``max_delay`` seconds, whichever comes
+    first. Each conversation in a batch commits on its own: messages for a
+    conversation that no longer exists are dropped, and other failures are
+    put back at the head of the queue and retried with backoff until
+    ``max_attempts``, after which they move to ``dead_letters`` and are
+    appended to the dead-letter file. Anything still pending when the
+    process exits, including messages waiting for a retry, is written
+    synchronously with up to SHUTDOWN_ATTEMPTS tries; what still fails goes
+    to the dead-letter file rather than being lost with the process.
+    """
+
+    # Longest wait between retries of a failing conversation, in seconds
+    MAX_RETRY_DELAY = 5
+    # Tries flush_sync() gives a batch before dead-lettering what is left
+    SHUTDOWN_ATTEMPTS = 3
+
+    def __init__(self, max_batch=None, max_delay_ms=None, max_attempts=None, dead_letter_path=None):
+        self.enabled = getattr(settings, 'CHAT_WRITE_BEHIND', False)
+        self.max_batch = max_batch or getattr(settings, 'CHAT_WRITE_BEHIND_MAX_BATCH', 50)
+        self.max_delay = (max_delay_ms or getattr(settings, 'CHAT_WRITE_BEHIND_MAX_DELAY_MS', 50)) / 1000
+        self.max_attempts = max_attempts or getattr(settings, 'CHAT_WRITE_BEHIND_MAX_ATTEMPTS', 8)
+        self._pending = []
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self.dead_letters = deque(maxlen=1000)
+        self.dead_letter_path = dead_letter_path or getattr(settings, 'CHAT_WRITE_BEHIND_DEAD_LETTER_PATH', None)
+        self.stats = {
+            'batches': 0,
+            'messages': 0,
+            'failures': 0,
+            'dropped': 0,
+            'dead_lettered': 0,
+            'last_batch_size': 0,
+            'last_batch_ms': 0.0,
+            'max_batch_ms': 0.0,
+        }
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def submit(self, message):
+        """Queue an unsaved Message. Must be called from the event loop."""
+        with self._lock:
+            self._pending.append(message)
+            full = len(self._pending) >= self.max_batch
+
+        loop = asyncio.get_running_loop()
+        if full:
+            self._cancel_timer()
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _take(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        return batch
+
+    async def flush(self):
+        """Persist everything pending and announce the assigned ids."""
+        self._cancel_timer()
+        batch = self._take()
+        if not batch:
+            return
+        persisted, retry = await database_sync_to_async(self._persist)(batch)
+        if retry:
+            with self._lock:
+                self._pending[:0] = retry
+            if self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(
+                    self._retry_delay(retry), self._on_timer,
+                )
+        if persisted:
+            await self._announce(persisted)
+
+    def flush_sync(self):
+        """Blocking flush used on interpreter shutdown."""
+        self._cancel_timer()
+        batch = self._take()
+        for attempt in range(self.SHUTDOWN_ATTEMPTS):
+            if not batch:
+                return
+            if attempt:
+                time.sleep(self._retry_delay(batch))
+            _, batch = self._persist(batch)
+        if batch:
+            logger.error('Write-behind could not write %d messages at shutdown', len(batch))
+            self._dead_letter(batch)
+
+    def _retry_delay(self, messages):
+        attempts = max(self._attempts.get(m.uid, 1) for m in messages)
+        return min(self.max_delay * 2 ** attempts, self.MAX_RETRY_DELAY)
+
+    def _persist(self, batch):
+        """Write a batch; returns (persisted messages, messages to retry)."""
+        from chat.models import Conversation, Message
+
+        started = time.perf_counter()
+        by_conv = defaultdict(list)
+        for m in batch:
+            by_conv[m.conversation_id].append(m)
+
+        persisted, retry = [], []
+        for conv_id, msgs in by_conv.items():
+            # One transaction and one seq block per conversation, so a bad
+            # conversation cannot hold back the others
+            try:
+                with transaction.atomic():
+                    first = Conversation.allocate_seq(conv_id, len(msgs))
+                    for offset, m in enumerate(msgs):
+                        m.seq = first + offset
+                    Message.objects.bulk_create(msgs)
+            except Conversation.DoesNotExist:
+                logger.warning('Write-behind dropped %d messages for deleted conversation %s',
+                               len(msgs), conv_id)
+                self.stats['dropped'] += len(msgs)
+                self._forget_attempts(msgs)
+                continue
+            except Exception:
+                for m in msgs:
+                    m.pk = m.seq = None  # Rolled back; reassign both on retry
+                retry.extend(self._failed(conv_id, msgs))
+                continue
+            self._forget_attempts(msgs)
+            persisted.extend(msgs)
+
+        if persisted:
+            self._after_commit(persisted)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats['batches'] += 1
+        self.stats['messages'] += len(persisted)
+        self.stats['last_batch_size'] = len(persisted)
+        self.stats['last_batch_ms'] = elapsed_ms
+        self.stats['max_batch_ms'] = max(self.stats['max_batch_ms'], elapsed_ms)
+        logger.debug('Write-behind flushed %d messages in %.1f ms', len(persisted), elapsed_ms)
+        return persisted, retry
+
+    def _failed(self, conversation_id, msgs):
+        """Count a failed attempt; returns the messages still worth retrying."""
+        self.stats['failures'] += 1
+        attempts = max(self._attempts.get(m.uid, 0) for m in msgs) + 1
+        if attempts < self.max_attempts:
+            logger.exception('Write-behind write of %d messages for conversation %s failed '
+                             '(attempt %d/%d); requeueing',
+                             len(msgs), conversation_id, attempts, self.max_attempts)
+            for m in msgs:
+                self._attempts[m.uid] = attempts
+            return msgs
+        logger.exception('Write-behind gave up on %d messages for conversation %s after %d attempts',
+                         len(msgs), conversation_id, attempts)
+        self._dead_letter(msgs)
+        return []
+
+    def _dead_letter(self, msgs):
+        """
+        Set messages aside for good: in dead_letters, and appended to the
+        dead-letter file as one Django JSON fixture per line, so they can be
+        inspected or reloaded with serializers.deserialize().
+        """
+        self.stats['dead_lettered'] += len(msgs)
+        self.dead_letters.extend(msgs)
+        self._forget_attempts(msgs)
+        if not self.dead_letter_path:
+            logger.error('Write-behind has no dead-letter file; %d messages kept in memory only', len(msgs))
+            return
+        try:
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+                for m in msgs:
+                    f.write(serializers.serialize('json', [m]) + '\n')
+        except OSError:
+            logger.exception('Write-behind could not write %d messages to %s',
+                             len(msgs), self.dead_letter_path)
+
+    def _forget_attempts(self, msgs):
+        for m in msgs:
+            self._attempts.pop(m.uid, None)
+
+    def _after_commit(self, batch):
+        from chat.models import Conversation, Message
+
+        # Backends that cannot return ids from a bulk insert: look them up by uid.
+        missing = [m for m in batch if m.pk is None]
+        if missing:
+            ids = dict(Message.objects.filter(
+                uid__in=[m.uid for m in missing]
+            ).values_list('uid', 'id'))
+            for m in missing:
+                m.pk = ids.get(m.uid)
+
+        # bulk_create sends no post_save, so feed the recent-messages cache
+        # and the members' inbox rows here
+        recent_messages.append(batch)
+        inbox.record_messages([m for m in batch if m.pk is not None])
+
+        latest = {}
+        for m in batch:
+            latest[m.conversation_id] = max(m.timestamp, latest.get(m.conversation_id, m.timestamp))
+        for conv_id, ts in latest.items():
+            Conversation.objects.filter(id=conv_id).update(updated_at=ts)
+
+    async def _announce(self, batch):
+        """Tell each conversation which database ids and seqs its pending uids received."""
+        by_conv = defaultdict(list)
+        for m in batch:
+            by_conv[m.conversation_id].append({'uid': str(m.uid), 'id': m.pk, 'seq': m.seq})
+        channel_layer = get_channel_layer()
+        for conv_id, ids in by_conv.items():
+            await channel_layer.group_send(
+                conversation_group(conv_id),
+                conversation_event(conv_id, 'message_persisted', {
+                    'type': 'persisted',
+                    'messages': ids,
+                })
+            )
+
+
+write_behind = MessageWriteBehind()
+atexit.register(write_behind.flush_sync)
@@ -1,5 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 import uuid
 
 class NearbyDevice(models.Model):
@@ -19,3 +22,10 @@ class NearbyDevice(models.Model):
         
     def __str__(self):
         return f"{self.user.username} - {self.ip_address}"
+
+
+@receiver(post_delete, sender=NearbyDevice)
+def forget_pairing_code(sender, instance, **kwargs):
+    """A deleted device's QR code must not be revalidated from the cache."""
+    from .qr import pairing_code_key
+    cache.delete(pairing_code_key(instance.user_id, instance.ip_address))
@@ -0,0 +1,152 @@
+"""
+Discovery — Nearby Device Index
+Answers heartbeat polls. NEARBY_INDEX picks the index:
+
+- 'database': NearbyDevice rows, so devices on different workers and
+  instances see each other. A heartbeat is one UPDATE (an INSERT the first
+  time) and one query for the other devices with their profiles joined.
+- 'memory': devices indexed by IP address in this process, each entry
+  carrying the user's display name and avatar so a lookup needs no
+  queries. Only correct when a single worker serves every heartbeat.
+  Heartbeats do not create NearbyDevice rows (only QR pairing needs them);
+  the last_active of rows that exist is refreshed in one batched UPDATE
+  every NEARBY_FLUSH_INTERVAL seconds.
+
+Either way, devices drop out NEARBY_DEVICE_TTL seconds after their last
+heartbeat.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Devices per UPDATE statement, to keep the OR-ed filter small
+FLUSH_CHUNK = 200
+
+
+def describe(user, ip, device_name):
+    """The public device entry; user.profile should already be loaded."""
+    profile = getattr(user, 'profile', None)
+    return {
+        'user_id': user.id,
+        'username': user.get_full_name() or user.username,
+        'avatar': profile.avatar_url if profile else '/static/img/default-avatar.svg',
+        'ip': ip,
+        'device_name': device_name,
+    }
+
+
+class DatabaseNearbyIndex:
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'NEARBY_DEVICE_TTL', 300)
+
+    def heartbeat(self, user, ip, device_name):
+        """Mark the user's device at ip as active; returns the other devices on that IP."""
+        from discovery.models import NearbyDevice
+        now = timezone.now()
+        # last_active is auto_now, which update() does not apply
+        if not NearbyDevice.objects.filter(user=user, ip_address=ip).update(last_active=now):
+            NearbyDevice.objects.get_or_create(
+                user=user, ip_address=ip, defaults={'device_name': device_name},
+            )
+        others = NearbyDevice.objects.filter(
+            ip_address=ip, last_active__gte=now - timedelta(seconds=self.ttl),
+        ).exclude(user=user).select_related('user__profile')
+        return [describe(d.user, d.ip_address, d.device_name) for d in others]
+
+
+class NearbyIndex:
+
+    def __init__(self, ttl=None, flush_interval=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'NEARBY_DEVICE_TTL', 300)
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(settings, 'NEARBY_FLUSH_INTERVAL', 30)
+        self._by_ip = {}       # {ip: {user_id: (expires, device dict)}}
+        self._active = set()   # (user_id, ip) seen since the last flush
+        self._lock = threading.Lock()
+        self._timer = None
+        self._next_sweep = time.monotonic() + self.ttl
+
+    def heartbeat(self, user, ip, device_name):
+        """Mark the user's device at ip as active; returns the other devices on that IP."""
+        now = time.monotonic()
+        with self._lock:
+            devices = self._by_ip.get(ip, {})
+            current = devices.get(user.id)
+        if current is None or current[0] <= now:
+            device = describe(user, ip, device_name)
+        else:
+            device = current[1]
+
+        with self._lock:
+            devices = self._by_ip.setdefault(ip, {})
+            devices[user.id] = (now + self.ttl, device)
+            self._active.add((user.id, ip))
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+            others = [d for uid, (expires, d) in devices.items() if uid != user.id and expires > now]
+            if now >= self._next_sweep:
+                self._sweep(now)
+        return others
+
+    def _sweep(self, now):
+        for ip in list(self._by_ip):
+            devices = self._by_ip[ip]
+            for uid in [uid for uid, (expires, _) in devices.items() if expires <= now]:
+                del devices[uid]
+            if not devices:
+                del self._by_ip[ip]
+        self._next_sweep = now + self.ttl
+
+    # ── Persistence ─────────────────────────────────────────────────────
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            connections.close_all()
+
+    def flush(self):
+        with self._lock:
+            active, self._active = self._active, set()
+        if not active:
+            return
+        try:
+            self._persist(active)
+        except Exception:
+            logger.exception('Failed to refresh %d nearby devices', len(active))
+
+    def flush_sync(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.flush()
+
+    def _persist(self, active):
+        from discovery.models import NearbyDevice
+        active, now = list(active), timezone.now()
+        for start in range(0, len(active), FLUSH_CHUNK):
+            match = Q()
+            for user_id, ip in active[start:start + FLUSH_CHUNK]:
+                match |= Q(user_id=user_id, ip_address=ip)
+            NearbyDevice.objects.filter(match).update(last_active=now)
+
+
+if getattr(settings, 'NEARBY_INDEX', 'database') == 'memory':
+    nearby_devices = NearbyIndex()
+    atexit.register(nearby_devices.flush_sync)
+else:
+    nearby_devices = DatabaseNearbyIndex()
@@ -0,0 +1,79 @@
+"""
+Discovery — QR Codes
+Renders pairing QR codes once per (pairing code, URL) and keeps them in
+Django's cache. The pairing URL only changes with the host and scheme, so
+the ETag is derived from the URL and format without rendering anything.
+Each (user, IP) pairing code is cached too, so a revalidation that ends in
+a 304 reads no NearbyDevice row.
+"""
+import base64
+import hashlib
+from io import BytesIO
+
+import qrcode
+import qrcode.image.svg
+from django.core.cache import cache
+
+# Rendered images are immutable for their key; keep them a day
+QR_CACHE_SECONDS = 24 * 60 * 60
+
+
+def pairing_code_key(user_id, ip):
+    return f'discovery:pairing:{user_id}:{ip}'
+
+
+def device_pairing_code(user, ip, device_name):
+    """The pairing code of the user's device at ip, creating the device on first use."""
+    from discovery.models import NearbyDevice
+    key = pairing_code_key(user.id, ip)
+    code = cache.get(key)
+    if code is None:
+        device, _ = NearbyDevice.objects.get_or_create(
+            user=user, ip_address=ip, defaults={'device_name': device_name},
+        )
+        code = device.pairing_code
+        cache.set(key, code, QR_CACHE_SECONDS)
+    return code
+
+
+def pairing_url(request, pairing_code):
+    return f"{request.scheme}://{request.get_host()}/discovery/pair/{pairing_code}/"
+
+
+def qr_etag(url, fmt):
+    return '"qr-%s"' % hashlib.sha1(f'{fmt}:{url}'.encode()).hexdigest()[:20]
+
+
+def _make(url, **kwargs):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+        **kwargs,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    return qr
+
+
+def png_data_uri(url):
+    key = 'discovery:qr:png:' + hashlib.sha1(url.encode()).hexdigest()
+    data_uri = cache.get(key)
+    if data_uri is None:
+        img = _make(url).make_image(fill_color="black", back_color="white")
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        data_uri = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+        cache.set(key, data_uri, QR_CACHE_SECONDS)
+    return data_uri
+
+
+def svg_bytes(url):
+    """A single-path SVG, sharp at any size and compressible in transit."""
+    key = 'discovery:qr:svg:' + hashlib.sha1(url.encode()).hexdigest()
+    svg = cache.get(key)
+    if svg is None:
+        svg = _make(url, image_factory=qrcode.image.svg.SvgPathImage).make_image().to_string()
+        cache.set(key, svg, QR_CACHE_SECONDS)
+    return svg
@@ -1,3 +1,122 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from accounts.lastseen import last_seen
+from discovery.models import NearbyDevice
+from discovery.nearby import DatabaseNearbyIndex, NearbyIndex
+
+
+class DatabaseNearbyIndexTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def test_workers_see_each_others_devices(self):
+        first, second = DatabaseNearbyIndex(), DatabaseNearbyIndex()
+        self.assertEqual(first.heartbeat(self.alice, '10.0.0.1', 'laptop'), [])
+
+        devices = second.heartbeat(self.bob, '10.0.0.1', 'phone')
+        self.assertEqual([(d['user_id'], d['device_name']) for d in devices],
+                         [(self.alice.id, 'laptop')])
+        self.assertEqual(second.heartbeat(self.bob, '10.0.0.2', 'phone'), [])
+
+    def test_stale_devices_drop_out(self):
+        index = DatabaseNearbyIndex(ttl=60)
+        index.heartbeat(self.alice, '10.0.0.1', 'laptop')
+        NearbyDevice.objects.filter(user=self.alice).update(last_active='2000-01-01T00:00:00Z')
+        self.assertEqual(index.heartbeat(self.bob, '10.0.0.1', 'phone'), [])
+
+    def test_heartbeat_cost_does_not_grow_with_devices(self):
+        index = DatabaseNearbyIndex()
+        for n in range(5):
+            index.heartbeat(User.objects.create_user(f'user{n}'), '10.0.0.1', 'phone')
+        index.heartbeat(self.alice, '10.0.0.1', 'laptop')
+        with self.assertNumQueries(2):
+            self.assertEqual(len(index.heartbeat(self.alice, '10.0.0.1', 'laptop')), 5)
+
+
+class NearbyIndexTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+
+    def test_devices_on_the_same_ip_see_each_other(self):
+        index = NearbyIndex(flush_interval=3600)
+        self.addCleanup(index.flush_sync)
+        index.heartbeat(self.alice, '10.0.0.1', 'laptop')
+        with self.assertNumQueries(0):
+            devices = index.heartbeat(self.bob, '10.0.0.1', 'phone')
+        self.assertEqual([d['user_id'] for d in devices], [self.alice.id])
+
+    def test_expired_devices_drop_out(self):
+        index = NearbyIndex(ttl=0, flush_interval=3600)
+        self.addCleanup(index.flush_sync)
+        index.heartbeat(self.alice, '10.0.0.1', 'laptop')
+        self.assertEqual(index.heartbeat(self.bob, '10.0.0.1', 'phone'), [])
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class HeartbeatViewTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.addCleanup(last_seen.flush_sync)
+
+    def test_heartbeat_lists_other_devices_on_the_network(self):
+        self.client.force_login(self.alice)
+        self.client.get(reverse('discovery:heartbeat'), REMOTE_ADDR='10.0.0.7')
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse('discovery:heartbeat'), REMOTE_ADDR='10.0.0.7')
+        self.assertEqual([d['user_id'] for d in response.json()['devices']], [self.alice.id])
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+class QRCodeTests(TestCase):
+    def setUp(self):
+        # Rolled-back tests reuse user and device ids; forget their pairing codes
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.client.force_login(self.alice)
+        self.addCleanup(last_seen.flush_sync)
+        self.url = reverse('discovery:generate_qr')
+
+    def device_queries(self, response_fn):
+        with CaptureQueriesContext(connection) as queries:
+            response = response_fn()
+        return response, [q['sql'] for q in queries if 'discovery_nearbydevice' in q['sql']]
+
+    def test_revalidation_skips_the_device_lookup(self):
+        first = self.client.get(self.url, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first.json()['qr_image'].startswith('data:image/png;base64,'))
+
+        again, device_queries = self.device_queries(lambda: self.client.get(
+            self.url, REMOTE_ADDR='10.0.0.1', headers={'If-None-Match': first['ETag']},
+        ))
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(device_queries, [])
+
+    def test_other_network_gets_its_own_code(self):
+        first = self.client.get(self.url, REMOTE_ADDR='10.0.0.1')
+        other = self.client.get(self.url, REMOTE_ADDR='10.0.0.2', headers={'If-None-Match': first['ETag']})
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(NearbyDevice.objects.filter(user=self.alice).count(), 2)
+
+    def test_deleted_device_gets_a_new_code(self):
+        first = self.client.get(self.url, REMOTE_ADDR='10.0.0.1')
+        NearbyDevice.objects.filter(user=self.alice).delete()
+        again = self.client.get(self.url, REMOTE_ADDR='10.0.0.1', headers={'If-None-Match': first['ETag']})
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again['ETag'], first['ETag'])
+
+    def test_svg_is_only_served_to_its_owner(self):
+        svg_url = self.client.get(self.url, {'format': 'svg'}, REMOTE_ADDR='10.0.0.1').json()['qr_svg_url']
+        response = self.client.get(svg_url)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+
+        self.client.force_login(User.objects.create_user('eve'))
+        self.assertEqual(self.client.get(svg_url).status_code, 404)
@@ -5,6 +5,7 @@ app_name = 'discovery'
 
 urlpatterns = [
     path('qr/', views.generate_qr, name='generate_qr'),
+    path('qr/<uuid:pairing_code>.svg', views.qr_svg, name='qr_svg'),
     path('pair/<uuid:pairing_code>/', views.scan_pair, name='scan_pair'),
     path('heartbeat/', views.heartbeat, name='heartbeat'),
 ]
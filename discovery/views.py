@@ -1,13 +1,11 @@
-import qrcode
-import base64
-from io import BytesIO
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from django.utils import timezone
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from .models import NearbyDevice
-from accounts.models import UserProfile
-import datetime
+from .nearby import nearby_devices
+from .qr import QR_CACHE_SECONDS, device_pairing_code, pairing_url, png_data_uri, qr_etag, svg_bytes
 
 def get_client_ip(request):
     """Extract IP from request headers."""
@@ -18,35 +16,49 @@ def get_client_ip(request):
 
 @login_required
 def generate_qr(request):
-    """Generate a QR code for the current user's nearby connection."""
-    ip = get_client_ip(request)
-    device, created = NearbyDevice.objects.get_or_create(
-        user=request.user, 
-        ip_address=ip,
-        defaults={'device_name': request.META.get('HTTP_USER_AGENT', '')[:250]}
-    )
-    
-    # Generate pairing URL (assuming local network operation)
-    # The URL needs to point to the endpoint that handles the scan
-    host = request.get_host()
-    scheme = request.scheme
-    pairing_url = f"{scheme}://{host}/discovery/pair/{device.pairing_code}/"
-    
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+    """
+    Generate a QR code for the current user's nearby connection.
+    Returns {"qr_image": PNG data URI, "qr_svg_url": ...}, or with
+    ?format=svg only the SVG URL. The pairing code and rendered images are
+    cached, so a matching If-None-Match gets a 304 without a device lookup
+    or any rendering.
+    """
+    code = device_pairing_code(
+        request.user, get_client_ip(request), request.META.get('HTTP_USER_AGENT', '')[:250],
     )
-    qr.add_data(pairing_url)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    
-    return JsonResponse({'qr_image': f"data:image/png;base64,{img_str}"})
+
+    # Pairing URL (assuming local network operation) for the scan endpoint
+    url = pairing_url(request, code)
+    fmt = 'svg' if request.GET.get('format') == 'svg' else 'png'
+    etag = qr_etag(url, fmt)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        data = {'qr_svg_url': reverse('discovery:qr_svg', args=[code])}
+        if fmt == 'png':
+            data['qr_image'] = png_data_uri(url)
+        response = JsonResponse(data)
+    response['ETag'] = etag
+    # The device (and so the code) depends on the caller's IP: always revalidate
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@login_required
+def qr_svg(request, pairing_code):
+    """
+    The pairing QR code as a cacheable SVG image. The ETag depends only on
+    the URL, so revalidation is answered before the device lookup: a 304
+    tells the client nothing its cached copy does not already hold.
+    """
+    url = pairing_url(request, pairing_code)
+    etag = qr_etag(url, 'svg')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        get_object_or_404(NearbyDevice, pairing_code=pairing_code, user=request.user)
+        response = HttpResponse(svg_bytes(url), content_type='image/svg+xml')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=QR_CACHE_SECONDS)
+    return response
 
 @login_required
 def scan_pair(request, pairing_code):
@@ -64,32 +76,9 @@ def scan_pair(request, pairing_code):
 def heartbeat(request):
     """Ping endpoint to keep device active and return nearby devices."""
     ip = get_client_ip(request)
-    
-    # Update current user
-    device, created = NearbyDevice.objects.get_or_create(
-        user=request.user,
-        ip_address=ip,
-        defaults={'device_name': request.META.get('HTTP_USER_AGENT', '')[:250]}
+
+    # Devices on the same network (sharing same public IP on Vercel)
+    devices = nearby_devices.heartbeat(
+        request.user, ip, request.META.get('HTTP_USER_AGENT', '')[:250],
     )
-    device.save() # Updates last_active
-    
-    # Find others on same network (sharing same public IP on Vercel)
-    cutoff = timezone.now() - datetime.timedelta(minutes=5)
-    
-    active_devices = NearbyDevice.objects.filter(
-        ip_address=ip,
-        last_active__gte=cutoff
-    ).exclude(user=request.user)
-    
-    devices = []
-    for d in active_devices:
-        profile = getattr(d.user, 'profile', None)
-        devices.append({
-            'user_id': d.user.id,
-            'username': d.user.get_full_name() or d.user.username,
-            'avatar': profile.avatar_url if profile else '/static/img/default-avatar.svg',
-            'ip': d.ip_address,
-            'device_name': d.device_name
-        })
-        
     return JsonResponse({'devices': devices})
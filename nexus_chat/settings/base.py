@@ -180,3 +180,129 @@ ALLOWED_UPLOAD_EXTENSIONS = [
 SESSION_ENGINE = 'django.contrib.sessions.backends.file'
 SESSION_FILE_PATH = os.path.join(BASE_DIR, 'sessions')
 
+# ── Chat Write-Behind ───────────────────────────────────────────────────────
+# Opt-in: WebSocket messages are broadcast immediately and persisted in
+# batches of up to MAX_BATCH rows, at most MAX_DELAY_MS after arrival.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'False').lower() in ('true', '1', 'yes')
+CHAT_WRITE_BEHIND_MAX_BATCH = 50
+CHAT_WRITE_BEHIND_MAX_DELAY_MS = 50
+# A conversation whose rows keep failing is retried with backoff and set
+# aside (MessageWriteBehind.dead_letters) after this many attempts.
+CHAT_WRITE_BEHIND_MAX_ATTEMPTS = 8
+# Messages set aside, and those still failing at shutdown, are appended here
+# (one JSON fixture per line) so they outlive the process.
+CHAT_WRITE_BEHIND_DEAD_LETTER_PATH = (
+    os.environ.get('CHAT_WRITE_BEHIND_DEAD_LETTER_PATH') or str(BASE_DIR / 'write_behind_dead_letters.jsonl')
+)
+
+# ── Shared Cache ────────────────────────────────────────────────────────────
+# Holds device pairing codes. 'memory' (the default) is per process; 'redis'
+# uses REDIS_URL and is shared by every worker.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# ── Chat Cache Versions ─────────────────────────────────────────────────────
+# Invalidation counters for the membership and recent-message caches; every
+# worker must see the same ones (see chat/versions.py). 'memory' is correct
+# with a single worker only, 'sqlite' shares a file between the workers on one
+# host, 'cache' uses the shared cache and needs CACHE_BACKEND=redis.
+CHAT_CACHE_VERSIONS = os.environ.get('CHAT_CACHE_VERSIONS', 'memory')
+CHAT_CACHE_VERSIONS_PATH = os.environ.get('CHAT_CACHE_VERSIONS_PATH') or str(BASE_DIR / 'versions.sqlite3')
+# How long a worker trusts a version it has checked before reading it again,
+# i.e. the longest another worker's write can go unseen.
+CHAT_CACHE_VERSION_TTL_MS = 1000
+
+# ── Chat Membership Cache ───────────────────────────────────────────────────
+# Max users (and, separately, conversations) kept in each membership LRU.
+CHAT_MEMBERSHIP_CACHE_SIZE = 10000
+
+# ── Read Receipts ───────────────────────────────────────────────────────────
+# WebSocket read acks are coalesced per user/conversation and written after this delay.
+CHAT_READ_RECEIPT_DEBOUNCE_MS = 500
+# Cursors whose last written id each worker remembers, to drop repeated acks.
+CHAT_READ_CURSORS_REMEMBERED = 10000
+
+# ── WebSocket Outbound Queues ───────────────────────────────────────────────
+# Per-connection send buffer. Typing/presence frames are coalesced or dropped
+# when it fills; a chat frame that still does not fit disconnects the client.
+CHAT_OUTBOUND_MAX_MESSAGES = 256
+CHAT_OUTBOUND_MAX_BYTES = 1024 * 1024
+
+# ── Event Replay ────────────────────────────────────────────────────────────
+# Recent conversation events kept per conversation for reconnecting clients.
+CHAT_REPLAY_BUFFER_SIZE = 200
+
+# ── Recent Messages Cache ───────────────────────────────────────────────────
+# Newest messages kept in memory per conversation, and the total size budget
+# (estimated) across all conversations before LRU eviction.
+CHAT_RECENT_MESSAGES_PER_CONVERSATION = 100
+CHAT_RECENT_MESSAGES_MAX_BYTES = 32 * 1024 * 1024
+
+# ── Message History Pages ───────────────────────────────────────────────────
+# Messages per page in the conversation view and the history endpoints
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 100
+
+# ── HTTP Polling Fallback ───────────────────────────────────────────────────
+# Longest a ?wait= poll is held open before answering "nothing new"
+CHAT_LONG_POLL_TIMEOUT = 25
+# Version recheck for waits no channel-layer event can wake (e.g. under WSGI)
+CHAT_LONG_POLL_RECHECK = 3
+
+# ── Server-Sent Events ──────────────────────────────────────────────────────
+# Comment line sent on idle streams, and the lifetime of one stream (the
+# browser reconnects and resumes); keep it under the host's request timeout
+CHAT_SSE_HEARTBEAT = 15
+CHAT_SSE_MAX_SECONDS = int(os.environ.get('CHAT_SSE_MAX_SECONDS', 300))
+
+# ── Presence Broadcasts ─────────────────────────────────────────────────────
+# Joins and leaves are merged into one delta per window (0 sends each at once)
+CHAT_PRESENCE_WINDOW_MS = 250
+# Presence is always split by organization; also split it by client network
+# with 'ip' (same address) or 'subnet' (same /24 IPv4 or /64 IPv6 prefix).
+CHAT_PRESENCE_NETWORK_SCOPE = os.environ.get('CHAT_PRESENCE_NETWORK_SCOPE') or None
+CHAT_PRESENCE_SUBNET_PREFIX = 24
+CHAT_PRESENCE_SUBNET_PREFIX_V6 = 64
+# Registry of open presence sockets: 'memory' (this process) or 'sqlite' (a
+# file shared by every worker on the host). Sockets expire CHAT_PRESENCE_TTL
+# seconds after their last heartbeat (clients beat every 30s).
+CHAT_PRESENCE_STORE = os.environ.get('CHAT_PRESENCE_STORE', 'memory')
+CHAT_PRESENCE_STORE_PATH = os.environ.get('CHAT_PRESENCE_STORE_PATH') or str(BASE_DIR / 'presence.sqlite3')
+CHAT_PRESENCE_TTL = 75
+CHAT_PRESENCE_SWEEP_INTERVAL = 15
+
+# ── Online Status ───────────────────────────────────────────────────────────
+# Seconds a user's last socket may be closed before they are stored as offline
+# (covers page reloads and switching conversations).
+CHAT_ONLINE_GRACE_SECONDS = 5
+# A presence socket on another worker keeps a user online only while its last
+# heartbeat is this recent; older rows may belong to a worker that crashed.
+CHAT_ONLINE_FRESH_SECONDS = 40
+
+# ── Last Seen ───────────────────────────────────────────────────────────────
+# Requests record last_seen at most once per user per LAST_SEEN_MIN_INTERVAL
+# seconds; pending values are written in bulk every LAST_SEEN_FLUSH_INTERVAL.
+LAST_SEEN_MIN_INTERVAL = 60
+LAST_SEEN_FLUSH_INTERVAL = 30
+
+# ── Nearby Discovery ────────────────────────────────────────────────────────
+# Where heartbeats find each other: 'database' (NearbyDevice rows, seen by
+# every worker and instance) or 'memory' (an index in this process, only
+# correct with a single worker). Devices drop out NEARBY_DEVICE_TTL seconds
+# after their last heartbeat. With 'memory', QR-pairing rows get their
+# last_active refreshed in one batch every NEARBY_FLUSH_INTERVAL seconds.
+NEARBY_INDEX = os.environ.get('NEARBY_INDEX', 'database')
+NEARBY_DEVICE_TTL = 300
+NEARBY_FLUSH_INTERVAL = 30
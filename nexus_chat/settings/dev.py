@@ -2,6 +2,8 @@
 Nexus Chat Web — Development Settings
 Uses MongoDB via djongo connector.
 """
+import os
+
 from .base import *  # noqa: F401,F403
 
 DEBUG = True
@@ -18,8 +20,19 @@ DATABASES = {
 print('[Nexus] Using SQLite database')
 
 # ── Channel layer — in-memory for development (no Redis needed) ──
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# Set CHANNEL_LAYER=sqlite to run several workers on one host.
+if os.environ.get('CHANNEL_LAYER', 'memory') == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CHANNEL_LAYER_PATH') or str(BASE_DIR / 'channels.sqlite3'),
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
     }
-}
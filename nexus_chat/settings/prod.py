@@ -34,11 +34,23 @@ else:
     }
 
 # ── Channel Layer ─────────────────────────────────────────────
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# In-memory only works with a single worker process. With several workers
+# on one host, set CHANNEL_LAYER=sqlite to share groups through a SQLite file.
+if os.environ.get('CHANNEL_LAYER', 'memory') == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CHANNEL_LAYER_PATH') or str(BASE_DIR / 'channels.sqlite3'),
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
     }
-}
 
 # ── Static & Media Files ──────────────────────────────────────
 # On Vercel, static files are served via the @vercel/static build.
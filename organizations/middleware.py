@@ -2,6 +2,7 @@
 Organizations — Middleware
 Resolves the active organization from session and attaches it to the request.
 """
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.shortcuts import redirect
 from django.urls import reverse
 
@@ -22,20 +23,40 @@ class OrganizationMiddleware:
         '/',
     ]
 
+    # Async-capable so async views (the long-poll endpoint) stay on the event loop
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.resolve(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # request.auser() caches its own copy of the user, which the view and
+        # UpdateLastSeenMiddleware reuse; request.user would load it again
+        user = await request.auser()
+        await sync_to_async(self.resolve)(request, user)
+        return await self.get_response(request)
+
+    def resolve(self, request, user=None):
         request.organization = None
+        user = user or request.user
 
-        if request.user.is_authenticated:
+        if user.is_authenticated:
             org_id = request.session.get('active_org_id')
             if org_id:
                 from organizations.models import Organization, OrganizationMembership
                 try:
                     org = Organization.objects.get(id=org_id, is_active=True)
                     # Verify user is a member
-                    mem = OrganizationMembership.objects.filter(organization=org, user=request.user).first()
+                    mem = OrganizationMembership.objects.filter(organization=org, user=user).first()
                     if mem and mem.is_active:
                         request.organization = org
                 except Organization.DoesNotExist:
@@ -44,11 +65,8 @@ class OrganizationMiddleware:
             # If no org set and user has memberships, auto-set the first one
             if not request.organization:
                 from organizations.models import OrganizationMembership
-                memberships = OrganizationMembership.objects.filter(user=request.user)
+                memberships = OrganizationMembership.objects.filter(user=user)
                 membership = next((m for m in memberships if m.is_active), None)
                 if membership:
                     request.organization = membership.organization
                     request.session['active_org_id'] = membership.organization.id
-
-        response = self.get_response(request)
-        return response
@@ -13,15 +13,23 @@
     const username = app.dataset.user;
     const userId = app.dataset.userId;
     const conversationId = app.dataset.conversationId;
+    const conversationMuted = app.dataset.muted === '1';
     const messagesArea = document.getElementById('messagesArea');
     const messageInput = document.getElementById('messageInput');
     const sendBtn = document.getElementById('sendBtn');
 
     let chatSocket = null;
-    let presenceSocket = null;
     let typingTimeout = null;
     let jwtToken = null;
     let currentUploadXHR = null;
+    let readAckTimer = null;
+    let pendingAckId = 0;
+    let lastAckedId = 0;
+    let streamEpoch = null;
+    let streamSeq = 0;
+    let lastSeq = 0;
+    let reconnectDelay = 500;
+    const SLOW_CONSUMER_CLOSE_CODE = 4008;
 
     // ──── JWT Token Fetch ────────────────────────────────────────────
     async function fetchJWT() {
@@ -36,16 +44,28 @@
         }
     }
 
-    // ──── WebSocket Connection (Chat) ────────────────────────────────
+    // ──── WebSocket Connection (multiplexed stream) ──────────────────
+    // One socket per page carries the open conversation, presence and
+    // sidebar updates; conversations are joined with in-band frames.
     function connectWebSocket() {
-        if (!conversationId) return;
         const wsProtocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
-        let wsUrl = `${wsProtocol}//${location.host}/ws/chat/${conversationId}/`;
+        let wsUrl = `${wsProtocol}//${location.host}/ws/stream/`;
         if (jwtToken) wsUrl += `?token=${jwtToken}`;
         chatSocket = new WebSocket(wsUrl);
 
         chatSocket.onopen = () => {
-            console.log('[Nexus] Chat WebSocket connected');
+            console.log('[Nexus] Stream WebSocket connected');
+            reconnectDelay = 500;
+            stopEventStream();
+            if (conversationId) {
+                const frame = { type: 'subscribe', conversation_id: conversationId };
+                if (streamEpoch) {
+                    // Reconnect: ask for only what was missed since the last event seen
+                    frame.resume = { epoch: streamEpoch, seq: streamSeq };
+                    frame.after_seq = lastSeq;
+                }
+                chatSocket.send(JSON.stringify(frame));
+            }
         };
 
         chatSocket.onmessage = (e) => {
@@ -54,52 +74,155 @@
         };
 
         chatSocket.onclose = (e) => {
-            console.log('[Nexus] Chat WebSocket closed, reconnecting in 3s...');
-            setTimeout(connectWebSocket, 3000);
+            // Missed events are replayed on resubscribe, so reconnect quickly;
+            // back off (with jitter) only while the server stays unreachable.
+            // A slow-consumer close means the server is fine: retry at once.
+            const delay = e.code === SLOW_CONSUMER_CLOSE_CODE ? 0 : reconnectDelay;
+            console.log(`[Nexus] Stream WebSocket closed, reconnecting in ${delay}ms...`);
+            setTimeout(connectWebSocket, delay + Math.random() * 250);
+            reconnectDelay = Math.min(reconnectDelay * 2, 15000);
         };
 
         chatSocket.onerror = (err) => {
-            console.error('[Nexus] Chat WebSocket error:', err);
-            // Switch to HTTP polling if WebSocket fails
-            startHttpPolling();
+            console.error('[Nexus] Stream WebSocket error:', err);
+            startFallback();
+        };
+    }
+
+    function sendFrame(frame) {
+        if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) return false;
+        chatSocket.send(JSON.stringify({ ...frame, conversation_id: conversationId }));
+        return true;
+    }
+
+    // ──── Fallback Transports ─────────────────────────────────────────
+    // Without a socket, events come from a Server-Sent Events stream (same
+    // frames, resumed with Last-Event-ID); browsers without EventSource, or
+    // servers that refuse the stream, fall back to long-polling.
+    let eventSource = null;
+    let eventSourceFailed = false;
+
+    function startFallback() {
+        if (chatSocket && chatSocket.readyState === WebSocket.OPEN) return;
+        if (window.EventSource && !eventSourceFailed) startEventStream();
+        else startHttpPolling();
+    }
+
+    function startEventStream() {
+        if (eventSource) return;
+        const params = new URLSearchParams();
+        if (conversationId) {
+            params.set('conversation', conversationId);
+            if (streamEpoch) {
+                params.set('last_event_id', `${streamEpoch}:${streamSeq}`);
+                params.set('after_seq', lastSeq);
+            }
+        }
+        console.log('[Nexus] Starting event stream fallback...');
+        eventSource = new EventSource(`/chat/events/?${params}`);
+        eventSource.onmessage = (e) => handleSocketMessage(JSON.parse(e.data));
+        eventSource.onerror = () => {
+            // CLOSED means the server refused the stream; otherwise the browser reconnects
+            if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+                eventSource = null;
+                eventSourceFailed = true;
+                startHttpPolling();
+            }
         };
     }
 
+    function stopEventStream() {
+        if (!eventSource) return;
+        eventSource.close();
+        eventSource = null;
+    }
+
+    // Long-polls: each request is held by the server until a message
+    // arrives (up to LONG_POLL_WAIT seconds), and an idle answer is a bodiless
+    // 304 for the ETag we already have. Stops once the socket is back.
+    const LONG_POLL_WAIT = 25;
+    const POLL_RETRY_DELAY = 5000;
+    let polling = false;
+    let pollEtag = null;
+
     function startHttpPolling() {
-        if (!conversationId) return;
-        if (window.pollingInterval) return;
+        if (!conversationId || polling) return;
         console.log('[Nexus] Starting HTTP polling fallback...');
-        window.pollingInterval = setInterval(pollMessages, 5000);
+        polling = true;
+        pollLoop();
+    }
+
+    async function pollLoop() {
+        while (polling) {
+            if (chatSocket && chatSocket.readyState === WebSocket.OPEN) break;
+            if (!(await pollMessages())) {
+                await new Promise(resolve => setTimeout(resolve, POLL_RETRY_DELAY));
+            }
+        }
+        polling = false;
     }
 
     async function pollMessages() {
-        if (!conversationId) return;
-        const lastMsg = messagesArea.querySelector('.message:last-child');
-        const lastId = lastMsg ? lastMsg.dataset.msgId : null;
-        let url = `/chat/${conversationId}/messages-http/`;
-        if (lastId) url += `?after_id=${lastId}`;
+        if (!conversationId) return false;
+        let lastId = 0;
+        messagesArea.querySelectorAll('.message[data-msg-id]').forEach(el => {
+            lastId = Math.max(lastId, Number(el.dataset.msgId) || 0);
+        });
+        const url = `/chat/${conversationId}/messages-http/?after_id=${lastId}&wait=${LONG_POLL_WAIT}`;
 
         try {
-            const resp = await fetch(url);
-            if (resp.ok) {
-                const data = await resp.json();
-                if (data.messages && data.messages.length > 0) {
-                    data.messages.forEach(appendMessage);
-                    scrollToBottom();
-                }
+            const headers = pollEtag ? { 'If-None-Match': pollEtag } : {};
+            const resp = await fetch(url, { headers, cache: 'no-store' });
+            if (resp.status === 304) return true;
+            if (!resp.ok) return false;
+            pollEtag = resp.headers.get('ETag');
+            const data = await resp.json();
+            if (data.messages && data.messages.length > 0) {
+                data.messages.forEach(appendMessage);
+                scrollToBottom();
             }
+            return true;
         } catch (e) {
             console.warn('[Nexus] HTTP polling failed');
+            return false;
         }
     }
 
     function handleSocketMessage(data) {
+        switch (data.type) {
+            case 'presence_snapshot':
+                onlineUsers.snapshot(data);
+                return;
+            case 'presence_delta':
+                onlineUsers.delta(data);
+                return;
+            case 'nearby_snapshot':
+                nearbyDevices.snapshot(data);
+                return;
+            case 'nearby_delta':
+                nearbyDevices.delta(data);
+                return;
+            case 'sidebar':
+                updateSidebar(data);
+                return;
+        }
+        // Conversation frames for anything but the open chat are ignored
+        if (data.conversation_id && String(data.conversation_id) !== String(conversationId)) return;
+
+        // Replayed and live copies of an event share a seq; apply it once
+        if (data.seq !== undefined) {
+            if (data.epoch === streamEpoch && data.seq <= streamSeq) return;
+            streamEpoch = data.epoch;
+            streamSeq = data.seq;
+        }
+
         switch (data.type) {
             case 'message':
                 appendMessage(data.message);
                 scrollToBottom();
                 if (data.message.sender !== username) {
-                    showNotification(data.message.sender, data.message.content);
+                    if (!conversationMuted) showNotification(data.message.sender, data.message.content);
+                    scheduleReadAck(data.message.id);
                 }
                 break;
             case 'typing':
@@ -120,48 +243,103 @@
             case 'status':
                 updateUserStatus(data);
                 break;
+            case 'persisted':
+                assignPersistedIds(data.messages);
+                break;
+            case 'subscribed':
+                streamEpoch = data.epoch;
+                streamSeq = data.seq;
+                break;
+            case 'resync':
+                // The server could not replay the gap; it sent newer messages instead
+                if (data.truncated) {
+                    location.reload();
+                    return;
+                }
+                data.messages.forEach(appendMessage);
+                if (data.messages.length) scrollToBottom();
+                break;
         }
     }
 
-    // ──── WebSocket Connection (Presence) ────────────────────────────
-    function connectPresenceSocket() {
-        const wsProtocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
-        let wsUrl = `${wsProtocol}//${location.host}/ws/presence/`;
-        if (jwtToken) wsUrl += `?token=${jwtToken}`;
-        presenceSocket = new WebSocket(wsUrl);
+    // ──── Message Sequence ───────────────────────────────────────────
+    // Messages are numbered 1, 2, 3... per conversation; a jump means frames
+    // were lost, and exactly the missing range is fetched.
+    function noteSeq(seq) {
+        if (!seq) return;
+        if (lastSeq && seq > lastSeq + 1) fetchMissing(lastSeq, seq - 1);
+        lastSeq = Math.max(lastSeq, seq);
+    }
 
-        presenceSocket.onopen = () => {
-            console.log('[Nexus] Presence WebSocket connected');
-        };
+    async function fetchMissing(afterSeq, untilSeq) {
+        try {
+            const resp = await fetch(`/chat/${conversationId}/messages-http/?after_seq=${afterSeq}&until_seq=${untilSeq}`);
+            if (resp.ok) {
+                const data = await resp.json();
+                data.messages.forEach(appendMessage);
+            }
+        } catch (e) {
+            console.warn('[Nexus] Fetching missed messages failed');
+        }
+    }
 
-        presenceSocket.onmessage = (e) => {
-            const data = JSON.parse(e.data);
-            if (data.type === 'presence_update') {
-                renderNearbyDevices(data.users);
+    // ──── Older History ──────────────────────────────────────────────
+    // The page renders the newest messages only; scrolling near the top
+    // fetches the page before the oldest one shown and keeps the view still.
+    const HISTORY_SCROLL_MARGIN = 200;
+    let hasOlder = messagesArea?.dataset.hasOlder === '1';
+    let loadingOlder = false;
+
+    async function loadOlder() {
+        if (!hasOlder || loadingOlder || !conversationId) return;
+        const oldest = messagesArea.querySelector('.message[data-msg-seq]');
+        if (!oldest || !Number(oldest.dataset.msgSeq)) return;
+        loadingOlder = true;
+        try {
+            const resp = await fetch(`/chat/${conversationId}/history/?before_seq=${oldest.dataset.msgSeq}`);
+            if (resp.ok) {
+                const data = await resp.json();
+                const fromBottom = messagesArea.scrollHeight - messagesArea.scrollTop;
+                data.messages.forEach(appendMessage);
+                messagesArea.scrollTop = messagesArea.scrollHeight - fromBottom;
+                hasOlder = data.has_more;
             }
-        };
+        } catch (e) {
+            console.warn('[Nexus] Loading older messages failed');
+        } finally {
+            loadingOlder = false;
+        }
+    }
 
-        presenceSocket.onclose = () => {
-            console.log('[Nexus] Presence WebSocket closed, reconnecting in 5s...');
-            setTimeout(connectPresenceSocket, 5000);
-        };
+    messagesArea?.addEventListener('scroll', () => {
+        if (messagesArea.scrollTop < HISTORY_SCROLL_MARGIN) loadOlder();
+    }, { passive: true });
 
-        presenceSocket.onerror = (err) => {
-            console.error('[Nexus] Presence WebSocket error:', err);
-        };
+    function initialSeq() {
+        messagesArea?.querySelectorAll('.message[data-msg-seq]').forEach(el => {
+            lastSeq = Math.max(lastSeq, Number(el.dataset.msgSeq) || 0);
+        });
+    }
 
+    // ──── Heartbeat ──────────────────────────────────────────────────
+    // Nearby devices are pushed over the socket; the HTTP heartbeat is only
+    // a low-frequency fallback while the socket is down (e.g. on Vercel).
+    const NEARBY_FALLBACK_INTERVAL = 60000;
+    let lastNearbyPoll = 0;
+
+    function startHeartbeat() {
         // Heartbeat every 30 seconds
         setInterval(() => {
-            if (presenceSocket && presenceSocket.readyState === WebSocket.OPEN) {
-                presenceSocket.send(JSON.stringify({ type: 'heartbeat' }));
-            } else {
-                // Fallback to polling if WebSocket is not connected (Vercel)
+            if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+                chatSocket.send(JSON.stringify({ type: 'heartbeat' }));
+            } else if (Date.now() - lastNearbyPoll >= NEARBY_FALLBACK_INTERVAL) {
                 pollNearbyFallback();
             }
         }, 30000);
     }
 
     async function pollNearbyFallback() {
+        lastNearbyPoll = Date.now();
         try {
             const resp = await fetch('/discovery/heartbeat/');
             if (resp.ok) {
@@ -173,6 +351,50 @@
         }
     }
 
+    // ──── Presence State ─────────────────────────────────────────────
+    // Two partitions arrive the same way: "presence" (who is online in the
+    // organization, shown as status dots) and "nearby" (devices on this
+    // network). One snapshot on connect, then versioned join/leave deltas.
+    // A skipped version means a delta was lost: ask for a new snapshot.
+    function presencePartition(kind, render) {
+        const users = new Map();
+        let version = null;
+        return {
+            snapshot(data) {
+                users.clear();
+                data.users.forEach(u => users.set(u.user_id, u));
+                version = data.version;
+                render(users);
+            },
+            delta(data) {
+                if (version === null || data.version <= version) return;
+                if (data.version !== version + 1) {
+                    version = null;
+                    chatSocket.send(JSON.stringify({ type: `${kind}_sync` }));
+                    return;
+                }
+                data.joined.forEach(u => {
+                    if (String(u.user_id) !== String(userId)) users.set(u.user_id, u);
+                });
+                data.left.forEach(id => users.delete(id));
+                version = data.version;
+                render(users, data.left);
+            },
+        };
+    }
+
+    const onlineUsers = presencePartition('presence', renderOnlineStatus);
+    const nearbyDevices = presencePartition('nearby', devices => renderNearbyDevices([...devices.values()]));
+
+    // Users outside this partition keep the status the page was rendered with
+    function renderOnlineStatus(users, left = []) {
+        document.querySelectorAll('.conversation-item .status-dot[data-user-id]').forEach(dot => {
+            const id = Number(dot.dataset.userId);
+            if (users.has(id)) dot.classList.add('online');
+            else if (left.includes(id)) dot.classList.remove('online');
+        });
+    }
+
     // ──── Nearby Devices Rendering ───────────────────────────────────
     function renderNearbyDevices(users) {
         const list = document.getElementById('nearbyDeviceList');
@@ -228,16 +450,22 @@
         if (emptyState) emptyState.remove();
 
         // Check for duplicate message (from upload broadcast)
-        if (messagesArea.querySelector(`[data-msg-id="${data.id}"]`)) return;
+        if (data.id && messagesArea.querySelector(`[data-msg-id="${data.id}"]`)) return;
+        if (data.uid && messagesArea.querySelector(`[data-msg-uid="${data.uid}"]`)) return;
 
         const isSent = data.sender === username;
         const div = document.createElement('div');
         div.className = `message ${isSent ? 'sent' : 'received'}`;
-        div.dataset.msgId = data.id;
+        div.dataset.msgId = data.id || '';
+        div.dataset.msgSeq = data.seq || '';
+        if (data.uid) div.dataset.msgUid = data.uid;
         div.dataset.sender = data.sender;
 
         let contentHtml = '';
-        if (data.message_type === 'image' && data.media_url) {
+        if (data.is_deleted) {
+            div.classList.add('deleted');
+            contentHtml = '<p class="msg-deleted"><span class="material-icons-round">block</span> This message was deleted</p>';
+        } else if (data.message_type === 'image' && data.media_url) {
             contentHtml = `<div class="msg-media"><img src="${data.media_url}" alt="Image" loading="lazy" onclick="openMediaViewer(this.src)"></div>`;
         } else if (data.message_type === 'video' && data.media_url) {
             contentHtml = `<div class="msg-media"><video src="${data.media_url}" controls></video></div>`;
@@ -258,6 +486,7 @@
             ${!isSent && data.sender_avatar ? `<img src="${data.sender_avatar}" alt="" class="msg-avatar">` : ''}
             <div class="msg-bubble">
                 ${contentHtml}
+                ${data.is_edited && !data.is_deleted ? '<span class="msg-edited-tag">edited</span>' : ''}
                 <div class="msg-meta">
                     <span class="msg-time">${time}</span>
                     ${statusHtml}
@@ -265,6 +494,21 @@
             </div>
         `;
 
+        insertBySeq(div, data.seq);
+        noteSeq(data.seq);
+    }
+
+    function insertBySeq(div, seq) {
+        // Gap fills arrive after newer messages; slot them into place
+        const last = messagesArea.querySelector('.message:last-child');
+        if (seq && last && Number(last.dataset.msgSeq) > seq) {
+            const later = [...messagesArea.querySelectorAll('.message[data-msg-seq]')]
+                .find(el => Number(el.dataset.msgSeq) > seq);
+            if (later) {
+                messagesArea.insertBefore(div, later);
+                return;
+            }
+        }
         messagesArea.appendChild(div);
     }
 
@@ -274,12 +518,7 @@
         const content = messageInput.value.trim();
         if (!content) return;
 
-        if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-            chatSocket.send(JSON.stringify({
-                type: 'message',
-                content: content,
-            }));
-        } else {
+        if (!sendFrame({ type: 'message', content: content })) {
             // Fallback to HTTP POST
             try {
                 const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]')?.value
@@ -298,8 +537,8 @@
                     const data = await resp.json();
                     appendMessage(data);
                     scrollToBottom();
-                    // Also start polling if not already
-                    startHttpPolling();
+                    // Also start a fallback transport if not already
+                    startFallback();
                 }
             } catch (e) {
                 console.error('[Nexus] HTTP send failed', e);
@@ -320,8 +559,7 @@
 
     // ──── Typing Indicator ───────────────────────────────────────────
     window.handleTyping = function () {
-        if (!chatSocket) return;
-        chatSocket.send(JSON.stringify({ type: 'typing' }));
+        sendFrame({ type: 'typing' });
 
         if (typingTimeout) clearTimeout(typingTimeout);
         typingTimeout = setTimeout(() => { }, 3000);
@@ -340,48 +578,65 @@
 
     // ──── Message Actions ────────────────────────────────────────────
     window.reactToMessage = function (msgId, emoji) {
-        if (!chatSocket) return;
         emoji = emoji || prompt('Enter an emoji:');
         if (!emoji) return;
-        chatSocket.send(JSON.stringify({
+        sendFrame({
             type: 'reaction',
             message_id: msgId,
             emoji: emoji,
-        }));
+        });
     };
 
     window.editMessage = function (msgId) {
-        if (!chatSocket) return;
         const msgEl = document.querySelector(`[data-msg-id="${msgId}"] .msg-text`);
         if (!msgEl) return;
         const newContent = prompt('Edit message:', msgEl.textContent);
         if (newContent !== null && newContent.trim()) {
-            chatSocket.send(JSON.stringify({
+            sendFrame({
                 type: 'edit',
                 message_id: msgId,
                 content: newContent.trim(),
-            }));
+            });
         }
     };
 
     window.deleteMessage = function (msgId) {
-        if (!chatSocket) return;
         if (confirm('Delete this message?')) {
-            chatSocket.send(JSON.stringify({
+            sendFrame({
                 type: 'delete',
                 message_id: msgId,
-            }));
+            });
         }
     };
 
     // ──── DOM Updates ────────────────────────────────────────────────
+    // Receipts carry the reader's high-water mark: everything up to it is seen
     function markMessagesRead(data) {
-        document.querySelectorAll('.message.sent .msg-status .material-icons-round').forEach(el => {
-            el.textContent = 'done_all';
-            el.classList.add('read');
+        if (data.reader === username) return;
+        document.querySelectorAll('.message.sent').forEach(msgEl => {
+            const id = Number(msgEl.dataset.msgId);
+            if (!id || id > data.message_id) return;
+            const el = msgEl.querySelector('.msg-status .material-icons-round');
+            if (el) {
+                el.textContent = 'done_all';
+                el.classList.add('read');
+            }
         });
     }
 
+    // Acks are debounced; the server only needs the highest id seen
+    function scheduleReadAck(msgId) {
+        if (!msgId || msgId <= lastAckedId) return;
+        pendingAckId = Math.max(pendingAckId, msgId);
+        if (readAckTimer) return;
+        readAckTimer = setTimeout(() => {
+            readAckTimer = null;
+            if (pendingAckId > lastAckedId && sendFrame({ type: 'read_receipt', message_id: pendingAckId })) {
+                lastAckedId = pendingAckId;
+            }
+        }, 1000);
+    }
+
     function updateReaction(data) {
         const msgEl = document.querySelector(`[data-msg-id="${data.message_id}"]`);
         if (!msgEl) return;
@@ -391,18 +646,37 @@
             reactionsDiv.className = 'msg-reactions';
             msgEl.querySelector('.msg-bubble').appendChild(reactionsDiv);
         }
+        // The event carries {emoji: count}; "mine" is tracked from our own toggles
+        const mine = new Set([...reactionsDiv.querySelectorAll('.reaction-chip.mine')].map(c => c.dataset.emoji));
+        if (data.username === username) {
+            if (data.added) mine.add(data.emoji); else mine.delete(data.emoji);
+        }
         reactionsDiv.innerHTML = '';
         if (data.reactions) {
-            for (const [emoji, users] of Object.entries(data.reactions)) {
+            for (const [emoji, count] of Object.entries(data.reactions)) {
                 const chip = document.createElement('span');
-                chip.className = 'reaction-chip';
-                chip.textContent = `${emoji} ${users.length}`;
+                chip.className = `reaction-chip${mine.has(emoji) ? ' mine' : ''}`;
+                chip.dataset.emoji = emoji;
+                chip.textContent = `${emoji} ${count}`;
                 chip.onclick = () => reactToMessage(data.message_id, emoji);
                 reactionsDiv.appendChild(chip);
             }
         }
     }
 
+    // Write-behind messages are broadcast before they have a database id
+    function assignPersistedIds(messages) {
+        (messages || []).forEach(m => {
+            const msgEl = document.querySelector(`[data-msg-uid="${m.uid}"]`);
+            if (msgEl) {
+                msgEl.dataset.msgId = m.id;
+                msgEl.dataset.msgSeq = m.seq;
+                if (msgEl.dataset.sender !== username) scheduleReadAck(m.id);
+            }
+            noteSeq(m.seq);
+        });
+    }
+
     function editMessageDOM(data) {
         const msgEl = document.querySelector(`[data-msg-id="${data.message_id}"] .msg-text`);
         if (msgEl) {
@@ -426,6 +700,18 @@
         }
     }
 
+    function updateSidebar(data) {
+        const item = document.querySelector(`.conversation-item[data-id="${data.conversation_id}"]`);
+        if (!item) return;
+        const preview = item.querySelector('.conv-preview');
+        const time = item.querySelector('.conv-time');
+        if (preview) preview.textContent = data.message.content || `[${data.message.message_type}]`;
+        if (time) time.textContent = 'just now';
+        // Most recent activity first
+        const list = document.getElementById('conversationList');
+        if (list && list.firstElementChild !== item) list.prepend(item);
+    }
+
     function updateUserStatus(data) {
         const dot = document.getElementById('headerStatusDot');
         const status = document.getElementById('chatHeaderStatus');
@@ -662,21 +948,24 @@
     // ──── Init ───────────────────────────────────────────────────────
     async function init() {
         scrollToBottom();
+        initialSeq();
+        // A short first page leaves nothing to scroll; fill the view
+        if (messagesArea && messagesArea.scrollHeight <= messagesArea.clientHeight) loadOlder();
         await fetchJWT();
         connectWebSocket();
-        connectPresenceSocket();
+        startHeartbeat();
         
-        // Initial fallback check for nearby
-        setTimeout(pollNearbyFallback, 2000);
-
-        // If in a conversation, check if WebSocket is working, otherwise fallback to polling
-        if (conversationId) {
-            setTimeout(() => {
-                if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) {
-                    startHttpPolling();
-                }
-            }, 3000);
-        }
+        // Initial fallback check for nearby, only if the socket did not come up
+        setTimeout(() => {
+            if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) pollNearbyFallback();
+        }, 2000);
+
+        // If the WebSocket is not up by now, use the event stream (or polling)
+        setTimeout(() => {
+            if (!chatSocket || chatSocket.readyState !== WebSocket.OPEN) {
+                startFallback();
+            }
+        }, 3000);
     }
 
     init();